@@ -7,6 +7,7 @@ Global variables:
   outformats - a dictionary of supported output formats
   descs - a list of supported descriptors
   fps - a list of supported fingerprint types
+  screenfps - the fingerprint types used by substructsearch()
   forcefields - a list of supported forcefields
 """
 
@@ -18,6 +19,12 @@ import base64
 import tempfile
 import StringIO
 
+import recordio
+import fpsearch
+import desctable
+import smartslib
+import molgraph
+
 from jpype import *
 
 _jvm = os.environ['JPYPE_JVM']
@@ -37,6 +44,18 @@ try:
 except ImportError:
     tk = None
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _checknumpy():
+    if not numpy:
+        errormessage = ("NumPy not found, but is required for coordinate "
+                        "arrays. See installation instructions for "
+                        "more information.")
+        raise ImportError, errormessage
+
 cdk = JPackage("org").openscience.cdk
 try:
     _testmol = cdk.Molecule()
@@ -60,6 +79,11 @@ descs = _descdict.keys()
 """A list of supported descriptors"""
 fps = ["daylight", "graph"]
 """A list of supported fingerprint types"""
+screenfps = ["daylight", "graph"]
+"""The fingerprint types that can be used by substructsearch()"""
+_hybridisations = {'SP1': 1, 'SP2': 2, 'SP3': 3, 'SP3D1': 5, 'SP3D2': 6}
+_fingerprinters = {"daylight": cdk.fingerprint.Fingerprinter,
+                   "graph": cdk.fingerprint.GraphOnlyFingerprinter}
 _formats = {'smi': "SMILES" , 'sdf': "MDL SDF",
             'mol2': "MOL2", 'mol': "MDL MOL"}
 _informats = {'sdf': cdk.io.MDLV2000Reader, 'mol': cdk.io.MDLV2000Reader}
@@ -80,7 +104,28 @@ _bondtypes = {1: cdk.CDKConstants.BONDORDER_SINGLE,
               3: cdk.CDKConstants.BONDORDER_TRIPLE}
 _revbondtypes = dict([(_y,_x) for (_x,_y) in _bondtypes.iteritems()])
 
-def readfile(format, filename):
+def _atomproperties(atom):
+    """Return the atomic number, formal charge and isotope of a CDK atom.
+
+    Unlike _isofact.configure(), this leaves the atom unchanged, as
+    configure() would replace any mass number with that of the major
+    isotope. The isotope is 0 unless a mass number other than that of the
+    major isotope is set.
+    """
+    symbol = atom.getSymbol()
+    atomicnum = atom.getAtomicNumber()
+    if atomicnum is None:
+        atomicnum = _isofact.getElement(symbol).getAtomicNumber()
+    charge = atom.getFormalCharge()
+    isotope = atom.getMassNumber()
+    major = _isofact.getMajorIsotope(symbol)
+    if major and isotope and \
+           isotope.intValue() == major.getMassNumber().intValue():
+        isotope = None
+    return (atomicnum.intValue(), charge and charge.intValue() or 0,
+            isotope and isotope.intValue() or 0)
+
+def readfile(format, filename, lazy=False):
     """Iterate over the molecules in a file.
 
     Required parameters:
@@ -88,6 +133,12 @@ def readfile(format, filename):
                 input formats
        filename
 
+    Optional parameters:
+       lazy -- if True, return a recordio.LazyMolecule for each record of
+               an SDF or SMILES file. Its title and SD tags are available
+               without parsing the molecule, which is only read when
+               another attribute or method is used (default is False)
+
     You can access the first molecule in a file using the next() method
     of the iterator:
         mol = readfile("smi", "myfile.smi").next()
@@ -103,9 +154,23 @@ def readfile(format, filename):
     ...
     >>> print atomtotal
     43
+
+    SDF and SMILES files compressed with gzip, bzip2 or Zstandard are
+    decompressed in a background thread (see recordio.compressions).
     """
     if not os.path.isfile(filename):
         raise IOError, "No such file: '%s'" % filename
+    if lazy:
+        if format not in recordio.recordformats:
+            raise ValueError, "%s is not a recognised format for lazy reading" % format
+        records = recordio.iterrecords(format, filename)
+        return (recordio.LazyMolecule(format, record, _readrecord)
+                for record in records)
+    if recordio.getcompression(filename):
+        if format not in recordio.recordformats:
+            raise ValueError, "%s is not a recognised format for compressed files" % format
+        records = recordio.iterrecords(format, filename)
+        return (_readrecord(format, record) for record in records)
     builder = cdk.DefaultChemObjectBuilder.getInstance()
     if format=="sdf":
         return (Molecule(mol) for mol in cdk.io.iterator.IteratingMDLReader(
@@ -154,6 +219,167 @@ def readstring(format, string):
     else:
         raise ValueError,"%s is not a recognised CDK format" % format
 
+def calcfps(molecules, fptype="daylight"):
+    """Calculate the fingerprints of a set of molecules.
+
+    Required parameters:
+       molecules -- an iterable of Molecules, such as readfile()
+
+    Optional parameters:
+       fptype -- the fingerprint type (default is "daylight"). See the
+                 fps variable for a list of of available fingerprint
+                 types.
+
+    Returns an fpsearch.FingerprintMatrix, which holds the fingerprints
+    packed into a NumPy array of 64-bit words with one row per molecule.
+    NumPy is required.
+    """
+    fptype = fptype.lower()
+    try:
+        fingerprinter = _fingerprinters[fptype]()
+    except KeyError:
+        raise ValueError, "%s is not a recognised CDK Fingerprint type" % fptype
+    nwords = (fingerprinter.getSize() + 63) // 64
+    rows = []
+    for molecule in molecules:
+        bitset = fingerprinter.getFingerprint(molecule.Molecule)
+        # Java longs are signed, and trailing zero words are left out
+        longs = [x & 0xFFFFFFFFFFFFFFFF for x in bitset.toLongArray()]
+        rows.append(longs + [0] * (nwords - len(longs)))
+    return fpsearch.FingerprintMatrix(fpsearch.packwords(rows, 64),
+                                      fingerprinter.getSize(), fptype)
+
+def substructsearch(query, fps, molecules):
+    """Find the molecules that contain a substructure.
+
+    Required parameters:
+       query -- a SMILES string for the substructure
+       fps -- the fingerprints of the molecules as a FingerprintMatrix,
+              such as calcfps(molecules, fptype) or the fps of a
+              FingerprintDB, where fptype is one of the screenfps
+       molecules -- anything that can be indexed to give the Molecules,
+                    such as a list or a MoleculeFile
+
+    Returns a list of the indices of the molecules that match.
+
+    The fingerprint of the query is compared against fps first (see
+    fpsearch.screen()). Only the molecules whose fingerprints have all
+    of the query's bits set are read and matched against the query as a
+    SMARTS pattern, so a MoleculeFile does not parse the others.
+    """
+    if fps.fptype not in screenfps:
+        raise ValueError, "%s fingerprints cannot be used to screen substructures" % fps.fptype
+    queryfp = calcfps([readstring("smi", query)], fps.fptype)
+    smarts = Smarts(query)
+    return [i for i in fpsearch.screen(queryfp, fps).tolist()
+            if smarts.match(molecules[i])]
+
+def _calcdesc(Molecule, descriptors):
+    """Calculate descriptor values for a CDK Molecule.
+
+    Required parameters:
+       Molecule -- a CDK Molecule
+       descriptors -- a list of (name, descriptor) pairs
+
+    Descriptors that return an array give one value for each element,
+    named 'descname.0', 'descname.1' and so on.
+    """
+    ans = {}
+    for descname, desc in descriptors:
+        try:
+            value = desc.calculate(Molecule).getValue()
+            if hasattr(value, "get"): # Instead of array
+                for i in range(value.length()):
+                    ans[descname + ".%d" % i] = value.get(i)
+            elif hasattr(value, "doubleValue"):
+                ans[descname] = value.doubleValue()
+            else:
+                ans[descname] = value.intValue()
+        except JavaException, ex:
+            # Can happen if molecule has no 3D coordinates
+            pass
+    return ans
+
+def _getdescriptors(descnames):
+    if not descnames:
+        descnames = descs
+    descriptors = []
+    for descname in descnames:
+        try:
+            descriptors.append((descname, _descdict[descname]))
+        except KeyError:
+            raise ValueError, "%s is not a recognised CDK descriptor type" % descname
+    return descriptors
+
+def _plandescs(descriptors):
+    """Plan the calculation of descriptors, sharing the atom typing.
+
+    Descriptors with a checkAromaticity parameter perceive the atom types
+    and aromaticity of each molecule themselves. They are replaced by
+    copies that rely on _prepare() having done this once per molecule.
+    """
+    planned = []
+    for descname, desc in descriptors:
+        paramnames = list(desc.getParameterNames() or [])
+        if "checkAromaticity" in paramnames:
+            try:
+                copy = desc.getClass().newInstance()
+                params = copy.getParameters()
+                params[paramnames.index("checkAromaticity")] = java.lang.Boolean(False)
+                copy.setParameters(params)
+                desc = copy
+            except JavaException, ex:
+                pass # Leave it to check for itself
+        planned.append((descname, desc))
+    return planned
+
+def _prepare(Molecule):
+    """Perceive the atom types and aromaticity of a CDK Molecule"""
+    manipulator = cdk.tools.manipulator.AtomContainerManipulator
+    manipulator.percieveAtomTypesAndConfigureAtoms(Molecule)
+    cdk.aromaticity.CDKHueckelAromaticityDetector.detectAromaticity(Molecule)
+
+def _calcplanned(Molecule, descriptors, planned):
+    """Calculate descriptor values using a plan from _plandescs()
+
+    The atom types are perceived on a copy, so that the CDK Molecule (and
+    the values cached for it) are unchanged.
+    """
+    Molecule = Molecule.clone()
+    try:
+        _prepare(Molecule)
+    except JavaException, ex:
+        return _calcdesc(Molecule, descriptors) # Each checks for itself
+    return _calcdesc(Molecule, planned)
+
+def calcdescs(molecules, descnames=[]):
+    """Calculate descriptor values for a set of molecules.
+
+    Required parameters:
+       molecules -- an iterable of Molecules, such as readfile()
+
+    Optional parameters:
+       descnames -- a list of names of descriptors (default is all of
+                    those in the descs variable)
+
+    Returns a dictionary with a NumPy float64 array for each descriptor,
+    holding its values in the same order as the molecules. Values that
+    cannot be calculated are NaN. Descriptors that return an array
+    give one column for each element, named 'descname.0', 'descname.1'
+    and so on. NumPy is required.
+
+    Unlike the other Cinfony modules, the descriptors are always
+    calculated in this process, as the Java virtual machine cannot be
+    shared with worker processes. The atom types and aromaticity of each
+    molecule are perceived once, on a copy, rather than by each
+    descriptor.
+    """
+    descriptors = _getdescriptors(descnames)
+    planned = _plandescs(descriptors)
+    return desctable.fromdicts(_calcplanned(molecule.Molecule, descriptors,
+                                            planned)
+                               for molecule in molecules)
+
 class Outputfile(object):
     """Represent a file to which *output* is to be sent.
    
@@ -165,6 +391,9 @@ class Outputfile(object):
     Optional parameters:
        overwite -- if the output file already exists, should it
                    be overwritten? (default is False)
+
+    If the filename ends in one of the extensions in recordio.compressions,
+    the output is compressed in a background thread.
                    
     Methods:
        write(molecule)
@@ -177,11 +406,17 @@ class Outputfile(object):
             raise IOError, "%s already exists. Use 'overwrite=True' to overwrite it." % self.filename
         if not format in outformats:
             raise ValueError,"%s is not a recognised CDK format" % format
+        self._compressed = recordio.getcompression(self.filename) is not None
+        if self._compressed:
+            if format not in recordio.recordformats:
+                raise ValueError, "%s is not a recognised format for compressed files" % format
+            self._outputfile = recordio.openoutput(self.filename)
         if self.format == "smi":
             self._sg = cdk.smiles.SmilesGenerator()
             self._sg.setUseAromaticityFlag(True)
-            self._outputfile = open(self.filename, "w")
-        else:
+            if not self._compressed:
+                self._outputfile = open(self.filename, "w")
+        elif not self._compressed:
             self._writer = java.io.FileWriter(java.io.File(self.filename))
             self._molwriter = _outformats[self.format](self._writer)
         self.total = 0 # The total number of molecules written to the file
@@ -196,6 +431,8 @@ class Outputfile(object):
             raise IOError, "Outputfile instance is closed."
         if self.format == "smi":
             self._outputfile.write("%s\n" % self._sg.createSMILES(molecule.Molecule))
+        elif self._compressed:
+            self._outputfile.write(molecule.write(self.format))
         else:
             self._molwriter.write(molecule.Molecule)
         self.total += 1
@@ -203,13 +440,171 @@ class Outputfile(object):
     def close(self):
         """Close the Outputfile to further writing."""
         self.filename = None
-        if self.format == "smi":
+        if self.format == "smi" or self._compressed:
             self._outputfile.close()
         else:
             self._molwriter.close()
             self._writer.close()
 
     
+def _readrecord(format, record):
+    builder = cdk.DefaultChemObjectBuilder.getInstance()
+    if format == "sdf":
+        reader = cdk.io.iterator.IteratingMDLReader(
+            java.io.StringReader(record), builder)
+    else:
+        reader = cdk.io.iterator.IteratingSmilesReader(
+            java.io.StringReader(record), builder)
+    try:
+        if reader.hasNext():
+            return Molecule(reader.next())
+    except JavaException, ex:
+        pass
+    raise IOError, "Failed to read the record '%s'" % (
+        recordio.readtitle(format, record))
+
+_filterer = None # Set by _initfilter(), once per worker process
+
+def _initfilter(patterns, mode):
+    global _filterer
+    _filterer = (SmartsLibrary([(x, x) for x in patterns]), mode)
+
+def _filterchunk(args):
+    format, records = args
+    library, mode = _filterer
+    molecules = []
+    for record in records:
+        try:
+            molecules.append(_readrecord(format, record))
+        except IOError:
+            raise ValueError, "Cannot read the record '%s'" % (
+                recordio.readtitle(format, record))
+    return [record for record, keep in
+            zip(records, library.select(molecules, mode)) if keep]
+
+def filterfile(format, infile, outfile, patterns, mode="any",
+               overwrite=False):
+    """Write the molecules of a file that pass a filter on SMARTS patterns.
+
+    Required parameters:
+       format - "sdf" or "smi" (see recordio.recordformats)
+       infile, outfile -- the names of the input and output files
+       patterns -- a list of SMARTS patterns
+
+    Optional parameters:
+       mode -- "any" keeps the molecules that match at least one of the
+               patterns, "all" those that match every pattern and "none"
+               those that match none of them (default is "any")
+       overwrite -- if the output file already exists, should it be
+                    overwritten? (default is False)
+
+    Returns the number of molecules written.
+
+    Unlike the other Cinfony modules, the patterns are always matched in
+    this process, as the Java virtual machine cannot be shared with worker
+    processes. The text of the records that are kept is written as it is,
+    in the same order as in the input file (see recordio.writerecords()).
+    A ValueError that gives the title of the record is raised if a record
+    cannot be read.
+    """
+    library = SmartsLibrary([(x, x) for x in patterns]) # Check the patterns
+    records = smartslib.filterrecords(_filterchunk, _initfilter, format,
+                                      infile, library.names, mode,
+                                      nprocs=1)
+    return recordio.writerecords(format, records, outfile, overwrite)
+
+class MoleculeFile(object):
+    """Random access to the molecules in a file.
+
+    Required parameters:
+       format - "sdf" or "smi" (see recordio.recordformats)
+       filename
+
+    Optional parameters:
+       save -- store the index of the records next to the file, so that
+               it does not need to be built again (default is True)
+
+    A MoleculeFile supports len(), indexing and slicing. Molecule i is read
+    directly from its position in the file, without parsing the molecules
+    before it. See recordio.RecordIndex for details of the index.
+
+    Example:
+    >>> molfile = MoleculeFile("sdf", "head.sdf")
+    >>> len(molfile)
+    2
+    >>> print molfile[-1].title
+    NSC 2
+    """
+    def __init__(self, format, filename, save=True):
+        if format not in recordio.recordformats:
+            raise ValueError, "%s is not a recognised format for a MoleculeFile" % format
+        self.format = format
+        self.filename = filename
+        self.index = recordio.RecordIndex(format, filename, save)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [_readrecord(self.format, x) for x in self.index[i]]
+        return _readrecord(self.format, self.index[i])
+
+    def close(self):
+        """Close the underlying file."""
+        self.index.close()
+
+def _fromgraph(graph):
+    """Return a CDK Molecule built from a MolGraph.
+
+    The CDK has no stereo elements, so only the coordinates carry the
+    stereochemistry.
+    """
+    mol = cdk.Molecule()
+    atoms = []
+    for atomicnum, charge, isotope, hcount, aromatic in graph.atoms:
+        atom = cdk.Atom(_isofact.getElement(atomicnum).getSymbol())
+        atom.setAtomicNumber(java.lang.Integer(atomicnum))
+        atom.setFormalCharge(java.lang.Integer(charge))
+        if isotope:
+            atom.setMassNumber(java.lang.Integer(isotope))
+        atom.setHydrogenCount(java.lang.Integer(hcount))
+        if aromatic:
+            atom.setFlag(cdk.CDKConstants.ISAROMATIC, True)
+        mol.addAtom(atom)
+        atoms.append(atom)
+    for begin, end, order, aromatic in graph.bonds:
+        bond = cdk.Bond(atoms[begin], atoms[end], _bondtypes[order])
+        if aromatic:
+            bond.setFlag(cdk.CDKConstants.ISAROMATIC, True)
+        mol.addBond(bond)
+    if graph.coords:
+        for atom, (x, y, z) in zip(atoms, graph.coords):
+            if graph.dim == 3:
+                atom.setPoint3d(javax.vecmath.Point3d(x, y, z))
+            else:
+                atom.setPoint2d(javax.vecmath.Point2d(x, y))
+    mol.setProperty(cdk.CDKConstants.TITLE, graph.title)
+    return mol
+
+def fromgraph(molecule):
+    """Copy a molecule of another Cinfony module through a MolGraph.
+
+    Required parameters:
+       molecule -- a Molecule of any Cinfony module with a _graph
+                   attribute (pybel, rdk or cdk), or a MolGraph
+
+    Unlike the Molecule constructor, which writes and reads a SMILES
+    string or MOL block, this keeps the order of the atoms, the hydrogen
+    counts, the exact coordinates and the title (see the molgraph
+    module). The CDK has no stereo elements, so only the coordinates
+    carry the stereochemistry. It is slower, as each atom and bond is
+    copied by a separate call.
+    """
+    if not isinstance(molecule, molgraph.MolGraph):
+        molecule = molecule._graph
+    return Molecule(_fromgraph(molecule))
+
 class Molecule(object):
     """Represent a cdkjpype Molecule.
 
@@ -217,14 +612,31 @@ class Molecule(object):
        Molecule -- a CDK Molecule or any type of cinfony Molecule
 
     Attributes:
-       atoms, data, exactmass, formula, molwt, title
+       atoms, coords, data, exactmass, formula, molwt, title
     
     Methods:
-       addh(), calcfp(), calcdesc(), draw(), removeh(), write()
+       addh(), atomtable(), bondtable(), calcfp(), calcdesc(), draw(),
+       removeh(), setcoords(), write()
+
+    The values of atoms, exactmass, formula and molwt, and the results of
+    calcfp() and calcdesc(), are cached. The cache is cleared by addh(),
+    removeh(), draw(update=True) and by setting the title. If you change
+    the CDK Molecule directly, create a new Molecule from it.
+
+    Molecules, Atoms and MoleculeData use __slots__ to save memory when
+    many of them are held at once, so other attributes cannot be added
+    to them. The data attribute returns the same MoleculeData each time.
+      
+    A Molecule of another Cinfony module is copied by writing and reading
+    a SMILES string or MOL block. This is the fastest way to convert, but
+    it is lossy: the atoms may be reordered, coordinates are rounded or
+    lost and the title may not survive. fromgraph() is the lossless
+    way to convert (see its docstring).
       
     The underlying CDK Molecule can be accessed using the attribute:
        Molecule
     """
+    __slots__ = ("Molecule", "_cache", "_data")
     _cinfony = True
 
     def __init__(self, Molecule):
@@ -238,33 +650,99 @@ class Molecule(object):
             Molecule = mol.Molecule
             
         self.Molecule = Molecule
-        
+        self._cache = None # Created when first needed
+        self._data = None
+
+    def _cached(self, key, function, *args):
+        """Return the cached value for key, calculating it if necessary"""
+        if self._cache is None:
+            self._cache = {}
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = function(*args)
+            return value
+
+    def _invalidate(self):
+        """Clear the cache, as the molecule has changed"""
+        self._cache = None
+
+    def _getatoms(self): return [Atom(self.Molecule.getAtom(i)) for i in range(self.Molecule.getAtomCount())]
     @property
-    def atoms(self): return [Atom(self.Molecule.getAtom(i)) for i in range(self.Molecule.getAtomCount())]
+    def atoms(self): return list(self._cached("atoms", self._getatoms))
+    def _getcoords(self):
+        _checknumpy()
+        coords = []
+        for i in range(self.Molecule.getAtomCount()):
+            atom = self.Molecule.getAtom(i)
+            point = atom.point3d
+            if point:
+                coords.append((point.x, point.y, point.z))
+            elif atom.point2d:
+                coords.append((atom.point2d.x, atom.point2d.y, 0.))
+            else:
+                coords.append((0., 0., 0.))
+        return numpy.array(coords, dtype=numpy.float64).reshape(-1, 3)
+    def _setcoords(self, coords): self.setcoords(coords)
+    coords = property(_getcoords, _setcoords)
     @property
-    def data(self): return MoleculeData(self.Molecule)
+    def data(self):
+        if self._data is None or self._data._mol is not self.Molecule:
+            self._data = MoleculeData(self.Molecule)
+        return self._data
+    def _getmf(self):
+        # The molecular formula includes the implicit hydrogens, so
+        # the masses do not need a copy of the molecule with explicit ones
+        manip = cdk.tools.manipulator.MolecularFormulaManipulator
+        return self._cached("mf", manip.getMolecularFormula, self.Molecule)
     @property
     def formula(self):
         manip = cdk.tools.manipulator.MolecularFormulaManipulator
-        mf = manip.getMolecularFormula(self.Molecule)
-        return manip.getString(mf) # GetHillString
+        return self._cached("formula", manip.getString, self._getmf()) # GetHillString
     @property
     def exactmass(self):
-        clone = Molecule(self.Molecule.clone())
-        clone.addh()
         manip = cdk.tools.manipulator.MolecularFormulaManipulator
-        mf = manip.getMolecularFormula(clone.Molecule)
-        return manip.getMajorIsotopeMass(mf)
+        return self._cached("exactmass", manip.getMajorIsotopeMass,
+                            self._getmf())
     @property
     def molwt(self):
-        clone = Molecule(self.Molecule.clone())
-        clone.addh()
-        atommanip = cdk.tools.manipulator.AtomContainerManipulator
-        return atommanip.getNaturalExactMass(clone.Molecule)
+        manip = cdk.tools.manipulator.MolecularFormulaManipulator
+        return self._cached("molwt", manip.getNaturalExactMass, self._getmf())
     def _gettitle(self): return self.Molecule.getProperty(cdk.CDKConstants.TITLE)
-    def _settitle(self, val): self.Molecule.setProperty(cdk.CDKConstants.TITLE, val)
+    def _settitle(self, val):
+        self.Molecule.setProperty(cdk.CDKConstants.TITLE, val)
+        self._invalidate()
     title = property(_gettitle, _settitle)
     @property
+    def _graph(self):
+        mol = self.Molecule
+        atoms = []
+        for i in range(mol.getAtomCount()):
+            atom = mol.getAtom(i)
+            hcount = atom.getHydrogenCount()
+            atoms.append(_atomproperties(atom) +
+                         (hcount and hcount.intValue() or 0,
+                          bool(atom.getFlag(cdk.CDKConstants.ISAROMATIC))))
+        bonds = []
+        for i in range(mol.getBondCount()):
+            bond = mol.getBond(i)
+            begin, end = [mol.getAtomNumber(x)
+                          for x in bond.atoms().iterator()]
+            bonds.append((begin, end, _revbondtypes.get(bond.getOrder(), 1),
+                          bool(bond.getFlag(cdk.CDKConstants.ISAROMATIC))))
+        coords, dim = None, 0
+        gt = cdk.geometry.GeometryTools
+        if gt.has3DCoordinates(mol):
+            points = [mol.getAtom(i).point3d for i in range(len(atoms))]
+            coords = [(p.x, p.y, p.z) for p in points]
+            dim = 3
+        elif gt.has2DCoordinates(mol):
+            points = [mol.getAtom(i).point2d for i in range(len(atoms))]
+            coords = [(p.x, p.y, 0.) for p in points]
+            dim = 2
+        return molgraph.MolGraph(atoms, bonds, coords, dim,
+                                 title=self.title or "")
+    @property
     def _exchange(self):
         gt = cdk.geometry.GeometryTools
         if gt.has2DCoordinates(self.Molecule) or gt.has3DCoordinates(self.Molecule):
@@ -284,15 +762,99 @@ class Molecule(object):
     def __str__(self):
         return self.write()
 
+    def setcoords(self, coords):
+        """Set the 3D coordinates of all of the atoms.
+
+        Required parameters:
+           coords -- an (n x 3) array or list, in the same order as the
+                     atoms attribute
+
+        The coords attribute returns the current coordinates as an
+        (n x 3) NumPy array of type float64 (using the 2D coordinates if
+        there are no 3D ones), and can also be assigned to. The CDK has
+        no call to set all of the coordinates at once, but no Atom
+        objects are created. NumPy is required.
+        """
+        _checknumpy()
+        coords = numpy.asarray(coords, dtype=numpy.float64)
+        n = self.Molecule.getAtomCount()
+        if coords.shape != (n, 3):
+            raise ValueError, ("Expected coordinates of shape (%d, 3) but got %s"
+                               % (n, coords.shape))
+        for i, (x, y, z) in enumerate(coords.tolist()):
+            self.Molecule.getAtom(i).setPoint3d(javax.vecmath.Point3d(x, y, z))
+        self._invalidate()
+
+    def atomtable(self):
+        """Return the properties of the atoms as NumPy arrays.
+
+        Returns a dictionary with the keys atomicnum, formalcharge,
+        isotope, hyb, partialcharge and coords, each with one row per atom
+        in the same order as the atoms attribute (see
+        desctable.atomcolumns()). No Atom objects are created. NumPy is
+        required.
+
+        The hybridisation uses the same codes as Open Babel (1 for sp,
+        2 for sp2, 3 for sp3, 5 for sp3d, 6 for sp3d2 and 0 otherwise).
+        The isotope is 0 unless a mass number other than that of the
+        major isotope is set, as for the other Cinfony modules. The atoms
+        are not changed. The partial charges are those stored on the
+        atoms, or NaN if they have not been calculated. 2D coordinates
+        are used if there are no 3D ones, and zeros if there are neither.
+        """
+        rows = []
+        for i in range(self.Molecule.getAtomCount()):
+            atom = self.Molecule.getAtom(i)
+            hyb = atom.getHybridization()
+            charge = atom.getCharge()
+            if charge is None:
+                charge = float("nan")
+            else:
+                charge = charge.doubleValue()
+            coords = atom.point3d
+            if coords:
+                coords = (coords.x, coords.y, coords.z)
+            elif atom.point2d:
+                coords = (atom.point2d.x, atom.point2d.y, 0.)
+            else:
+                coords = (0., 0., 0.)
+            rows.append(_atomproperties(atom) +
+                        (_hybridisations.get(hyb and hyb.name(), 0),
+                         charge) + coords)
+        return desctable.atomcolumns(rows)
+
+    def bondtable(self):
+        """Return the bonds as NumPy arrays.
+
+        Returns a dictionary with the keys begin and end (the indices of
+        the atoms, starting from 0, in the same order as the atoms
+        attribute) and order (1.5 for aromatic bonds), with one row per
+        bond. The adjacency of the atoms is included in compressed sparse
+        row format (see desctable.bondcolumns()). NumPy is required.
+        """
+        rows = []
+        for i in range(self.Molecule.getBondCount()):
+            bond = self.Molecule.getBond(i)
+            atoms = [self.Molecule.getAtomNumber(x)
+                     for x in bond.atoms().iterator()]
+            if bond.getFlag(cdk.CDKConstants.ISAROMATIC):
+                order = 1.5
+            else:
+                order = _revbondtypes.get(bond.getOrder(), 0)
+            rows.append((atoms[0], atoms[1], order))
+        return desctable.bondcolumns(self.Molecule.getAtomCount(), rows)
+
     def addh(self):
         """Add hydrogens."""
         atommanip = cdk.tools.manipulator.AtomContainerManipulator
         atommanip.convertImplicitToExplicitHydrogens(self.Molecule)
+        self._invalidate()
 
     def removeh(self):
         """Remove hydrogens."""        
         atommanip = cdk.tools.manipulator.AtomContainerManipulator
         self.Molecule = atommanip.removeHydrogens(self.Molecule)
+        self._invalidate()
 
     def write(self, format="smi", filename=None, overwrite=False):
         """Write the molecule to a file or return a string.
@@ -349,12 +911,12 @@ class Molecule(object):
                      types.
         """        
         fp = fp.lower()
-        if fp == "graph":
-            fingerprinter = cdk.fingerprint.GraphOnlyFingerprinter()
-        elif fp == "daylight":
-            fingerprinter = cdk.fingerprint.Fingerprinter()
-        else:
+        if fp not in _fingerprinters:
             raise ValueError, "%s is not a recognised CDK Fingerprint type" % fp
+        return self._cached(("fp", fp), self._calcfp, fp)
+
+    def _calcfp(self, fp):
+        fingerprinter = _fingerprinters[fp]()
         return Fingerprint(fingerprinter.getFingerprint(self.Molecule))
 
     def calcdesc(self, descnames=[]):
@@ -367,27 +929,11 @@ class Molecule(object):
         calculated. See the descs variable for a list of available
         descriptors.
         """
-        if not descnames:
-            descnames = descs
         ans = {}
-        for descname in descnames:
-            try:
-                desc = _descdict[descname]
-            except KeyError:
-                raise ValueError, "%s is not a recognised CDK descriptor type" % descname
-            try:
-                value = desc.calculate(self.Molecule).getValue()
-                if hasattr(value, "get"): # Instead of array
-                    for i in range(value.length()):
-                        ans[descname + ".%d" % i] = value.get(i)
-                elif hasattr(value, "doubleValue"):
-                    ans[descname] = value.doubleValue()
-                else:
-                    ans[descname] = value.intValue()
-            except JavaException, ex:
-                # Can happen if molecule has no 3D coordinates
-                pass
-        return ans    
+        for descname, desc in _getdescriptors(descnames):
+            ans.update(self._cached(("desc", descname), _calcdesc,
+                                    self.Molecule, [(descname, desc)]))
+        return ans
 
     def draw(self, show=True, filename=None, update=False,
              usecoords=False):
@@ -418,6 +964,7 @@ class Molecule(object):
                     coords = newatom.Atom.getPoint2d()
                     atom.Atom.setPoint3d(javax.vecmath.Point3d(
                                          coords.x, coords.y, 0.0))    
+                self._invalidate()
         else:
             newmol = self
             
@@ -552,6 +1099,7 @@ class Atom(object):
     The original CDK Atom can be accessed using the attribute:
        Atom
     """
+    __slots__ = ("Atom",)
 
     def __init__(self, Atom):
         self.Atom = Atom
@@ -585,26 +1133,113 @@ class Smarts(object):
        smartspattern
     
     Methods:
-       findall()
+       findall(molecule, maxmatches=None), match(molecule)
     
     Example:
     >>> mol = readstring("smi","CCN(CC)CC") # triethylamine
     >>> smarts = Smarts("[#6][#6]") # Matches an ethyl group
     >>> print smarts.findall(mol) 
     [(1, 2), (4, 5), (6, 7)]
+    >>> smarts.match(mol)
+    True
     """
     def __init__(self, smartspattern):
         """Initialise with a SMARTS pattern."""
         self.smarts = cdk.smiles.smarts.SMARTSQueryTool(smartspattern)
         
-    def findall(self, molecule):
+    def findall(self, molecule, maxmatches=None):
         """Find all matches of the SMARTS pattern to a particular molecule.
         
         Required parameters:
            molecule
+
+        Optional parameters:
+           maxmatches -- the maximum number of matches to return (default
+                         is None, which returns all of them)
+
+        The CDK's SMARTSQueryTool always finds every match, so maxmatches
+        only limits the number that are returned.
         """
         match = self.smarts.matches(molecule.Molecule)
-        return list(self.smarts.getUniqueMatchingAtoms())
+        return list(self.smarts.getUniqueMatchingAtoms())[:maxmatches]
+
+    def match(self, molecule):
+        """Does a SMARTS pattern match a particular molecule?
+
+        Required parameters:
+           molecule
+
+        This skips making the matches unique, which findall() needs.
+        """
+        return bool(self.smarts.matches(molecule.Molecule))
+
+class SmartsLibrary(object):
+    """A set of named SMARTS patterns that are matched together
+
+    Required parameters:
+       patterns -- a list of (name, SMARTS pattern) pairs, or a dictionary
+                   (in which case the patterns are sorted by name)
+
+    Attributes:
+       names -- the names of the patterns, in the order of the columns
+                returned by match()
+       smarts -- the compiled Smarts, in the same order
+
+    Methods:
+       match(molecules), select(molecules, mode="any")
+
+    Each pattern is compiled once. Before a pattern is matched against a
+    molecule, its element and ring requirements are checked against
+    counts made once for the molecule (see smartslib), and most patterns
+    are never run. NumPy is required.
+
+    Example:
+    >>> library = SmartsLibrary([("amine", "N"), ("benzene", "c1ccccc1")])
+    >>> mols = [readstring("smi", "Nc1ccccc1"), readstring("smi", "CCN")]
+    >>> library.match(mols).tolist()
+    [[True, True], [True, False]]
+    """
+    def __init__(self, patterns):
+        if hasattr(patterns, "items"):
+            patterns = sorted(patterns.items())
+        self.names = [name for name, pattern in patterns]
+        self.smarts = [Smarts(pattern) for name, pattern in patterns]
+        self._screen = smartslib.Screen([pattern for name, pattern in patterns])
+
+    def _counts(self, molecule):
+        mol = molecule.Molecule
+        components = cdk.graph.ConnectivityChecker.partitionIntoMolecules(mol)
+        rings = (mol.getBondCount() - mol.getAtomCount() +
+                 components.getAtomContainerCount())
+        return smartslib.formulacounts(molecule.formula), rings
+
+    def _matches(self, i, molecule):
+        return self.smarts[i].match(molecule)
+
+    def match(self, molecules):
+        """Find which patterns match each molecule.
+
+        Required parameters:
+           molecules -- an iterable of Molecules
+
+        Returns a boolean NumPy array with one row per molecule and one
+        column per pattern.
+        """
+        return self._screen.hitmatrix(molecules, self._counts, self._matches)
+
+    def select(self, molecules, mode="any"):
+        """Find which molecules pass a filter on the patterns.
+
+        Required parameters:
+           molecules -- an iterable of Molecules
+
+        Optional parameters:
+           mode -- "any", "all" or "none" (see smartslib.Screen.select())
+
+        Returns a list of booleans, one per molecule.
+        """
+        return self._screen.select(molecules, self._counts, self._matches,
+                                   mode)
 
 class MoleculeData(object):
     """Store molecule data in a dictionary-type object
@@ -633,6 +1268,8 @@ class MoleculeData(object):
     >>> print len(data), data.keys(), data.has_key("NSC")
     1 ['Comment'] False
     """
+    __slots__ = ("_mol",)
+
     def __init__(self, Molecule):
         self._mol = Molecule
     def _data(self):
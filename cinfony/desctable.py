@@ -0,0 +1,239 @@
+"""
+desctable - Toolkit-independent tables of descriptor values
+
+The calcdescs() function of a Cinfony module calculates descriptors for
+many molecules at once. The values are returned as a table with one
+column per descriptor, rather than as one dictionary per molecule. Each
+column is a NumPy array of type float64, with NaN where a descriptor could
+not be calculated.
+
+Similarly, the atomtable() and bondtable() methods of a Molecule return
+the properties of its atoms and bonds as columns, built by atomcolumns()
+and bondcolumns(). graphbatch() combines the tables of many molecules.
+
+NumPy is required.
+"""
+
+import itertools
+
+import recordio
+
+try:
+    import numpy
+except ImportError: #pragma: no cover
+    numpy = None
+
+def _checknumpy():
+    if not numpy:
+        errormessage = ("NumPy not found, but is required for descriptor "
+                        "tables. See installation instructions for "
+                        "more information.")
+        raise ImportError(errormessage)
+
+def _tofloat(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+def fromrows(descnames, rows):
+    """Convert rows of descriptor values into columns.
+
+    Required parameters:
+       descnames -- a list of names of descriptors
+       rows -- an iterable of sequences of values, in the same order as
+               descnames
+
+    Returns a dictionary of float64 arrays. Values that are not numbers
+    become NaN.
+
+    >>> table = fromrows(["a", "b"], [(1, 2.5), (3, None)])
+    >>> table["a"]
+    array([1., 3.])
+    >>> table["b"]
+    array([2.5, nan])
+    """
+    _checknumpy()
+    rows = list(rows)
+    try:
+        values = numpy.array(rows, dtype=numpy.float64)
+    except (TypeError, ValueError):
+        values = numpy.array([[_tofloat(x) for x in row] for row in rows],
+                             dtype=numpy.float64)
+    values = values.reshape(len(rows), len(descnames))
+    return dict([(name, values[:, i].copy())
+                 for i, name in enumerate(descnames)])
+
+def fromdicts(dicts):
+    """Convert dictionaries of descriptor values into columns.
+
+    Required parameters:
+       dicts -- an iterable of dictionaries, one per molecule
+
+    Returns a dictionary of float64 arrays, with a column for every name
+    found in any of the dictionaries. Missing values become NaN.
+
+    >>> table = fromdicts([{"a": 1}, {"a": 2, "b": 3}])
+    >>> table["b"]
+    array([nan,  3.])
+    """
+    _checknumpy()
+    dicts = list(dicts)
+    table = {}
+    for i, values in enumerate(dicts):
+        for name, value in values.iteritems():
+            if name not in table:
+                table[name] = numpy.empty(len(dicts), dtype=numpy.float64)
+                table[name].fill(numpy.nan)
+            table[name][i] = _tofloat(value)
+    return table
+
+def atomcolumns(rows):
+    """Convert rows of atom properties into columns.
+
+    Required parameters:
+       rows -- a list of (atomicnum, formalcharge, isotope, hyb,
+               partialcharge, x, y, z) tuples, one per atom
+
+    Returns a dictionary with the keys atomicnum, formalcharge, isotope
+    and hyb (int32 arrays), partialcharge (a float64 array) and coords
+    (an n x 3 float64 array).
+
+    >>> table = atomcolumns([(6, 0, 0, 3, -0.1, 0.0, 1.0, 2.0)])
+    >>> table["atomicnum"], table["coords"]
+    (array([6], dtype=int32), array([[0., 1., 2.]]))
+    """
+    _checknumpy()
+    values = numpy.array(rows, dtype=numpy.float64).reshape(len(rows), 8)
+    table = dict([(name, values[:, i].astype(numpy.int32)) for i, name in
+                  enumerate(["atomicnum", "formalcharge", "isotope", "hyb"])])
+    table["partialcharge"] = values[:, 4].copy()
+    table["coords"] = values[:, 5:].copy()
+    return table
+
+def _adjacency(natoms, begin, end):
+    """Return the neighbours of each atom in compressed sparse row format"""
+    first = numpy.concatenate([begin, end])
+    second = numpy.concatenate([end, begin])
+    order = numpy.lexsort((second, first))
+    counts = numpy.bincount(first, minlength=natoms)
+    indptr = numpy.concatenate([[0], numpy.cumsum(counts)]).astype(numpy.int32)
+    bondindex = numpy.concatenate([numpy.arange(len(begin))] * 2)
+    return indptr, second[order], bondindex[order].astype(numpy.int32)
+
+def bondcolumns(natoms, rows):
+    """Convert rows of bond properties into columns.
+
+    Required parameters:
+       natoms -- the number of atoms
+       rows -- a list of (begin, end, order) tuples, one per bond, where
+               begin and end are atom indices starting from 0
+
+    Returns a dictionary with the keys begin and end (int32 arrays) and
+    order (a float64 array, 1.5 for aromatic bonds). It also holds the
+    adjacency in compressed sparse row format: the neighbours of atom i
+    are indices[indptr[i]:indptr[i+1]], joined by the bonds at the same
+    positions in bondindex.
+
+    >>> table = bondcolumns(3, [(0, 1, 1.0), (1, 2, 2.0)])
+    >>> table["indptr"].tolist(), table["indices"].tolist()
+    ([0, 1, 3, 4], [1, 0, 2, 1])
+    >>> table["bondindex"].tolist()
+    [0, 0, 1, 1]
+    """
+    _checknumpy()
+    values = numpy.array(rows, dtype=numpy.float64).reshape(len(rows), 3)
+    table = {"begin": values[:, 0].astype(numpy.int32),
+             "end": values[:, 1].astype(numpy.int32),
+             "order": values[:, 2].copy()}
+    table["indptr"], table["indices"], table["bondindex"] = _adjacency(
+        natoms, table["begin"], table["end"])
+    return table
+
+_atomkeys = ["atomicnum", "formalcharge", "isotope", "hyb", "partialcharge",
+             "coords"]
+
+def graphbatch(molecules):
+    """Combine the atom and bond tables of several molecules.
+
+    Required parameters:
+       molecules -- an iterable of Molecules with atomtable() and
+                    bondtable() methods
+
+    Returns a dictionary holding the columns of atomtable() and bondtable()
+    for all of the molecules, one after the other. The atom indices in
+    begin, end, indices and indptr refer to the combined atoms, and
+    bondindex to the combined bonds. The atoms of molecule i are
+    atomoffsets[i] to atomoffsets[i+1], and its bonds are bondoffsets[i]
+    to bondoffsets[i+1]. The molecule column gives the molecule of each
+    atom. NumPy is required.
+    """
+    _checknumpy()
+    atomtables, bondtables = [], []
+    for molecule in molecules:
+        atomtables.append(molecule.atomtable())
+        bondtables.append(molecule.bondtable())
+    natoms = numpy.array([len(x["atomicnum"]) for x in atomtables], dtype=int)
+    nbonds = numpy.array([len(x["begin"]) for x in bondtables], dtype=int)
+    atomoffsets = numpy.concatenate([[0], numpy.cumsum(natoms)])
+    bondoffsets = numpy.concatenate([[0], numpy.cumsum(nbonds)])
+    batch = atomcolumns([])
+    for key in _atomkeys:
+        batch[key] = numpy.concatenate([batch[key]] +
+                                       [x[key] for x in atomtables])
+    empty = bondcolumns(0, [])
+    for key in ["begin", "end", "order"]:
+        batch[key] = numpy.concatenate([empty[key]] +
+                                       [x[key] for x in bondtables])
+    shift = numpy.repeat(atomoffsets[:-1], nbonds).astype(numpy.int32)
+    begin = batch["begin"] = batch["begin"] + shift
+    end = batch["end"] = batch["end"] + shift
+    batch["indptr"], batch["indices"], batch["bondindex"] = _adjacency(
+        atomoffsets[-1], begin, end)
+    batch["atomoffsets"] = atomoffsets
+    batch["bondoffsets"] = bondoffsets
+    batch["molecule"] = numpy.repeat(numpy.arange(len(natoms)), natoms)
+    return batch
+
+def _chunks(molecules, chunksize):
+    molecules = iter(molecules)
+    while True:
+        chunk = list(itertools.islice(molecules, chunksize))
+        if not chunk:
+            break
+        yield chunk
+
+def maprows(function, descnames, molecules, nprocs=1, chunksize=1000):
+    """Calculate rows of descriptor values using several processes.
+
+    Required parameters:
+       function -- a function that takes a list of names of descriptors and
+                   a list of Molecules, and returns a list of rows. It must
+                   be defined at the top level of a module.
+       descnames -- a list of names of descriptors
+       molecules -- an iterable of Molecules
+
+    Optional parameters:
+       nprocs -- the number of worker processes. If 1, the rows are
+                 calculated in this process; if None, the number of CPUs
+                 is used (default is 1)
+       chunksize -- the number of molecules sent to a worker at a time
+                    (default is 1000)
+
+    The rows are yielded in the same order as the molecules. The Molecules
+    are pickled to send them to the workers.
+    """
+    chunks = ((descnames, chunk) for chunk in _chunks(molecules, chunksize))
+    if nprocs == 1:
+        results = (function(*args) for args in chunks)
+    else:
+        results = recordio.imapchunks(_maprowschunk,
+                                      ((function, args) for args in chunks),
+                                      nprocs)
+    for rows in results:
+        for row in rows:
+            yield row
+
+def _maprowschunk(args):
+    function, (descnames, molecules) = args
+    return function(descnames, molecules)
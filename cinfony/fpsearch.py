@@ -0,0 +1,725 @@
+"""
+fpsearch - Toolkit-independent storage and searching of fingerprints
+
+The fingerprints calculated by the calcfps() function of a Cinfony module
+are packed into a FingerprintMatrix, a NumPy array of 64-bit words with one
+row per molecule. Bit i of a fingerprint is stored in bit i % 64 of word
+i // 64. Similarity searches work a block of rows at a time, counting bits
+with vectorised operations on the words.
+
+Fingerprints can be stored in a file with makedb() and searched using a
+FingerprintDB, which memory-maps the file instead of reading it. For
+searches with a high similarity threshold, a PopcountIndex only compares
+the query against fingerprints with a suitable number of bits set.
+neighbours() finds all similar pairs using several processes, and
+butina() clusters them. screen() finds the fingerprints that contain all
+of the bits of a query, the first step of a substructure search.
+
+NumPy is required.
+"""
+
+import os
+import math
+import heapq
+import shutil
+import tempfile
+import itertools
+
+try:
+    import numpy
+except ImportError: #pragma: no cover
+    numpy = None
+
+_blockrows = 65536 # The number of fingerprints searched at a time
+_headersize = 512 # The header of a fingerprint database file
+
+if numpy:
+    _m1 = numpy.uint64(0x5555555555555555)
+    _m2 = numpy.uint64(0x3333333333333333)
+    _m4 = numpy.uint64(0x0f0f0f0f0f0f0f0f)
+    _h01 = numpy.uint64(0x0101010101010101)
+
+def _checknumpy():
+    if not numpy:
+        errormessage = ("NumPy not found, but is required for packed "
+                        "fingerprints. See installation instructions for "
+                        "more information.")
+        raise ImportError(errormessage)
+
+def _tolittle(words):
+    """Return the bytes of an array of words in little-endian order"""
+    words = numpy.ascontiguousarray(words, dtype="<u8")
+    return words.view(numpy.uint8).reshape(words.shape[:-1] + (-1,))
+
+def _packbits(bits):
+    """Pack an (n x nbits) array of 0s and 1s into an array of words"""
+    n, nbits = bits.shape
+    nwords = (nbits + 63) // 64
+    padded = numpy.zeros((n, nwords * 64), dtype=numpy.uint8)
+    padded[:, :nbits] = bits
+    # numpy.packbits puts the first bit in the most significant place
+    packed = numpy.packbits(padded.reshape(n, -1, 8)[:, :, ::-1], axis=-1)
+    return packed.reshape(n, -1).view("<u8").astype(numpy.uint64)
+
+def _unpackbits(words):
+    """Unpack an array of words into an array of 0s and 1s"""
+    data = _tolittle(words)
+    bits = numpy.unpackbits(data[..., numpy.newaxis], axis=-1)[..., ::-1]
+    return bits.reshape(words.shape[:-1] + (-1,))
+
+def _popcount(words):
+    """Count the bits set in each row of an array of words"""
+    if hasattr(numpy, "bitwise_count"): # NumPy 2.0
+        counts = numpy.bitwise_count(words)
+    else: # Bit-twiddling in place, to avoid temporary arrays
+        x = words >> numpy.uint64(1)
+        x &= _m1
+        numpy.subtract(words, x, out=x)
+        y = x >> numpy.uint64(2)
+        y &= _m2
+        x &= _m2
+        x += y
+        x += x >> numpy.uint64(4)
+        x &= _m4
+        x *= _h01
+        x >>= numpy.uint64(56)
+        counts = x
+    return counts.sum(axis=-1, dtype=numpy.int64)
+
+def packwords(rows, wordsize=32):
+    """Pack fingerprints stored as lists of integers.
+
+    Required parameters:
+       rows -- a list with one sequence of integers per fingerprint. The
+               least significant bit of the first integer is bit 0.
+
+    Optional parameters:
+       wordsize -- the number of bits in each integer, 32 or 64
+                   (default is 32)
+
+    Returns a 2D NumPy array of type uint64.
+
+    >>> packwords([[1, 2], [3, 0]])
+    array([[8589934593],
+           [         3]], dtype=uint64)
+    """
+    _checknumpy()
+    if wordsize not in [32, 64]:
+        raise ValueError("The wordsize must be 32 or 64")
+    if not len(rows):
+        return numpy.zeros((0, 0), dtype=numpy.uint64)
+    dtype = {32: numpy.uint32, 64: numpy.uint64}[wordsize]
+    words = numpy.array(rows, dtype=dtype)
+    if wordsize == 64:
+        return words
+    if words.shape[1] % 2:
+        words = numpy.hstack([words, numpy.zeros((len(words), 1), dtype)])
+    return (words[:, 0::2].astype(numpy.uint64) |
+            (words[:, 1::2].astype(numpy.uint64) << numpy.uint64(32)))
+
+def packbitstrings(strings):
+    """Pack fingerprints stored as strings of '0's and '1's.
+
+    Required parameters:
+       strings -- a list of equal-length strings, where the first
+                  character is bit 0
+
+    Returns a 2D NumPy array of type uint64.
+
+    >>> packbitstrings(["1001", "0100"])
+    array([[9],
+           [2]], dtype=uint64)
+    """
+    _checknumpy()
+    if not strings:
+        return numpy.zeros((0, 0), dtype=numpy.uint64)
+    nbits = len(strings[0])
+    bits = numpy.frombuffer("".join(strings), dtype=numpy.uint8)
+    bits = (bits == ord("1")).astype(numpy.uint8)
+    return _packbits(bits.reshape(len(strings), nbits))
+
+_bitindex = dict([(1 << i, i) for i in range(64)]) # Single bit -> position
+
+def findbits(words, wordsize=32, offset=0):
+    """Find which bits are set in a sequence of integers.
+
+    Required parameters:
+       words -- a sequence of integers, where bit i of the sequence is
+                stored in bit i % wordsize of word i // wordsize
+
+    Optional parameters:
+       wordsize -- the number of bits in each integer, 8, 16, 32 or 64
+                   (default is 32)
+       offset -- the position of bit 0 (default is 0)
+
+    Returns a list of the positions of the bits that are set. Without
+    NumPy, only the bits that are set are visited.
+
+    >>> findbits([13, 71], 8)
+    [0, 2, 3, 8, 9, 10, 14]
+    >>> findbits([13, 71], 8, offset=1)
+    [1, 3, 4, 9, 10, 11, 15]
+    """
+    if wordsize not in [8, 16, 32, 64]:
+        raise ValueError("The wordsize must be 8, 16, 32 or 64")
+    if not numpy:
+        ans = []
+        start = offset
+        for x in words:
+            while x:
+                lowest = x & -x
+                ans.append(start + _bitindex[lowest])
+                x ^= lowest
+            start += wordsize
+        return ans
+    data = numpy.fromiter(words, dtype="<u%d" % (wordsize // 8))
+    # numpy.unpackbits puts the most significant bit of each byte first
+    bits = numpy.unpackbits(data.view(numpy.uint8)).reshape(-1, 8)[:, ::-1]
+    return (numpy.flatnonzero(bits) + offset).tolist()
+
+def packfingerprints(fingerprints):
+    """Pack the Fingerprints returned by the calcfp() method of a Molecule.
+
+    Required parameters:
+       fingerprints -- a list of Fingerprints from any Cinfony module
+
+    Returns a FingerprintMatrix. It is made from the bits attribute of
+    each Fingerprint, so the toolkit's calcfps() function is faster
+    where it is available.
+    """
+    _checknumpy()
+    bitlists = [fp.bits for fp in fingerprints]
+    nbits = max([max(bits or [-1]) for bits in bitlists] + [-1]) + 1
+    bits = numpy.zeros((len(bitlists), nbits), dtype=numpy.uint8)
+    for i, x in enumerate(bitlists):
+        bits[i, x] = 1
+    return FingerprintMatrix(_packbits(bits), nbits)
+
+class FingerprintMatrix(object):
+    """A set of fingerprints packed into a matrix of 64-bit words.
+
+    Required parameters:
+       words -- a 2D NumPy array with one row per fingerprint (converted
+                to a contiguous array of type uint64)
+       nbits -- the number of bits in each fingerprint
+
+    Optional parameters:
+       fptype -- the fingerprint type (default is None)
+
+    Attributes:
+       words, nbits, fptype
+
+    Methods:
+       bits(i)
+
+    len() gives the number of fingerprints. Indexing with an integer
+    returns the row of words for that fingerprint, while indexing with
+    a slice, a list of indices or a boolean array returns a new
+    FingerprintMatrix.
+
+    >>> fps = FingerprintMatrix(packbitstrings(["0110", "1000"]), 4)
+    >>> len(fps), fps.bits(0)
+    (2, [1, 2])
+    >>> fps[1:].bits(0)
+    [0]
+    """
+    def __init__(self, words, nbits, fptype=None):
+        _checknumpy()
+        self.words = numpy.ascontiguousarray(words, dtype=numpy.uint64)
+        if self.words.ndim != 2:
+            raise ValueError("The words of a FingerprintMatrix must be a 2D array")
+        self.nbits = nbits
+        self.fptype = fptype
+        self._popcounts = None
+
+    def __len__(self):
+        return self.words.shape[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, long, numpy.integer)):
+            return self.words[i]
+        fps = FingerprintMatrix(self.words[i], self.nbits, self.fptype)
+        if self._popcounts is not None:
+            fps._popcounts = self._popcounts[i]
+        return fps
+
+    def bits(self, i):
+        """Return a list of the bits set in fingerprint i."""
+        return numpy.flatnonzero(_unpackbits(self.words[i])).tolist()
+
+    def popcounts(self):
+        """Return an array of the number of bits set in each fingerprint.
+
+        The result is calculated once and then stored.
+        """
+        if self._popcounts is None:
+            self._popcounts = numpy.empty(len(self), dtype=numpy.int64)
+            for start in range(0, len(self), _blockrows):
+                block = self.words[start:start + _blockrows]
+                self._popcounts[start:start + len(block)] = _popcount(block)
+        return self._popcounts
+
+    def __repr__(self):
+        return "<FingerprintMatrix of %d fingerprints of %d bits>" % (
+            len(self), self.nbits)
+
+def _asquery(query, fps):
+    if isinstance(query, FingerprintMatrix):
+        if len(query) != 1:
+            raise ValueError("The query must be a single fingerprint")
+        query = query.words[0]
+    query = numpy.asarray(query, dtype=numpy.uint64)
+    if query.shape != fps.words.shape[1:]:
+        raise ValueError("The query has %d words, but the fingerprints have %d"
+                         % (query.size, fps.words.shape[1]))
+    return query
+
+def _iterscores(query, fps):
+    """Yield the start row and the Tanimoto coefficients of each block"""
+    query = _asquery(query, fps)
+    querycount = _popcount(query)
+    popcounts = fps.popcounts()
+    for start in range(0, len(fps), _blockrows):
+        block = fps.words[start:start + _blockrows]
+        common = _popcount(block & query)
+        union = querycount + popcounts[start:start + len(block)] - common
+        # Two empty fingerprints have a similarity of 0
+        yield start, common / numpy.maximum(union, 1).astype(numpy.float64)
+
+def tanimoto(query, fps):
+    """Calculate the Tanimoto coefficient between a query and a set of
+    fingerprints.
+
+    Required parameters:
+       query -- a single fingerprint, either a row of words such as
+                fps[i] or a FingerprintMatrix of length 1
+       fps -- a FingerprintMatrix
+
+    Returns a NumPy array with one Tanimoto coefficient per fingerprint.
+
+    >>> fps = FingerprintMatrix(packbitstrings(["1100", "1110", "0011"]), 4)
+    >>> tanimoto(fps[0], fps)
+    array([1.        , 0.66666667, 0.        ])
+    """
+    scores = numpy.empty(len(fps))
+    for start, blockscores in _iterscores(query, fps):
+        scores[start:start + len(blockscores)] = blockscores
+    return scores
+
+def search(query, fps, threshold=0.0, k=None):
+    """Find the fingerprints that are most similar to a query.
+
+    Required parameters:
+       query -- a single fingerprint, either a row of words such as
+                fps[i] or a FingerprintMatrix of length 1
+       fps -- a FingerprintMatrix
+
+    Optional parameters:
+       threshold -- only return hits whose Tanimoto coefficient is at
+                    least this value (default is 0.0)
+       k -- only return the k most similar hits (default is None, which
+            returns all of the hits)
+
+    Returns a tuple of two NumPy arrays, the indices of the hits and their
+    Tanimoto coefficients, sorted from most to least similar.
+
+    >>> fps = FingerprintMatrix(packbitstrings(["1100", "1110", "0011"]), 4)
+    >>> indices, scores = search(fps[1], fps, k=2)
+    >>> indices.tolist(), scores.tolist()
+    ([1, 0], [1.0, 0.6666666666666666])
+    """
+    return _search(query, fps, threshold, k)
+
+def screen(query, fps):
+    """Find the fingerprints that have all of the bits of a query set.
+
+    Required parameters:
+       query -- a single fingerprint, either a row of words such as
+                fps[i] or a FingerprintMatrix of length 1
+       fps -- a FingerprintMatrix
+
+    Returns a NumPy array of the indices of the fingerprints, in order.
+    With a suitable fingerprint type, any molecule that contains the
+    query as a substructure is among these (see substructsearch() in
+    the Cinfony modules). Only the words where the query has bits set
+    are compared.
+
+    >>> fps = FingerprintMatrix(packbitstrings(["1100", "1110", "0011"]), 4)
+    >>> screen(fps[0], fps).tolist()
+    [0, 1]
+    """
+    query = _asquery(query, fps)
+    columns = numpy.flatnonzero(query)
+    query = query[columns]
+    allindices = [numpy.zeros(0, dtype=numpy.int64)]
+    for start in range(0, len(fps), _blockrows):
+        block = fps.words[start:start + _blockrows, columns]
+        hits = numpy.flatnonzero(((block & query) == query).all(axis=1))
+        allindices.append(hits + start)
+    return numpy.concatenate(allindices)
+
+def _topk(indices, scores, k):
+    """Keep the k highest scores, breaking ties by the lowest index"""
+    kth = numpy.partition(scores, len(scores) - k)[len(scores) - k]
+    better = numpy.flatnonzero(scores > kth)
+    equal = numpy.flatnonzero(scores == kth)
+    equal = equal[numpy.argsort(indices[equal], kind="mergesort")]
+    keep = numpy.concatenate([better, equal[:k - len(better)]])
+    return indices[keep], scores[keep]
+
+def _search(query, fps, threshold, k, order=None):
+    """Search, where order (if given) maps each row to the index returned"""
+    allindices = [numpy.zeros(0, dtype=numpy.int64)]
+    allscores = [numpy.zeros(0)]
+    for start, scores in _iterscores(query, fps):
+        hits = numpy.flatnonzero(scores >= threshold)
+        indices, scores = hits + start, scores[hits]
+        if order is not None:
+            indices = order[indices]
+        if k is not None and len(hits) > k:
+            indices, scores = _topk(indices, scores, k)
+        allindices.append(indices)
+        allscores.append(scores)
+    indices = numpy.concatenate(allindices)
+    scores = numpy.concatenate(allscores)
+    ranks = numpy.lexsort((indices, -scores))[:k]
+    return indices[ranks], scores[ranks]
+
+def _appendfile(output, inputfile):
+    inputfile.seek(0)
+    while True:
+        data = inputfile.read(1 << 20)
+        if not data:
+            break
+        output.write(data)
+
+def makedb(filename, toolkit, molecules, fptype=None, titlesize=64,
+           overwrite=False):
+    """Calculate the fingerprints of a set of molecules and store them.
+
+    Required parameters:
+       filename
+       toolkit -- the Cinfony module used to calculate the fingerprints,
+                  e.g. pybel
+       molecules -- an iterable of Molecules from that module, such as
+                    toolkit.readfile("sdf", "library.sdf")
+
+    Optional parameters:
+       fptype -- the fingerprint type (default is the default of the
+                 toolkit's calcfps() function)
+       titlesize -- the number of bytes stored for each title; longer
+                    titles are truncated (default is 64)
+       overwrite -- if the output file already exists, should it
+                    be overwritten? (default is False)
+
+    Returns a FingerprintDB for the new file. The file holds the packed
+    fingerprints, their bit counts and the titles of the molecules, each
+    in fixed-width rows. Fingerprint i belongs to molecule i, so hits can
+    be retrieved from the original file using the toolkit's MoleculeFile.
+    """
+    _checknumpy()
+    if not overwrite and os.path.isfile(filename):
+        raise IOError("%s already exists. Use 'overwrite=True' to overwrite it." % filename)
+    args = fptype and (fptype,) or ()
+    tempdir = os.path.dirname(os.path.abspath(filename))
+    counts = tempfile.TemporaryFile(dir=tempdir)
+    titles = tempfile.TemporaryFile(dir=tempdir)
+    output = open(filename, "wb")
+    try:
+        output.write(" " * _headersize)
+        total = 0
+        nbits = nwords = 0
+        molecules = iter(molecules)
+        while True:
+            chunk = list(itertools.islice(molecules, 10000))
+            if not chunk:
+                break
+            fps = toolkit.calcfps(chunk, *args)
+            nbits, fptype = fps.nbits, fps.fptype
+            nwords = fps.words.shape[1]
+            output.write(fps.words.astype("<u8").tostring())
+            counts.write(fps.popcounts().astype("<i8").tostring())
+            for molecule in chunk:
+                title = molecule.title or ""
+                if isinstance(title, unicode):
+                    title = title.encode("utf-8")
+                titles.write(title[:titlesize].ljust(titlesize, "\0"))
+            total += len(chunk)
+        _appendfile(output, counts)
+        _appendfile(output, titles)
+        header = "cinfony-fpdb %s %d %d %d %d\n" % (fptype, nbits, nwords,
+                                                     titlesize, total)
+        output.seek(0)
+        output.write(header.ljust(_headersize))
+    finally:
+        output.close()
+        counts.close()
+        titles.close()
+    return FingerprintDB(filename)
+
+class FingerprintDB(object):
+    """A file of fingerprints, memory-mapped for searching.
+
+    Required parameters:
+       filename -- a file created by makedb()
+
+    Attributes:
+       fps -- a FingerprintMatrix whose words are mapped from the file
+       fptype, titles
+
+    Methods:
+       screen(query), search(query, threshold, k), title(i)
+
+    Opening a FingerprintDB does not read the fingerprints into memory;
+    the operating system pages them in as they are searched. Processes
+    that open the same file share its memory.
+    """
+    def __init__(self, filename):
+        _checknumpy()
+        self.filename = filename
+        header = open(filename, "rb").read(_headersize).split()
+        if len(header) != 6 or header[0] != "cinfony-fpdb":
+            raise IOError("%s is not a fingerprint database" % filename)
+        fptype = header[1]
+        nbits, nwords, titlesize, total = [int(x) for x in header[2:]]
+        self.fptype = fptype != "None" and fptype or None
+        offset = _headersize
+        if total:
+            words = numpy.memmap(filename, dtype="<u8", mode="r",
+                                 offset=offset, shape=(total, nwords))
+            offset += words.nbytes
+            counts = numpy.memmap(filename, dtype="<i8", mode="r",
+                                  offset=offset, shape=(total,))
+            offset += counts.nbytes
+            self.titles = numpy.memmap(filename, dtype="S%d" % titlesize,
+                                       mode="r", offset=offset, shape=(total,))
+        else: # An empty file cannot be mapped
+            words = numpy.zeros((0, nwords), dtype=numpy.uint64)
+            counts = numpy.zeros(0, dtype=numpy.int64)
+            self.titles = numpy.zeros(0, dtype="S%d" % titlesize)
+        self.fps = FingerprintMatrix(words, nbits, self.fptype)
+        self.fps._popcounts = counts
+
+    def __len__(self):
+        return len(self.fps)
+
+    def title(self, i):
+        """Return the title of molecule i."""
+        return self.titles[i].rstrip("\0")
+
+    def search(self, query, threshold=0.0, k=None):
+        """Find the fingerprints that are most similar to a query.
+
+        See the search() function for details.
+        """
+        return search(query, self.fps, threshold, k)
+
+    def screen(self, query):
+        """Find the fingerprints that have all of the bits of a query set.
+
+        See the screen() function for details.
+        """
+        return screen(query, self.fps)
+
+def _bounds(starts, query, threshold):
+    """Return the rows of a sorted matrix that can reach the threshold
+
+    starts[c] is the first row with at least c bits set.
+    """
+    if threshold <= 0:
+        return 0, starts[-1]
+    count = _popcount(query)
+    # Allow for rounding errors in the threshold
+    lowest = int(math.ceil(threshold * count - 1e-9))
+    highest = int(math.floor(count / float(threshold) + 1e-9))
+    highest = min(highest, len(starts) - 2)
+    if lowest > highest:
+        return 0, 0
+    return starts[lowest], starts[highest + 1]
+
+class PopcountIndex(object):
+    """Fingerprints ordered by the number of bits set, for fast searching.
+
+    Required parameters:
+       fps -- a FingerprintMatrix, such as the fps attribute of a
+              FingerprintDB
+
+    Attributes:
+       fps -- a reordered copy of the fingerprints
+       order -- the original index of each of the reordered fingerprints
+
+    Methods:
+       search(query, threshold, k)
+
+    If a query has a bits set, the Tanimoto coefficient with a fingerprint
+    that has b bits set is at most min(a, b) / max(a, b). So only those
+    with t*a <= b <= a/t can reach a threshold t (Swamidass and Baldi,
+    J. Chem. Inf. Model. 2007, 47, 302-317). The index keeps the
+    fingerprints sorted by bit count so that this range can be found
+    directly, and the rest are skipped.
+
+    >>> fps = FingerprintMatrix(packbitstrings(["1100", "1110", "0011"]), 4)
+    >>> index = PopcountIndex(fps)
+    >>> indices, scores = index.search(fps[1], 0.7)
+    >>> indices.tolist()
+    [1]
+    """
+    def __init__(self, fps):
+        counts = fps.popcounts()
+        self.order = numpy.argsort(counts, kind="mergesort")
+        self.fps = fps[self.order]
+        # The fingerprints with b bits set are rows starts[b] to starts[b+1]
+        self._starts = numpy.searchsorted(self.fps.popcounts(),
+                                          numpy.arange(fps.nbits + 2))
+
+    def __len__(self):
+        return len(self.fps)
+
+    def search(self, query, threshold=0.0, k=None):
+        """Find the fingerprints that are most similar to a query.
+
+        See the search() function for details. The returned indices
+        refer to the original FingerprintMatrix.
+        """
+        query = _asquery(query, self.fps)
+        start, end = _bounds(self._starts, query, threshold)
+        return _search(query, self.fps[start:end], threshold, k,
+                       self.order[start:end])
+
+_pairdtype = numpy and numpy.dtype([("i", "<i4"), ("j", "<i4"), ("score", "<f4")])
+
+def _neighbourblock(args):
+    """Find the neighbours of a block of the fingerprints saved by neighbours()"""
+    dirname, nbits, start, end, threshold = args
+    words = numpy.load(os.path.join(dirname, "words.npy"), mmap_mode="r")
+    counts = numpy.load(os.path.join(dirname, "counts.npy"), mmap_mode="r")
+    order = numpy.load(os.path.join(dirname, "order.npy"), mmap_mode="r")
+    starts = numpy.searchsorted(counts, numpy.arange(nbits + 2))
+    fps = FingerprintMatrix(words, nbits)
+    fps._popcounts = counts
+    pairs = []
+    for row in range(start, end):
+        query = words[row]
+        first, last = _bounds(starts, query, threshold)
+        indices, scores = _search(query, fps[first:last], threshold, None,
+                                  order[first:last])
+        mask = indices > order[row] # Each pair once, and not with itself
+        block = numpy.empty(mask.sum(), dtype=_pairdtype)
+        block["i"] = order[row]
+        block["j"] = indices[mask]
+        block["score"] = scores[mask]
+        pairs.append(block)
+    return numpy.concatenate(pairs or [numpy.zeros(0, dtype=_pairdtype)])
+
+def loadneighbours(filename):
+    """Load the pairs written by neighbours().
+
+    Returns a NumPy record array, memory-mapped from the file, with
+    fields i, j and score.
+    """
+    _checknumpy()
+    if os.path.getsize(filename) == 0:
+        return numpy.zeros(0, dtype=_pairdtype)
+    return numpy.memmap(filename, dtype=_pairdtype, mode="r")
+
+def neighbours(fps, threshold, filename, nprocs=None, blocksize=1000,
+               overwrite=False):
+    """Find all pairs of similar fingerprints, using several processes.
+
+    Required parameters:
+       fps -- a FingerprintMatrix
+       threshold -- the lowest Tanimoto coefficient for a pair
+       filename -- where to write the pairs
+
+    Optional parameters:
+       nprocs -- the number of worker processes (default is the number
+                 of CPUs)
+       blocksize -- the number of fingerprints whose neighbours are found
+                    by a worker at a time (default is 1000)
+       overwrite -- if the output file already exists, should it
+                    be overwritten? (default is False)
+
+    Each pair (i, j), where i < j and the Tanimoto coefficient is at
+    least the threshold, is written to the file as two 32-bit integers
+    and a 32-bit float. The file is returned as loaded by loadneighbours().
+    The workers share a memory-mapped copy of the fingerprints, sorted
+    by bit count so that each one is only compared against those that
+    can reach the threshold (see PopcountIndex).
+    """
+    import recordio # Not needed on import, since it needs multiprocessing
+    _checknumpy()
+    if not overwrite and os.path.isfile(filename):
+        raise IOError("%s already exists. Use 'overwrite=True' to overwrite it." % filename)
+    counts = fps.popcounts()
+    order = numpy.argsort(counts, kind="mergesort")
+    dirname = tempfile.mkdtemp()
+    try:
+        numpy.save(os.path.join(dirname, "words.npy"), fps.words[order])
+        numpy.save(os.path.join(dirname, "counts.npy"), counts[order])
+        numpy.save(os.path.join(dirname, "order.npy"), order)
+        tasks = [(dirname, fps.nbits, start, min(start + blocksize, len(fps)),
+                  threshold) for start in range(0, len(fps), blocksize)]
+        output = open(filename, "wb")
+        try:
+            for pairs in recordio.imapchunks(_neighbourblock, tasks, nprocs):
+                output.write(pairs.tostring())
+        finally:
+            output.close()
+    finally:
+        shutil.rmtree(dirname)
+    return loadneighbours(filename)
+
+def butina(pairs, n, reordering=False):
+    """Cluster fingerprints using the neighbours found by neighbours().
+
+    Required parameters:
+       pairs -- the pairs of neighbours, as returned by neighbours()
+       n -- the total number of fingerprints
+
+    Optional parameters:
+       reordering -- after each cluster is made, update the neighbour
+                     counts of the remaining fingerprints, as in the
+                     Taylor-Butina method (default is False)
+
+    The fingerprint with the most neighbours becomes the centroid of a
+    cluster that contains all of its neighbours not already in a cluster
+    (Butina, J. Chem. Inf. Comput. Sci. 1999, 39, 747-750). This is
+    repeated until every fingerprint is in a cluster. Ties are broken by
+    the lowest index.
+
+    Returns a list of clusters, each a list of indices with the centroid
+    first.
+
+    >>> pairs = numpy.array([(0, 1, 0.9), (1, 2, 0.8)], dtype=_pairdtype)
+    >>> butina(pairs, 4)
+    [[1, 0, 2], [3]]
+    """
+    _checknumpy()
+    # Neighbour lists in compressed sparse row format
+    first = numpy.concatenate([pairs["i"], pairs["j"]]).astype(numpy.int64)
+    second = numpy.concatenate([pairs["j"], pairs["i"]]).astype(numpy.int64)
+    sortorder = numpy.lexsort((second, first))
+    adjacent = second[sortorder]
+    counts = numpy.bincount(first, minlength=n)
+    indptr = numpy.concatenate([[0], numpy.cumsum(counts)])
+    assigned = numpy.zeros(n, dtype=bool)
+    clusters = []
+    heap = [(-count, i) for i, count in enumerate(counts.tolist())]
+    heapq.heapify(heap)
+    while heap:
+        count, centroid = heapq.heappop(heap)
+        if assigned[centroid]:
+            continue
+        if reordering and -count != counts[centroid]:
+            heapq.heappush(heap, (-counts[centroid], centroid)) # Stale
+            continue
+        members = adjacent[indptr[centroid]:indptr[centroid + 1]]
+        members = members[~assigned[members]]
+        assigned[centroid] = True
+        assigned[members] = True
+        clusters.append([centroid] + members.tolist())
+        if reordering:
+            for member in [centroid] + members.tolist():
+                numpy.subtract.at(counts,
+                                  adjacent[indptr[member]:indptr[member + 1]], 1)
+    return clusters
@@ -563,6 +563,8 @@ class Atom(object):
         c = self.coords
         return "Atom: %d (%.2f %.2f %.2f)" % (self.atomicnum, c[0], c[1], c[2])
 
+_bitindex = dict([(1 << i, i) for i in range(64)]) # Single bit -> position
+
 def _findbits(fp, bitsperint):
     """Find which bits are set in a list/vector.
 
@@ -574,12 +576,10 @@ def _findbits(fp, bitsperint):
     ans = []
     start = 1
     for x in fp:
-        i = start
-        while x > 0:
-            if x % 2:
-                ans.append(i)
-            x >>= 1
-            i += 1
+        while x: # Visit only the bits that are set
+            lowest = x & -x
+            ans.append(start + _bitindex[lowest])
+            x ^= lowest
         start += bitsperint
     return ans
         
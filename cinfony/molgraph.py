@@ -0,0 +1,94 @@
+"""
+molgraph - A toolkit-independent copy of the graph of a molecule
+
+A MolGraph holds the atoms and bonds of a molecule, with their charges,
+isotopes, hydrogen counts, coordinates and stereochemistry, as plain
+Python lists. The Molecule of each Cinfony module can export its graph
+and be built from one. The fromgraph() function of a module, as in
+rdk.fromgraph(pybelmol), copies a molecule of another module through its
+graph, keeping the order of the atoms, instead of writing and parsing a
+SMILES string or MOL block as the Molecule constructor does.
+"""
+
+class MolGraph(object):
+    """The graph of a molecule, independent of any toolkit.
+
+    Required parameters:
+       atoms -- a list of (atomicnum, formalcharge, isotope, hcount,
+                aromatic) tuples, one per atom. The isotope is 0 for the
+                natural abundance, and hcount is the number of hydrogens
+                that are not themselves atoms of the graph.
+       bonds -- a list of (begin, end, order, aromatic) tuples, one per
+                bond, where begin and end are atom indices starting from 0
+                and order is 1, 2 or 3 (aromatic rings are given as a
+                Kekule structure)
+
+    Optional parameters:
+       coords -- a list of (x, y, z) tuples, one per atom (default is
+                 None, for no coordinates)
+       dim -- 2 or 3 if there are coordinates (default is 0)
+       tetrahedral -- a list of (centre, refs, clockwise) tuples for the
+                      stereocentres. refs is a tuple of the indices of the
+                      four neighbours, with None for an implicit hydrogen
+                      or a lone pair. clockwise is True if, looking from
+                      refs[0] towards the centre, the other three are
+                      arranged clockwise (as for @@ in SMILES). (default
+                      is [])
+       cistrans -- a list of (begin, end, first, second, cis) tuples for
+                   the stereo double bonds between atoms begin and end.
+                   first is a neighbour of begin and second a neighbour
+                   of end, and cis is True if they are on the same side
+                   of the double bond. (default is [])
+       title -- the title of the molecule (default is "")
+
+    Attributes:
+       atoms, bonds, coords, dim, tetrahedral, cistrans, title
+
+    Whether the atoms and bonds are aromatic is given as the exporting
+    toolkit perceived it. The importing toolkit may perceive them again
+    from the Kekule structure.
+
+    >>> graph = MolGraph([(6, 0, 0, 3, False), (8, 0, 0, 1, False)],
+    ...                  [(0, 1, 1, False)], title="methanol")
+    >>> graph
+    <MolGraph of 2 atoms and 1 bonds>
+    """
+    __slots__ = ("atoms", "bonds", "coords", "dim", "tetrahedral",
+                 "cistrans", "title")
+
+    def __init__(self, atoms, bonds, coords=None, dim=0, tetrahedral=None,
+                 cistrans=None, title=""):
+        self.atoms = atoms
+        self.bonds = bonds
+        self.coords = coords
+        self.dim = dim
+        self.tetrahedral = tetrahedral or []
+        self.cistrans = cistrans or []
+        self.title = title
+
+    def __repr__(self):
+        return "<MolGraph of %d atoms and %d bonds>" % (len(self.atoms),
+                                                        len(self.bonds))
+
+def reorder(refs, clockwise, order):
+    """Return the winding of a stereocentre with its neighbours reordered.
+
+    Required parameters:
+       refs, clockwise -- as in MolGraph.tetrahedral
+       order -- the same neighbours as refs, in another order
+
+    Returns True if, looking from order[0], the rest of order is arranged
+    clockwise. Swapping any two neighbours reverses the winding.
+
+    >>> reorder((0, 1, 2, 3), True, (1, 0, 2, 3))
+    False
+    >>> reorder((0, 1, 2, None), True, (2, None, 0, 1))
+    True
+    """
+    positions = [list(refs).index(x) for x in order]
+    swaps = 0
+    for i in range(len(positions)):
+        for j in range(i + 1, len(positions)):
+            if positions[i] > positions[j]:
+                swaps += 1
+    return clockwise == (swaps % 2 == 0)
@@ -7,6 +7,7 @@ Global variables:
   outformats - a dictionary of supported output formats
   descs - a list of supported descriptors
   fps - a list of supported fingerprint types
+  screenfps - the fingerprint types used by substructsearch()
   forcefields - a list of supported forcefields
 """
 
@@ -15,6 +16,12 @@ import os.path
 import tempfile
 import openbabel as ob
 
+import recordio
+import fpsearch
+import desctable
+import smartslib
+import molgraph
+
 try:
     import oasa
     import oasa.cairo_out
@@ -28,6 +35,18 @@ try:
 except ImportError: #pragma: no cover
     tk = None
 
+try:
+    import numpy
+except ImportError: #pragma: no cover
+    numpy = None
+
+def _checknumpy():
+    if not numpy:
+        errormessage = ("NumPy not found, but is required for coordinate "
+                        "arrays. See installation instructions for "
+                        "more information.")
+        raise ImportError(errormessage)
+
 def _formatstodict(list):
     broken = [x.replace("[Read-only]", "").replace("[Write-only]","").split(" -- ") for x in list]
     broken = [(x,y.strip()) for x,y in broken]
@@ -53,6 +72,8 @@ _descdict = _getplugins(ob.OBDescriptor.FindType, descs)
 fps = _getpluginnames("fingerprints")
 """A list of supported fingerprint types"""
 _fingerprinters = _getplugins(ob.OBFingerprint.FindFingerprint, fps)
+screenfps = [x for x in ["FP2"] if x in fps]
+"""The fingerprint types that can be used by substructsearch()"""
 forcefields = [_x.lower() for _x in _getpluginnames("forcefields")]
 """A list of supported forcefields"""
 _forcefields = _getplugins(ob.OBForceField.FindType, forcefields)
@@ -60,7 +81,7 @@ operations = _getpluginnames("ops")
 """A list of supported operations"""
 _operations = _getplugins(ob.OBOp.FindType, operations)
 
-def readfile(format, filename):
+def readfile(format, filename, lazy=False):
     """Iterate over the molecules in a file.
 
     Required parameters:
@@ -68,6 +89,12 @@ def readfile(format, filename):
                 input formats
        filename
 
+    Optional parameters:
+       lazy -- if True, return a recordio.LazyMolecule for each record of
+               an SDF or SMILES file. Its title and SD tags are available
+               without parsing the molecule, which is only read when
+               another attribute or method is used (default is False)
+
     You can access the first molecule in a file using the next() method
     of the iterator:
         mol = readfile("smi", "myfile.smi").next()
@@ -83,6 +110,9 @@ def readfile(format, filename):
     ...
     >>> print atomtotal
     43
+
+    SDF and SMILES files compressed with gzip, bzip2 or Zstandard are
+    decompressed in a background thread (see recordio.compressions).
     """
     obconversion = ob.OBConversion()
     formatok = obconversion.SetInFormat(format)
@@ -90,6 +120,18 @@ def readfile(format, filename):
         raise ValueError("%s is not a recognised OpenBabel format" % format)
     if not os.path.isfile(filename):
         raise IOError("No such file: '%s'" % filename)
+    if lazy:
+        if format not in recordio.recordformats:
+            raise ValueError("%s is not a recognised format for lazy reading" % format)
+        for record in recordio.iterrecords(format, filename):
+            yield recordio.LazyMolecule(format, record, readstring)
+        return
+    if recordio.getcompression(filename):
+        if format not in recordio.recordformats:
+            raise ValueError("%s is not a recognised format for compressed files" % format)
+        for record in recordio.iterrecords(format, filename):
+            yield readstring(format, record)
+        return
     obmol = ob.OBMol()
     notatend = obconversion.ReadFile(obmol,filename)
     while notatend:
@@ -97,6 +139,40 @@ def readfile(format, filename):
         obmol = ob.OBMol()
         notatend = obconversion.Read(obmol)
 
+def _mapchunk(args):
+    function, format, records = args
+    return [function(readstring(format, record)) for record in records]
+
+def mapfile(function, format, filename, nprocs=None, chunksize=1000):
+    """Apply a function to each molecule in a file using several processes.
+
+    Required parameters:
+       function -- a function that takes a Molecule. It must be defined at
+                   the top level of a module so that it can be sent to the
+                   worker processes, and its return value must be picklable.
+       format - "sdf" or "smi" (see recordio.recordformats)
+       filename
+
+    Optional parameters:
+       nprocs -- the number of worker processes (default is the number
+                 of CPUs)
+       chunksize -- the number of records sent to a worker at a time
+                    (default is 1000)
+
+    The file is split on record boundaries and the chunks are parsed in
+    the worker processes. The results are yielded in the same order as the
+    molecules in the file. A Molecule can itself be returned by the
+    function, but it is pickled as an SDF record and parsed again in
+    this process; the speedup comes from doing the work in the workers.
+    """
+    if not ob.OBConversion().SetInFormat(format):
+        raise ValueError("%s is not a recognised OpenBabel format" % format)
+    chunks = ((function, format, records) for records in
+              recordio.iterchunks(format, filename, chunksize))
+    for results in recordio.imapchunks(_mapchunk, chunks, nprocs):
+        for result in results:
+            yield result
+
 def readstring(format, string):
     """Read in a molecule from a string.
 
@@ -124,6 +200,110 @@ def readstring(format, string):
             string, format))
     return Molecule(obmol)
 
+def calcfps(molecules, fptype="FP2"):
+    """Calculate the fingerprints of a set of molecules.
+
+    Required parameters:
+       molecules -- an iterable of Molecules, such as readfile()
+
+    Optional parameters:
+       fptype -- the fingerprint type (default is "FP2"). See the
+                 fps variable for a list of of available fingerprint
+                 types.
+
+    Returns an fpsearch.FingerprintMatrix, which holds the fingerprints
+    packed into a NumPy array of 64-bit words with one row per molecule.
+    NumPy is required.
+
+    >>> fps = calcfps(readfile("sdf", "head.sdf"))
+    >>> fps.words.shape
+    (2, 16)
+    """
+    try:
+        fingerprinter = _fingerprinters[fptype]
+    except KeyError:
+        raise ValueError("%s is not a recognised Open Babel Fingerprint type" % fptype)
+    rows = []
+    for molecule in molecules:
+        fp = ob.vectorUnsignedInt()
+        fingerprinter.GetFingerprint(molecule.OBMol, fp)
+        rows.append(list(fp))
+    bitsperint = ob.OBFingerprint.Getbitsperint()
+    nbits = rows and len(rows[0]) * bitsperint or 0
+    return fpsearch.FingerprintMatrix(fpsearch.packwords(rows, bitsperint),
+                                      nbits, fptype)
+
+def substructsearch(query, fps, molecules):
+    """Find the molecules that contain a substructure.
+
+    Required parameters:
+       query -- a SMILES string for the substructure
+       fps -- the fingerprints of the molecules as a FingerprintMatrix,
+              such as calcfps(molecules, fptype) or the fps of a
+              FingerprintDB, where fptype is one of the screenfps
+       molecules -- anything that can be indexed to give the Molecules,
+                    such as a list or a MoleculeFile
+
+    Returns a list of the indices of the molecules that match.
+
+    The fingerprint of the query is compared against fps first (see
+    fpsearch.screen()). Only the molecules whose fingerprints have all
+    of the query's bits set are read and matched against the query as a
+    SMARTS pattern, so a MoleculeFile does not parse the others.
+
+    FP2 is the fingerprint used by Open Babel's fastsearch. FP3 and FP4
+    cannot be used, as many of their keys depend on the hydrogens or
+    neighbours of an atom, and so a match can lack bits that the query
+    has (for example, "CO" sets the alcohol bit but matches ethers).
+
+    >>> mols = list(readfile("sdf", "head.sdf"))
+    >>> substructsearch("SS", calcfps(mols, "FP2"), mols)
+    [1]
+    """
+    if fps.fptype not in screenfps:
+        raise ValueError("%s fingerprints cannot be used to screen substructures" % fps.fptype)
+    queryfp = calcfps([readstring("smi", query)], fps.fptype)
+    smarts = Smarts(query)
+    return [i for i in fpsearch.screen(queryfp, fps).tolist()
+            if smarts.match(molecules[i])]
+
+def _descrows(descnames, molecules):
+    descriptors = [_descdict[descname] for descname in descnames]
+    return [[desc.Predict(molecule.OBMol) for desc in descriptors]
+            for molecule in molecules]
+
+def calcdescs(molecules, descnames=[], nprocs=1, chunksize=1000):
+    """Calculate descriptor values for a set of molecules.
+
+    Required parameters:
+       molecules -- an iterable of Molecules, such as readfile()
+
+    Optional parameters:
+       descnames -- a list of names of descriptors (default is all of
+                    those in the descs variable)
+       nprocs -- the number of worker processes. If 1, the descriptors
+                 are calculated in this process; if None, the number of
+                 CPUs is used (default is 1)
+       chunksize -- the number of molecules sent to a worker at a time
+                    (default is 1000)
+
+    Returns a dictionary with a NumPy float64 array for each descriptor,
+    holding its values in the same order as the molecules. Values that
+    cannot be calculated are NaN. NumPy is required.
+
+    >>> table = calcdescs(readfile("sdf", "head.sdf"), ["MW"])
+    >>> len(table["MW"])
+    2
+    """
+    if not descnames:
+        descnames = descs
+    for descname in descnames:
+        if descname not in _descdict:
+            raise ValueError("%s is not a recognised Open Babel descriptor type" % descname)
+    rows = desctable.maprows(_descrows, descnames, molecules, nprocs,
+                             chunksize)
+    return desctable.fromrows(descnames, rows)
+
 class Outputfile(object):
     """Represent a file to which *output* is to be sent.
    
@@ -140,6 +320,9 @@ class Outputfile(object):
     Optional parameters:
        overwrite -- if the output file already exists, should it
                    be overwritten? (default is False)
+
+    If the filename ends in one of the extensions in recordio.compressions,
+    the output is compressed in a background thread.
                    
     Methods:
        write(molecule)
@@ -154,6 +337,11 @@ class Outputfile(object):
         formatok = self.obConversion.SetOutFormat(self.format)
         if not formatok:
             raise ValueError("%s is not a recognised OpenBabel format" % format)
+        self._output = None
+        if recordio.getcompression(self.filename):
+            if format not in recordio.recordformats:
+                raise ValueError("%s is not a recognised format for compressed files" % format)
+            self._output = recordio.openoutput(self.filename)
         self.total = 0 # The total number of molecules written to the file
     
     def write(self, molecule):
@@ -165,7 +353,9 @@ class Outputfile(object):
         if not self.filename:
             raise IOError("Outputfile instance is closed.")
 
-        if self.total==0:
+        if self._output:
+            self._output.write(self.obConversion.WriteString(molecule.OBMol))
+        elif self.total==0:
             self.obConversion.WriteFile(molecule.OBMol, self.filename)
         else:
             self.obConversion.Write(molecule.OBMol)
@@ -173,9 +363,197 @@ class Outputfile(object):
 
     def close(self):
         """Close the Outputfile to further writing."""
-        self.obConversion.CloseOutFile()
+        if self._output:
+            self._output.close()
+        else:
+            self.obConversion.CloseOutFile()
         self.filename = None
 
+def _readrecord(format, record):
+    return readstring(format, record)
+
+_filterer = None # Set by _initfilter(), once per worker process
+
+def _initfilter(patterns, mode):
+    global _filterer
+    _filterer = (SmartsLibrary([(x, x) for x in patterns]), mode)
+
+def _filterchunk(args):
+    format, records = args
+    library, mode = _filterer
+    molecules = []
+    for record in records:
+        try:
+            molecules.append(_readrecord(format, record))
+        except IOError:
+            raise ValueError("Cannot read the record '%s'" %
+                             recordio.readtitle(format, record))
+    return [record for record, keep in
+            zip(records, library.select(molecules, mode)) if keep]
+
+def filterfile(format, infile, outfile, patterns, mode="any", nprocs=None,
+               chunksize=1000, overwrite=False):
+    """Write the molecules of a file that pass a filter on SMARTS patterns.
+
+    Required parameters:
+       format - "sdf" or "smi" (see recordio.recordformats)
+       infile, outfile -- the names of the input and output files
+       patterns -- a list of SMARTS patterns
+
+    Optional parameters:
+       mode -- "any" keeps the molecules that match at least one of the
+               patterns, "all" those that match every pattern and "none"
+               those that match none of them (default is "any")
+       nprocs -- the number of worker processes. If 1, the patterns are
+                 matched in this process (default is the number of CPUs)
+       chunksize -- the number of records sent to a worker at a time
+                    (default is 1000)
+       overwrite -- if the output file already exists, should it be
+                    overwritten? (default is False)
+
+    Returns the number of molecules written.
+
+    The file is split into records, which are parsed and matched in the
+    worker processes (see smartslib.filterrecords()), so nothing needs to
+    be pickled apart from the text of the records and patterns. The text
+    of the records that are kept is written as it is, in the same order
+    as in the input file (see recordio.writerecords()). A ValueError that
+    gives the title of the record is raised if a record cannot be read.
+    """
+    library = SmartsLibrary([(x, x) for x in patterns]) # Check the patterns
+    records = smartslib.filterrecords(_filterchunk, _initfilter, format,
+                                      infile, library.names, mode,
+                                      nprocs, chunksize)
+    return recordio.writerecords(format, records, outfile, overwrite)
+
+class MoleculeFile(object):
+    """Random access to the molecules in a file.
+
+    Required parameters:
+       format - "sdf" or "smi" (see recordio.recordformats)
+       filename
+
+    Optional parameters:
+       save -- store the index of the records next to the file, so that
+               it does not need to be built again (default is True)
+
+    A MoleculeFile supports len(), indexing and slicing. Molecule i is read
+    directly from its position in the file, without parsing the molecules
+    before it. See recordio.RecordIndex for details of the index.
+
+    Example:
+    >>> molfile = MoleculeFile("sdf", "head.sdf")
+    >>> len(molfile)
+    2
+    >>> print molfile[-1].title
+    NSC 2
+    """
+    def __init__(self, format, filename, save=True):
+        if format not in recordio.recordformats:
+            raise ValueError("%s is not a recognised format for a MoleculeFile" % format)
+        self.format = format
+        self.filename = filename
+        self.index = recordio.RecordIndex(format, filename, save)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [_readrecord(self.format, x) for x in self.index[i]]
+        return _readrecord(self.format, self.index[i])
+
+    def close(self):
+        """Close the underlying file."""
+        self.index.close()
+
+_implicitref = ob.OBStereo.ImplicitRef & 0xFFFFFFFF # As returned by SWIG
+
+def _fromgraph(graph):
+    """Return an OBMol built from a MolGraph"""
+    mol = ob.OBMol()
+    mol.BeginModify()
+    for atomicnum, charge, isotope, hcount, aromatic in graph.atoms:
+        atom = mol.NewAtom()
+        atom.SetAtomicNum(atomicnum)
+        if charge:
+            atom.SetFormalCharge(charge)
+        if isotope:
+            atom.SetIsotope(isotope)
+    for begin, end, order, aromatic in graph.bonds:
+        mol.AddBond(begin + 1, end + 1, order)
+    if graph.coords:
+        for i, (x, y, z) in enumerate(graph.coords):
+            mol.GetAtom(i + 1).SetVector(x, y, z)
+    mol.EndModify()
+    for i, atom in enumerate(graph.atoms):
+        obatom = mol.GetAtom(i + 1)
+        obatom.SetImplicitValence(obatom.GetValence() + atom[3])
+    mol.SetImplicitValencePerceived()
+    mol.SetDimension(graph.dim)
+    mol.SetTitle(graph.title)
+
+    # The atoms of a new OBMol have the ids 0, 1, 2...
+    def ref(i):
+        if i is None:
+            return _implicitref
+        return i
+    for centre, refs, clockwise in graph.tetrahedral:
+        config = ob.OBTetrahedralConfig()
+        config.center = centre
+        config.from_or_towards = ref(refs[0])
+        config.refs = tuple([ref(x) for x in refs[1:]])
+        if clockwise:
+            config.winding = ob.OBStereo.Clockwise
+        else:
+            config.winding = ob.OBStereo.AntiClockwise
+        config.view = ob.OBStereo.ViewFrom
+        config.specified = True
+        stereo = ob.OBTetrahedralStereo(mol)
+        stereo.SetConfig(config)
+        mol.CloneData(stereo)
+    for begin, end, first, second, cis in graph.cistrans:
+        others = []
+        for atom, chosen in [(begin, first), (end, second)]:
+            obatom = mol.GetAtom(atom + 1)
+            rest = [nbr.GetIdx() - 1 for nbr in ob.OBAtomAtomIter(obatom)
+                    if nbr.GetIdx() - 1 not in (begin, end, chosen)]
+            others.append((rest + [None])[0])
+        if cis:
+            refs = (first, others[0], others[1], second)
+        else:
+            refs = (first, others[0], second, others[1])
+        config = ob.OBCisTransConfig()
+        config.begin = begin
+        config.end = end
+        config.refs = tuple([ref(x) for x in refs])
+        config.shape = ob.OBStereo.ShapeU
+        config.specified = True
+        stereo = ob.OBCisTransStereo(mol)
+        stereo.SetConfig(config)
+        mol.CloneData(stereo)
+    if graph.tetrahedral or graph.cistrans or graph.dim == 0:
+        # Otherwise, Open Babel perceives the stereo from the coordinates
+        mol.SetChiralityPerceived()
+    return mol
+
+def fromgraph(molecule):
+    """Copy a molecule of another Cinfony module through a MolGraph.
+
+    Required parameters:
+       molecule -- a Molecule of any Cinfony module with a _graph
+                   attribute (pybel, rdk or cdk), or a MolGraph
+
+    Unlike the Molecule constructor, which writes and reads a SMILES
+    string or MOL block, this keeps the order of the atoms, the hydrogen
+    counts, the exact coordinates, the stereochemistry and the title (see
+    the molgraph module). It is slower, as each atom and bond is copied
+    by a separate call.
+    """
+    if not isinstance(molecule, molgraph.MolGraph):
+        molecule = molecule._graph
+    return Molecule(_fromgraph(molecule))
+
 class Molecule(object):
     """Represent a Pybel Molecule.
 
@@ -183,17 +561,36 @@ class Molecule(object):
        OBMol -- an Open Babel OBMol or any type of cinfony Molecule
  
     Attributes:
-       atoms, charge, conformers, data, dim, energy, exactmass, formula, 
-       molwt, spin, sssr, title, unitcell.
+       atoms, charge, conformers, coords, data, dim, energy, exactmass,
+       formula, molwt, spin, sssr, title, unitcell.
     (refer to the Open Babel library documentation for more info).
     
     Methods:
-       addh(), calcfp(), calcdesc(), draw(), localopt(), make3D(), removeh(),
-       write() 
+       addh(), atomtable(), bondtable(), calcfp(), calcdesc(), draw(),
+       localopt(), make3D(), removeh(), setcoords(), write() 
+
+    Molecules can be pickled (they are stored as SDF records).
+
+    The values of atoms, exactmass, formula, molwt and sssr, and the
+    results of calcfp() and calcdesc(), are cached. The cache is cleared
+    by addh(), removeh(), make3D(), localopt(), draw(update=True) and by
+    setting the title. If you change the OBMol directly, create a new
+    Molecule from it.
+
+    Molecules, Atoms and MoleculeData use __slots__ to save memory when
+    many of them are held at once, so other attributes cannot be added
+    to them. The data attribute returns the same MoleculeData each time.
+      
+    A Molecule of another Cinfony module is copied by writing and reading
+    a SMILES string or MOL block. This is the fastest way to convert, but
+    it is lossy: the atoms may be reordered, coordinates are rounded or
+    lost, stereochemistry may be dropped and the title may not survive.
+    fromgraph() is the lossless way to convert (see its docstring).
       
     The underlying Open Babel molecule can be accessed using the attribute:
        OBMol
     """
+    __slots__ = ("OBMol", "_cache", "_data")
     _cinfony = True
 
     def __init__(self, OBMol):
@@ -207,32 +604,61 @@ class Molecule(object):
             OBMol = mol.OBMol
 
         self.OBMol = OBMol
- 
-    @property
-    def atoms(self):
+        self._cache = None # Created when first needed
+        self._data = None
+
+    def _cached(self, key, function, *args):
+        """Return the cached value for key, calculating it if necessary"""
+        if self._cache is None:
+            self._cache = {}
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = function(*args)
+            return value
+
+    def _invalidate(self):
+        """Clear the cache, as the molecule has changed"""
+        self._cache = None
+
+    def _getatoms(self):
         return [ Atom(self.OBMol.GetAtom(i+1)) for i in range(self.OBMol.NumAtoms()) ]
     @property
+    def atoms(self): return list(self._cached("atoms", self._getatoms))
+    @property
     def charge(self): return self.OBMol.GetTotalCharge()
     @property
     def conformers(self): return self.OBMol.GetConformers()
+    def _getcoords(self):
+        _checknumpy()
+        return numpy.array([(atom.GetX(), atom.GetY(), atom.GetZ()) for atom
+                            in ob.OBMolAtomIter(self.OBMol)],
+                           dtype=numpy.float64).reshape(-1, 3)
+    def _setcoords(self, coords): self.setcoords(coords)
+    coords = property(_getcoords, _setcoords)
     @property
-    def data(self): return MoleculeData(self.OBMol)
+    def data(self):
+        if self._data is None or self._data._mol is not self.OBMol:
+            self._data = MoleculeData(self.OBMol)
+        return self._data
     @property
     def dim(self): return self.OBMol.GetDimension()
     @property
     def energy(self): return self.OBMol.GetEnergy()
     @property
-    def exactmass(self): return self.OBMol.GetExactMass()
+    def exactmass(self): return self._cached("exactmass", self.OBMol.GetExactMass)
     @property
-    def formula(self): return self.OBMol.GetFormula()
+    def formula(self): return self._cached("formula", self.OBMol.GetFormula)
     @property
-    def molwt(self): return self.OBMol.GetMolWt()
+    def molwt(self): return self._cached("molwt", self.OBMol.GetMolWt)
     @property
     def spin(self): return self.OBMol.GetTotalSpinMultiplicity()
     @property
-    def sssr(self): return self.OBMol.GetSSSR()
+    def sssr(self): return self._cached("sssr", self.OBMol.GetSSSR)
     def _gettitle(self): return self.OBMol.GetTitle()
-    def _settitle(self, val): self.OBMol.SetTitle(val)
+    def _settitle(self, val):
+        self.OBMol.SetTitle(val)
+        self._invalidate()
     title = property(_gettitle, _settitle)
     @property
     def unitcell(self):
@@ -242,12 +668,68 @@ class Molecule(object):
         else:
             raise AttributeError("Molecule has no attribute 'unitcell'")
     @property
+    def _graph(self):
+        mol = self.OBMol
+        atoms = []
+        for i in range(mol.NumAtoms()):
+            atom = mol.GetAtom(i + 1)
+            atoms.append((atom.GetAtomicNum(), atom.GetFormalCharge(),
+                          atom.GetIsotope(), atom.ImplicitHydrogenCount(),
+                          atom.IsAromatic()))
+        bonds = []
+        for i in range(mol.NumBonds()):
+            bond = mol.GetBond(i)
+            bonds.append((bond.GetBeginAtomIdx() - 1, bond.GetEndAtomIdx() - 1,
+                          bond.GetBO(), bond.IsAromatic()))
+        coords = None
+        if mol.GetDimension():
+            coords = [(atom.GetX(), atom.GetY(), atom.GetZ())
+                      for atom in ob.OBMolAtomIter(mol)]
+        tetrahedral, cistrans = [], []
+        facade = ob.OBStereoFacade(mol)
+        if facade.NumTetrahedralStereo() or facade.NumCisTransStereo():
+            index = dict([(atom.GetId(), atom.GetIdx() - 1)
+                          for atom in ob.OBMolAtomIter(mol)])
+            index[_implicitref] = None
+            for atom in ob.OBMolAtomIter(mol):
+                if not facade.HasTetrahedralStereo(atom.GetId()):
+                    continue
+                config = facade.GetTetrahedralStereo(atom.GetId()).GetConfig()
+                if config.specified:
+                    refs = (config.from_or_towards,) + tuple(config.refs)
+                    tetrahedral.append((index[config.center],
+                                        tuple([index[x] for x in refs]), True))
+            for bond in ob.OBMolBondIter(mol):
+                if not facade.HasCisTransStereo(bond.GetId()):
+                    continue
+                stereo = facade.GetCisTransStereo(bond.GetId())
+                config = stereo.GetConfig()
+                if not config.specified:
+                    continue
+                begin = mol.GetAtomById(config.begin)
+                refs = [x for x in config.refs if x != _implicitref]
+                first = [x for x in refs
+                         if mol.GetBond(begin, mol.GetAtomById(x))][0]
+                second = [x for x in refs
+                          if not mol.GetBond(begin, mol.GetAtomById(x))][0]
+                cistrans.append((index[config.begin], index[config.end],
+                                 index[first], index[second],
+                                 stereo.IsCis(first, second)))
+        return molgraph.MolGraph(atoms, bonds, coords, mol.GetDimension(),
+                                 tetrahedral, cistrans, mol.GetTitle())
+    @property
     def _exchange(self):
         if self.OBMol.HasNonZeroCoords():
             return (1, self.write("mol"))
         else:
             return (0, self.write("can").split()[0])
 
+    def __getstate__(self):
+        return self.write("sdf")
+    def __setstate__(self, state):
+        self.OBMol = readstring("sdf", state).OBMol
+        self._cache = self._data = None
+
     def __iter__(self):
         """Iterate over the Atoms of the Molecule.
         
@@ -257,6 +739,72 @@ class Molecule(object):
         """
         return iter(self.atoms)
 
+    def atomtable(self):
+        """Return the properties of the atoms as NumPy arrays.
+
+        Returns a dictionary with the keys atomicnum, formalcharge,
+        isotope, hyb, partialcharge and coords, each with one row per atom
+        in the same order as the atoms attribute (see
+        desctable.atomcolumns()). No Atom objects are created. NumPy is
+        required.
+
+        >>> table = readstring("smi", "CC=O").atomtable()
+        >>> table["atomicnum"].tolist(), table["hyb"].tolist()
+        ([6, 6, 8], [3, 2, 2])
+        """
+        rows = [(atom.GetAtomicNum(), atom.GetFormalCharge(),
+                 atom.GetIsotope(), atom.GetHyb(), atom.GetPartialCharge(),
+                 atom.GetX(), atom.GetY(), atom.GetZ())
+                for atom in ob.OBMolAtomIter(self.OBMol)]
+        return desctable.atomcolumns(rows)
+
+    def bondtable(self):
+        """Return the bonds as NumPy arrays.
+
+        Returns a dictionary with the keys begin and end (the indices of
+        the atoms, starting from 0, in the same order as the atoms
+        attribute) and order (1.5 for aromatic bonds), with one row per
+        bond. The adjacency of the atoms is included in compressed sparse
+        row format (see desctable.bondcolumns()). NumPy is required.
+
+        >>> table = readstring("smi", "CC=O").bondtable()
+        >>> table["order"].tolist(), table["indices"].tolist()
+        ([1.0, 2.0], [1, 0, 2, 1])
+        """
+        rows = []
+        for bond in ob.OBMolBondIter(self.OBMol):
+            if bond.IsAromatic():
+                order = 1.5
+            else:
+                order = bond.GetBO()
+            rows.append((bond.GetBeginAtomIdx() - 1, bond.GetEndAtomIdx() - 1,
+                         order))
+        return desctable.bondcolumns(self.OBMol.NumAtoms(), rows)
+
+    def setcoords(self, coords):
+        """Set the coordinates of all of the atoms.
+
+        Required parameters:
+           coords -- an (n x 3) array or list, in the same order as the
+                     atoms attribute
+
+        The coords attribute returns the current coordinates as an
+        (n x 3) NumPy array of type float64, and can also be assigned
+        to. The coordinates are set atom by atom, as Open Babel does not
+        give the length of its coordinate array, so it cannot safely be
+        written to directly. No Atom objects are created. NumPy is
+        required.
+        """
+        _checknumpy()
+        coords = numpy.asarray(coords, dtype=numpy.float64)
+        if coords.shape != (self.OBMol.NumAtoms(), 3):
+            raise ValueError("Expected coordinates of shape (%d, 3) but got %s"
+                             % (self.OBMol.NumAtoms(), coords.shape))
+        for atom, (x, y, z) in zip(ob.OBMolAtomIter(self.OBMol),
+                                   coords.tolist()):
+            atom.SetVector(x, y, z)
+        self._invalidate()
+
     def calcdesc(self, descnames=[]):
         """Calculate descriptor values.
 
@@ -275,7 +823,8 @@ class Molecule(object):
                 desc = _descdict[descname]
             except KeyError:
                 raise ValueError("%s is not a recognised Open Babel descriptor type" % descname)
-            ans[descname] = desc.Predict(self.OBMol)
+            ans[descname] = self._cached(("desc", descname), desc.Predict,
+                                         self.OBMol)
         return ans
     
     def calcfp(self, fptype="FP2"):
@@ -286,11 +835,14 @@ class Molecule(object):
                      fps variable for a list of of available fingerprint
                      types.
         """
-        fp = ob.vectorUnsignedInt()
         try:
             fingerprinter = _fingerprinters[fptype]
         except KeyError:
             raise ValueError("%s is not a recognised Open Babel Fingerprint type" % fptype)
+        return self._cached(("fp", fptype), self._calcfp, fingerprinter)
+
+    def _calcfp(self, fingerprinter):
+        fp = ob.vectorUnsignedInt()
         fingerprinter.GetFingerprint(self.OBMol, fp)
         return Fingerprint(fp)
 
@@ -344,6 +896,7 @@ class Molecule(object):
             return
         ff.SteepestDescent(steps)
         ff.GetCoordinates(self.OBMol)
+        self._invalidate()
     
 ##    def globalopt(self, forcefield="MMFF94", steps=1000):
 ##        if not (self.OBMol.Has2D() or self.OBMol.Has3D()):
@@ -370,16 +923,19 @@ class Molecule(object):
         """
         forcefield = forcefield.lower()
         _builder.Build(self.OBMol)
+        self._invalidate()
         self.addh()
         self.localopt(forcefield, steps)
 
     def addh(self):
         """Add hydrogens."""
         self.OBMol.AddHydrogens()
+        self._invalidate()
 
     def removeh(self):
         """Remove hydrogens."""
         self.OBMol.DeleteHydrogens()
+        self._invalidate()
         
     def __str__(self):
         return self.write()
@@ -464,6 +1020,7 @@ class Molecule(object):
                 newcoords = [(v.x / 30., v.y / 30., 0.0) for v in mol.vertices]
                 for atom, newcoord in zip(ob.OBMolAtomIter(self.OBMol), newcoords):
                     atom.SetVector(*newcoord)
+                self._invalidate()
         if filename or show:
             maxx = max([v.x for v in mol.vertices])
             minx = min([v.x for v in mol.vertices])
@@ -528,6 +1085,7 @@ class Atom(object):
     The original Open Babel atom can be accessed using the attribute:
        OBAtom
     """
+    __slots__ = ("OBAtom",)
 
     def __init__(self, OBAtom):
         self.OBAtom = OBAtom
@@ -582,17 +1140,7 @@ def _findbits(fp, bitsperint):
     >>> _findbits([13, 71], 8)
     [1, 3, 4, 9, 10, 11, 15]
     """
-    ans = []
-    start = 1
-    for x in fp:
-        i = start
-        while x > 0:
-            if x % 2:
-                ans.append(i)
-            x >>= 1
-            i += 1
-        start += bitsperint
-    return ans
+    return fpsearch.findbits(fp, bitsperint, offset=1)
         
 class Fingerprint(object):
     """A Molecular Fingerprint.
@@ -626,13 +1174,15 @@ class Smarts(object):
        smartspattern
     
     Methods:
-       findall(molecule)
+       findall(molecule, maxmatches=None), match(molecule)
     
     Example:
     >>> mol = readstring("smi","CCN(CC)CC") # triethylamine
     >>> smarts = Smarts("[#6][#6]") # Matches an ethyl group
     >>> print smarts.findall(mol) 
     [(1, 2), (4, 5), (6, 7)]
+    >>> smarts.match(mol)
+    True
 
     The numbers returned are the indices (starting from 1) of the atoms
     that match the SMARTS pattern. In this case, there are three matches
@@ -644,15 +1194,101 @@ class Smarts(object):
         success = self.obsmarts.Init(smartspattern)
         if not success:
             raise IOError("Invalid SMARTS pattern")
-    def findall(self,molecule):
+    def findall(self,molecule,maxmatches=None):
         """Find all matches of the SMARTS pattern to a particular molecule.
         
         Required parameters:
            molecule
+
+        Optional parameters:
+           maxmatches -- the maximum number of matches to return (default
+                         is None, which returns all of them)
+
+        With maxmatches=1 the search stops at the first match. Open Babel
+        cannot stop after any other number, so for larger values all of
+        the matches are found and the rest are discarded.
         """
-        self.obsmarts.Match(molecule.OBMol)
-        return [x for x in self.obsmarts.GetUMapList()]
-        
+        if maxmatches == 1:
+            self.obsmarts.Match(molecule.OBMol, True)
+        else:
+            self.obsmarts.Match(molecule.OBMol)
+        return [x for x in self.obsmarts.GetUMapList()][:maxmatches]
+
+    def match(self,molecule):
+        """Does a SMARTS pattern match a particular molecule?
+
+        Required parameters:
+           molecule
+
+        The search stops at the first match.
+        """
+        return self.obsmarts.Match(molecule.OBMol, True)
+
+class SmartsLibrary(object):
+    """A set of named SMARTS patterns that are matched together
+
+    Required parameters:
+       patterns -- a list of (name, SMARTS pattern) pairs, or a dictionary
+                   (in which case the patterns are sorted by name)
+
+    Attributes:
+       names -- the names of the patterns, in the order of the columns
+                returned by match()
+       smarts -- the compiled Smarts, in the same order
+
+    Methods:
+       match(molecules), select(molecules, mode="any")
+
+    Each pattern is compiled once. Before a pattern is matched against a
+    molecule, its element and ring requirements are checked against
+    counts made once for the molecule (see smartslib), and most patterns
+    are never run. NumPy is required.
+
+    Example:
+    >>> library = SmartsLibrary([("amine", "N"), ("benzene", "c1ccccc1")])
+    >>> mols = [readstring("smi", "Nc1ccccc1"), readstring("smi", "CCN")]
+    >>> library.match(mols).tolist()
+    [[True, True], [True, False]]
+    """
+    def __init__(self, patterns):
+        if hasattr(patterns, "items"):
+            patterns = sorted(patterns.items())
+        self.names = [name for name, pattern in patterns]
+        self.smarts = [Smarts(pattern) for name, pattern in patterns]
+        self._screen = smartslib.Screen([pattern for name, pattern in patterns])
+
+    def _counts(self, molecule):
+        return (smartslib.formulacounts(molecule.formula),
+                len(molecule.OBMol.GetSSSR()))
+
+    def _matches(self, i, molecule):
+        return self.smarts[i].match(molecule)
+
+    def match(self, molecules):
+        """Find which patterns match each molecule.
+
+        Required parameters:
+           molecules -- an iterable of Molecules
+
+        Returns a boolean NumPy array with one row per molecule and one
+        column per pattern.
+        """
+        return self._screen.hitmatrix(molecules, self._counts, self._matches)
+
+    def select(self, molecules, mode="any"):
+        """Find which molecules pass a filter on the patterns.
+
+        Required parameters:
+           molecules -- an iterable of Molecules
+
+        Optional parameters:
+           mode -- "any", "all" or "none" (see smartslib.Screen.select())
+
+        Returns a list of booleans, one per molecule.
+        """
+        return self._screen.select(molecules, self._counts, self._matches,
+                                   mode)
+
 class MoleculeData(object):
     """Store molecule data in a dictionary-type object
     
@@ -680,6 +1316,8 @@ class MoleculeData(object):
     >>> print len(data), data.keys(), data.has_key("NSC")
     1 ['Comment'] False
     """
+    __slots__ = ("_mol",)
+
     def __init__(self, obmol):
         self._mol = obmol
     def _data(self):
@@ -692,7 +1330,7 @@ class MoleculeData(object):
     def values(self):
         return [x.GetValue() for x in self._data()]
     def items(self):
-        return zip(self.keys(), self.values())
+        return [(x.GetAttribute(), x.GetValue()) for x in self._data()]
     def __iter__(self):
         return iter(self.keys())
     def iteritems(self):
@@ -7,17 +7,27 @@ Global variables:
   outformats - a dictionary of supported output formats
   descs - a list of supported descriptors
   fps - a list of supported fingerprint types
+  screenfps - the fingerprint types used by substructsearch()
   forcefields - a list of supported forcefields
 """
 
 import os
 
+import recordio
+import fpsearch
+import desctable
+import smartslib
+import molgraph
+
 from rdkit import Chem
 from rdkit.Chem import AllChem
 from rdkit.Chem.Draw import MolDrawing
 from rdkit.Chem.AvailDescriptors import descDict
 
 import rdkit.DataStructs
+import rdkit.Geometry
+import rdkit.Chem.MolSurf
+import rdkit.Chem.EState.EState_VSA
 import rdkit.Chem.MACCSkeys
 import rdkit.Chem.AtomPairs.Pairs
 import rdkit.Chem.AtomPairs.Torsions
@@ -36,11 +46,107 @@ try:
 except ImportError:
     aggdraw = None
 
+# Only in newer versions of the RDKit
+try:
+    from rdkit.Chem import rdMolDescriptors
+except ImportError:
+    rdMolDescriptors = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _checknumpy():
+    if not numpy:
+        errormessage = ("NumPy not found, but is required for coordinate "
+                        "arrays. See installation instructions for "
+                        "more information.")
+        raise ImportError, errormessage
+
 fps = ['rdkit', 'layered', 'maccs', 'atompairs', 'torsions']
 """A list of supported fingerprint types"""
+screenfps = ['rdkit']
+"""The fingerprint types that can be used by substructsearch()"""
+if hasattr(Chem, "PatternFingerprint"):
+    fps.append('pattern')
+    screenfps.insert(0, 'pattern')
 descs = descDict.keys()
 """A list of supported descriptors"""
 
+def _getdescgroups():
+    """Find the descriptors that are elements of a shared calculation.
+
+    Returns a dictionary from the name of a descriptor to a (function, index)
+    pair, where the value of the descriptor is function(Mol)[index]. For
+    example, SlogP_VSA1 to SlogP_VSA12 are the bins of a single vector.
+    """
+    families = [("SlogP_VSA", rdkit.Chem.MolSurf, "SlogP_VSA_"),
+                ("SMR_VSA", rdkit.Chem.MolSurf, "SMR_VSA_"),
+                ("PEOE_VSA", rdkit.Chem.MolSurf, "PEOE_VSA_"),
+                ("EState_VSA", rdkit.Chem.EState.EState_VSA, "EState_VSA_"),
+                ("VSA_EState", rdkit.Chem.EState.EState_VSA, "VSA_EState_")]
+    groups = {}
+    for prefix, module, functionname in families:
+        function = getattr(module, functionname, None)
+        if function is None: # Not in this version of the RDKit
+            continue
+        for descname in descDict:
+            suffix = descname[len(prefix):]
+            if descname.startswith(prefix) and suffix.isdigit():
+                groups[descname] = (function, int(suffix) - 1)
+    # MolLogP and MolMR are sums over the same Crippen atom contributions
+    crippen = getattr(rdMolDescriptors, "CalcCrippenDescriptors", None)
+    if crippen:
+        for i, descname in enumerate(["MolLogP", "MolMR"]):
+            if descname in descDict:
+                groups[descname] = (crippen, i)
+    return groups
+
+_descgroups = _getdescgroups()
+
+def _plandescs(descnames):
+    """Plan the calculation of descriptors, sharing work between them.
+
+    Returns a list of (function, columns) steps, where columns is a list
+    of (position in descnames, index) pairs. Each step is calculated once
+    per molecule; if the index is None, the result is the value itself,
+    otherwise it is a vector holding several of the values.
+    """
+    plan = []
+    shared = {}
+    for column, descname in enumerate(descnames):
+        if descname in _descgroups:
+            function, index = _descgroups[descname]
+            if function not in shared:
+                shared[function] = []
+                plan.append((function, shared[function]))
+            shared[function].append((column, index))
+        else:
+            plan.append((descDict[descname], [(column, None)]))
+    return plan
+
+def _calcplan(plan, Mol, size, ignoreerrors=False):
+    """Carry out a plan from _plandescs() for an RDKit Mol.
+
+    Returns a list of size values. If ignoreerrors is True, the values of
+    a step that raises an exception are left as None.
+    """
+    row = [None] * size
+    for function, columns in plan:
+        try:
+            value = function(Mol)
+        except Exception:
+            if not ignoreerrors:
+                raise
+            continue
+        for column, index in columns:
+            if index is None:
+                row[column] = value
+            else:
+                row[column] = value[index]
+    return row
+
 _formats = {'smi': "SMILES", 'iso': "Isomeric SMILES",
             'mol': "MDL MOL file", 'sdf': "MDL SDF file"}
 informats = dict([(_x, _formats[_x]) for _x in ['mol', 'sdf', 'smi']])
@@ -48,11 +154,12 @@ informats = dict([(_x, _formats[_x]) for _x in ['mol', 'sdf', 'smi']])
 outformats = dict([(_x, _formats[_x]) for _x in ['mol', 'sdf', 'smi', 'iso']])
 """A dictionary of supported output formats"""
 
+_hybridisations = {'SP': 1, 'SP2': 2, 'SP3': 3, 'SP3D': 5, 'SP3D2': 6}
 _forcefields = {'uff': AllChem.UFFOptimizeMolecule}
 forcefields = _forcefields.keys()
 """A list of supported forcefields"""
 
-def readfile(format, filename):
+def readfile(format, filename, lazy=False):
     """Iterate over the molecules in a file.
 
     Required parameters:
@@ -60,6 +167,12 @@ def readfile(format, filename):
                 input formats
        filename
 
+    Optional parameters:
+       lazy -- if True, return a recordio.LazyMolecule for each record of
+               an SDF or SMILES file. Its title and SD tags are available
+               without parsing the molecule, which is only read when
+               another attribute or method is used (default is False)
+
     You can access the first molecule in a file using the next() method
     of the iterator:
         mol = readfile("smi", "myfile.smi").next()
@@ -75,10 +188,24 @@ def readfile(format, filename):
     ...
     >>> print atomtotal
     43
+
+    SDF and SMILES files compressed with gzip, bzip2 or Zstandard are
+    decompressed in a background thread (see recordio.compressions).
     """
     if not os.path.isfile(filename):
         raise IOError, "No such file: '%s'" % filename
     format = format.lower()
+    if lazy:
+        if format not in recordio.recordformats:
+            raise ValueError, "%s is not a recognised format for lazy reading" % format
+        records = recordio.iterrecords(format, filename)
+        return (recordio.LazyMolecule(format, record, _readrecord)
+                for record in records)
+    if recordio.getcompression(filename):
+        if format not in recordio.recordformats:
+            raise ValueError, "%s is not a recognised format for compressed files" % format
+        records = recordio.iterrecords(format, filename)
+        return (_readrecord(format, record) for record in records)
     # Eagerly evaluate the supplier functions in order to report
     # errors in the format and errors in opening the file.
     # Then switch to an iterator...
@@ -129,6 +256,104 @@ def readstring(format, string):
         raise IOError, "Failed to convert '%s' to format '%s'" % (
             string, format)
 
+def calcfps(molecules, fptype="rdkit"):
+    """Calculate the fingerprints of a set of molecules.
+
+    Required parameters:
+       molecules -- an iterable of Molecules, such as readfile()
+
+    Optional parameters:
+       fptype -- the fingerprint type (default is "rdkit"). See the
+                 fps variable for a list of of available fingerprint
+                 types.
+
+    Returns an fpsearch.FingerprintMatrix, which holds the fingerprints
+    packed into a NumPy array of 64-bit words with one row per molecule.
+    NumPy is required.
+
+    The "atompairs" and "torsions" fingerprints are not bit vectors,
+    and so cannot be packed.
+    """
+    fptype = fptype.lower()
+    if fptype not in fps:
+        raise ValueError, "%s is not a recognised RDKit Fingerprint type" % fptype
+    if fptype in ["atompairs", "torsions"]:
+        raise ValueError, "%s fingerprints cannot be packed" % fptype
+    strings = [rdkit.DataStructs.BitVectToText(molecule.calcfp(fptype).fp)
+               for molecule in molecules]
+    nbits = strings and len(strings[0]) or 0
+    return fpsearch.FingerprintMatrix(fpsearch.packbitstrings(strings),
+                                      nbits, fptype)
+
+def substructsearch(query, fps, molecules):
+    """Find the molecules that contain a substructure.
+
+    Required parameters:
+       query -- a SMILES string for the substructure
+       fps -- the fingerprints of the molecules as a FingerprintMatrix,
+              such as calcfps(molecules, fptype) or the fps of a
+              FingerprintDB, where fptype is one of the screenfps
+       molecules -- anything that can be indexed to give the Molecules,
+                    such as a list or a MoleculeFile
+
+    Returns a list of the indices of the molecules that match.
+
+    The fingerprint of the query is compared against fps first (see
+    fpsearch.screen()). Only the molecules whose fingerprints have all
+    of the query's bits set are read and matched against the query as a
+    SMARTS pattern, so a MoleculeFile does not parse the others.
+
+    The "pattern" fingerprint is designed for this screen. The "layered"
+    fingerprint cannot be used, as its ring layers differ between a
+    chain in the query and the same atoms in a ring of the molecule.
+
+    >>> mols = list(readfile("sdf", "head.sdf"))
+    >>> substructsearch("SS", calcfps(mols, "pattern"), mols)
+    [1]
+    """
+    if fps.fptype not in screenfps:
+        raise ValueError, "%s fingerprints cannot be used to screen substructures" % fps.fptype
+    queryfp = calcfps([readstring("smi", query)], fps.fptype)
+    smarts = Smarts(query)
+    return [i for i in fpsearch.screen(queryfp, fps).tolist()
+            if smarts.match(molecules[i])]
+
+def _descrows(descnames, molecules):
+    plan = _plandescs(descnames)
+    return [_calcplan(plan, molecule.Mol, len(descnames), ignoreerrors=True)
+            for molecule in molecules]
+
+def calcdescs(molecules, descnames=[], nprocs=1, chunksize=1000):
+    """Calculate descriptor values for a set of molecules.
+
+    Required parameters:
+       molecules -- an iterable of Molecules, such as readfile()
+
+    Optional parameters:
+       descnames -- a list of names of descriptors (default is all of
+                    those in the descs variable)
+       nprocs -- the number of worker processes. If 1, the descriptors
+                 are calculated in this process; if None, the number of
+                 CPUs is used (default is 1)
+       chunksize -- the number of molecules sent to a worker at a time
+                    (default is 1000)
+
+    Returns a dictionary with a NumPy float64 array for each descriptor,
+    holding its values in the same order as the molecules. Values that
+    cannot be calculated are NaN. NumPy is required.
+
+    Descriptors that are parts of the same calculation, such as the bins
+    of SlogP_VSA, are calculated together once per molecule.
+    """
+    if not descnames:
+        descnames = descs
+    for descname in descnames:
+        if descname not in descDict:
+            raise ValueError, "%s is not a recognised RDKit descriptor type" % descname
+    rows = desctable.maprows(_descrows, descnames, molecules, nprocs,
+                             chunksize)
+    return desctable.fromrows(descnames, rows)
+
 class Outputfile(object):
     """Represent a file to which *output* is to be sent.
    
@@ -140,6 +365,9 @@ class Outputfile(object):
     Optional parameters:
        overwite -- if the output file already exists, should it
                    be overwritten? (default is False)
+
+    If the filename ends in one of the extensions in recordio.compressions,
+    the output is compressed in a background thread.
                    
     Methods:
        write(molecule)
@@ -150,12 +378,16 @@ class Outputfile(object):
         self.filename = filename
         if not overwrite and os.path.isfile(self.filename):
             raise IOError, "%s already exists. Use 'overwrite=True' to overwrite it." % self.filename
+        if format not in ["sdf", "smi"]:
+            raise ValueError,"%s is not a recognised RDKit format" % format
+        self._output = None
+        target = self.filename
+        if recordio.getcompression(self.filename):
+            self._output = target = recordio.openoutput(self.filename)
         if format=="sdf":
-            self._writer = Chem.SDWriter(self.filename)
-        elif format=="smi":
-            self._writer = Chem.SmilesWriter(self.filename)
+            self._writer = Chem.SDWriter(target)
         else:
-            raise ValueError,"%s is not a recognised RDKit format" % format
+            self._writer = Chem.SmilesWriter(target)
         self.total = 0 # The total number of molecules written to the file
     
     def write(self, molecule):
@@ -173,8 +405,203 @@ class Outputfile(object):
     def close(self):
         """Close the Outputfile to further writing."""
         self.filename = None
+        # The writer must be finished before the compressor is
         self._writer.flush()
-        del self._writer
+        self._writer.close()
+        if self._output:
+            self._output.close()
+
+def _readrecord(format, record):
+    if format == "sdf":
+        supplier = Chem.SDMolSupplier()
+        supplier.SetData(record)
+    else:
+        supplier = Chem.SmilesMolSupplierFromText(record, delimiter=" \t",
+                                                  titleLine=False)
+    try:
+        mol = supplier[0]
+    except IndexError:
+        mol = None
+    if mol is None:
+        raise IOError, "Failed to read the record '%s'" % (
+            recordio.readtitle(format, record))
+    return Molecule(mol)
+
+_filterer = None # Set by _initfilter(), once per worker process
+
+def _initfilter(patterns, mode):
+    global _filterer
+    _filterer = (SmartsLibrary([(x, x) for x in patterns]), mode)
+
+def _filterchunk(args):
+    format, records = args
+    library, mode = _filterer
+    molecules = []
+    for record in records:
+        try:
+            molecules.append(_readrecord(format, record))
+        except IOError:
+            raise ValueError, "Cannot read the record '%s'" % (
+                recordio.readtitle(format, record))
+    return [record for record, keep in
+            zip(records, library.select(molecules, mode)) if keep]
+
+def filterfile(format, infile, outfile, patterns, mode="any", nprocs=None,
+               chunksize=1000, overwrite=False):
+    """Write the molecules of a file that pass a filter on SMARTS patterns.
+
+    Required parameters:
+       format - "sdf" or "smi" (see recordio.recordformats)
+       infile, outfile -- the names of the input and output files
+       patterns -- a list of SMARTS patterns
+
+    Optional parameters:
+       mode -- "any" keeps the molecules that match at least one of the
+               patterns, "all" those that match every pattern and "none"
+               those that match none of them (default is "any")
+       nprocs -- the number of worker processes. If 1, the patterns are
+                 matched in this process (default is the number of CPUs)
+       chunksize -- the number of records sent to a worker at a time
+                    (default is 1000)
+       overwrite -- if the output file already exists, should it be
+                    overwritten? (default is False)
+
+    Returns the number of molecules written.
+
+    The file is split into records, which are parsed and matched in the
+    worker processes (see smartslib.filterrecords()), so nothing needs to
+    be pickled apart from the text of the records and patterns. The text
+    of the records that are kept is written as it is, in the same order
+    as in the input file (see recordio.writerecords()). A ValueError that
+    gives the title of the record is raised if a record cannot be read.
+    """
+    library = SmartsLibrary([(x, x) for x in patterns]) # Check the patterns
+    records = smartslib.filterrecords(_filterchunk, _initfilter, format,
+                                      infile, library.names, mode,
+                                      nprocs, chunksize)
+    return recordio.writerecords(format, records, outfile, overwrite)
+
+class MoleculeFile(object):
+    """Random access to the molecules in a file.
+
+    Required parameters:
+       format - "sdf" or "smi" (see recordio.recordformats)
+       filename
+
+    Optional parameters:
+       save -- store the index of the records next to the file, so that
+               it does not need to be built again (default is True)
+
+    A MoleculeFile supports len(), indexing and slicing. Molecule i is read
+    directly from its position in the file, without parsing the molecules
+    before it. See recordio.RecordIndex for details of the index.
+
+    Example:
+    >>> molfile = MoleculeFile("sdf", "head.sdf")
+    >>> len(molfile)
+    2
+    >>> print molfile[-1].title
+    NSC 2
+    """
+    def __init__(self, format, filename, save=True):
+        if format not in recordio.recordformats:
+            raise ValueError, "%s is not a recognised format for a MoleculeFile" % format
+        self.format = format
+        self.filename = filename
+        self.index = recordio.RecordIndex(format, filename, save)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [_readrecord(self.format, x) for x in self.index[i]]
+        return _readrecord(self.format, self.index[i])
+
+    def close(self):
+        """Close the underlying file."""
+        self.index.close()
+
+_bondtypes = {1: Chem.BondType.SINGLE, 2: Chem.BondType.DOUBLE,
+              3: Chem.BondType.TRIPLE}
+_chiraltags = {Chem.ChiralType.CHI_TETRAHEDRAL_CW: True,
+               Chem.ChiralType.CHI_TETRAHEDRAL_CCW: False}
+_cistrans = {Chem.BondStereo.STEREOZ: True, Chem.BondStereo.STEREOE: False}
+_setcistrans = {} # Stereo relative to the stereo atoms is not available
+if hasattr(Chem.BondStereo, "STEREOCIS"):
+    _setcistrans = {True: Chem.BondStereo.STEREOCIS,
+                    False: Chem.BondStereo.STEREOTRANS}
+    _cistrans[Chem.BondStereo.STEREOCIS] = True
+    _cistrans[Chem.BondStereo.STEREOTRANS] = False
+
+def _fromgraph(graph):
+    """Return an RDKit Mol built from a MolGraph"""
+    mol = Chem.RWMol()
+    for atomicnum, charge, isotope, hcount, aromatic in graph.atoms:
+        atom = Chem.Atom(atomicnum)
+        atom.SetFormalCharge(charge)
+        atom.SetIsotope(isotope)
+        atom.SetNumExplicitHs(hcount)
+        atom.SetNoImplicit(True)
+        mol.AddAtom(atom)
+    for begin, end, order, aromatic in graph.bonds:
+        mol.AddBond(begin, end, _bondtypes[order])
+    if graph.coords:
+        conformer = Chem.Conformer(len(graph.atoms))
+        for i, (x, y, z) in enumerate(graph.coords):
+            conformer.SetAtomPosition(i, rdkit.Geometry.Point3D(x, y, z))
+        conformer.Set3D(graph.dim == 3)
+        mol.AddConformer(conformer)
+    for centre, refs, clockwise in graph.tetrahedral:
+        atom = mol.GetAtomWithIdx(centre)
+        # An implicit hydrogen counts as the last neighbour
+        order = [bond.GetOtherAtomIdx(centre) for bond in atom.GetBonds()]
+        order += [None] * (4 - len(order))
+        if molgraph.reorder(refs, clockwise, order):
+            atom.SetChiralTag(Chem.ChiralType.CHI_TETRAHEDRAL_CW)
+        else:
+            atom.SetChiralTag(Chem.ChiralType.CHI_TETRAHEDRAL_CCW)
+    for begin, end, first, second, cis in graph.cistrans:
+        if not _setcistrans:
+            break
+        bond = mol.GetBondBetweenAtoms(begin, end)
+        if bond.GetBeginAtomIdx() != begin:
+            first, second = second, first
+        bond.SetStereoAtoms(first, second)
+        bond.SetStereo(_setcistrans[cis])
+    mol = mol.GetMol()
+    mol.SetProp("_Name", graph.title)
+    try:
+        Chem.SanitizeMol(mol)
+    except ValueError, e:
+        raise IOError, "Failed to convert %r to an RDKit Mol (%s)" % (graph, e)
+    if graph.dim == 3 and not (graph.tetrahedral or graph.cistrans):
+        # Perceive the stereo from the coordinates, as the MOL reader does
+        Chem.AssignAtomChiralTagsFromStructure(mol)
+        Chem.DetectBondStereochemistry(mol)
+    elif graph.cistrans and _setcistrans:
+        # Set the bond directions, so that the cis/trans stereo is kept by
+        # cleanIt below and by later changes such as addh() and removeh()
+        Chem.SetDoubleBondNeighborDirections(mol)
+    Chem.AssignStereochemistry(mol, cleanIt=True, force=True)
+    return mol
+
+def fromgraph(molecule):
+    """Copy a molecule of another Cinfony module through a MolGraph.
+
+    Required parameters:
+       molecule -- a Molecule of any Cinfony module with a _graph
+                   attribute (pybel, rdk or cdk), or a MolGraph
+
+    Unlike the Molecule constructor, which writes and reads a SMILES
+    string or MOL block, this keeps the order of the atoms, the hydrogen
+    counts, the exact coordinates, the stereochemistry and the title (see
+    the molgraph module). It is slower, as each atom and bond is copied
+    by a separate call.
+    """
+    if not isinstance(molecule, molgraph.MolGraph):
+        molecule = molecule._graph
+    return Molecule(_fromgraph(molecule))
 
 class Molecule(object):
     """Represent an rdkit Molecule.
@@ -183,15 +610,31 @@ class Molecule(object):
        Mol -- an RDKit Mol or any type of cinfony Molecule
       
     Attributes:
-       atoms, data, molwt, title
+       atoms, coords, data, molwt, title
     
     Methods:
-       addh(), calcfp(), calcdesc(), draw(), localopt(), make3D(), removeh(),
-       write() 
+       addh(), atomtable(), bondtable(), calcfp(), calcdesc(), draw(),
+       localopt(), make3D(), removeh(), setcoords(), write() 
+
+    The values of atoms and molwt, and the results of calcfp() and
+    calcdesc(), are cached. The cache is cleared by addh(), removeh(),
+    make3D(), localopt(), draw(update=True) and by setting the title.
+    If you change the Mol directly, create a new Molecule from it.
+
+    Molecules, Atoms and MoleculeData use __slots__ to save memory when
+    many of them are held at once, so other attributes cannot be added
+    to them. The data attribute returns the same MoleculeData each time.
+      
+    A Molecule of another Cinfony module is copied by writing and reading
+    a SMILES string or MOL block. This is the fastest way to convert, but
+    it is lossy: the atoms may be reordered, coordinates are rounded or
+    lost, stereochemistry may be dropped and the title may not survive.
+    fromgraph() is the lossless way to convert (see its docstring).
       
     The underlying RDKit Mol can be accessed using the attribute:
        Mol
     """
+    __slots__ = ("Mol", "_cache", "_data")
     _cinfony = True
     
     def __init__(self, Mol):
@@ -204,35 +647,190 @@ class Molecule(object):
             Mol = molecule.Mol
             
         self.Mol = Mol
+        self._cache = None # Created when first needed
+        self._data = None
 
+    def _cached(self, key, function, *args):
+        """Return the cached value for key, calculating it if necessary"""
+        if self._cache is None:
+            self._cache = {}
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = function(*args)
+            return value
+
+    def _invalidate(self):
+        """Clear the cache, as the molecule has changed"""
+        self._cache = None
+
+    def __getstate__(self):
+        return self.Mol # The cache holds Atoms, which cannot be pickled
+    def __setstate__(self, state):
+        self.Mol = state
+        self._cache = self._data = None
+
+    def _getatoms(self): return [Atom(rdkatom) for rdkatom in self.Mol.GetAtoms()]
     @property
-    def atoms(self): return [Atom(rdkatom) for rdkatom in self.Mol.GetAtoms()]
+    def atoms(self): return list(self._cached("atoms", self._getatoms))
+    def _getcoords(self):
+        _checknumpy()
+        if self.Mol.GetNumConformers() == 0:
+            raise AttributeError, "Molecule has no coordinates (0D structure)"
+        conformer = self.Mol.GetConformer()
+        if hasattr(conformer, "GetPositions"):
+            return numpy.array(conformer.GetPositions(), dtype=numpy.float64)
+        positions = [conformer.GetAtomPosition(i)
+                     for i in range(self.Mol.GetNumAtoms())]
+        return numpy.array([(p.x, p.y, p.z) for p in positions],
+                           dtype=numpy.float64).reshape(-1, 3)
+    def _setcoords(self, coords): self.setcoords(coords)
+    coords = property(_getcoords, _setcoords)
     @property
-    def data(self): return MoleculeData(self.Mol)
+    def data(self):
+        if self._data is None or self._data._mol is not self.Mol:
+            self._data = MoleculeData(self.Mol)
+        return self._data
     @property
-    def molwt(self): return descDict['MolWt'](self.Mol)
+    def molwt(self): return self._cached("molwt", descDict['MolWt'], self.Mol)
     def _gettitle(self):
         # Note to self: maybe should implement the get() method for self.data
         if "_Name" in self.data:
             return self.data["_Name"]
         else:
             return ""
-    def _settitle(self, val): self.Mol.SetProp("_Name", val)
+    def _settitle(self, val):
+        self.Mol.SetProp("_Name", val)
+        self._invalidate()
     title = property(_gettitle, _settitle)
     @property
+    def _graph(self):
+        mol = Chem.Mol(self.Mol)
+        Chem.Kekulize(mol)
+        # Each atom and bond is visited once, as the iterators are slow
+        atoms, tetrahedral = [], []
+        for atom in mol.GetAtoms():
+            atoms.append((atom.GetAtomicNum(), atom.GetFormalCharge(),
+                          atom.GetIsotope(), atom.GetTotalNumHs(),
+                          atom.GetIsAromatic()))
+            clockwise = _chiraltags.get(atom.GetChiralTag())
+            if clockwise is not None:
+                centre = atom.GetIdx()
+                refs = [bond.GetOtherAtomIdx(centre)
+                        for bond in atom.GetBonds()]
+                refs += [None] * (4 - len(refs))
+                tetrahedral.append((centre, tuple(refs), clockwise))
+        bonds, cistrans = [], []
+        for bond in mol.GetBonds():
+            begin, end = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
+            bonds.append((begin, end, int(bond.GetBondTypeAsDouble()),
+                          bond.GetIsAromatic()))
+            cis = _cistrans.get(bond.GetStereo())
+            if cis is not None:
+                first, second = bond.GetStereoAtoms()
+                cistrans.append((begin, end, first, second, cis))
+        coords, dim = None, 0
+        if mol.GetNumConformers() > 0:
+            conformer = mol.GetConformer()
+            coords = [tuple(conformer.GetAtomPosition(i))
+                      for i in range(mol.GetNumAtoms())]
+            dim = conformer.Is3D() and 3 or 2
+        title = ""
+        if mol.HasProp("_Name"):
+            title = mol.GetProp("_Name")
+        return molgraph.MolGraph(atoms, bonds, coords, dim, tetrahedral,
+                                 cistrans, title)
+    @property
     def _exchange(self):
         if self.Mol.GetNumConformers() == 0:
             return (0, self.write("iso"))
         else:
             return (1, self.write("mol"))
 
+    def setcoords(self, coords):
+        """Set the coordinates of all of the atoms.
+
+        Required parameters:
+           coords -- an (n x 3) array or list, in the same order as the
+                     atoms attribute
+
+        The coords attribute returns the current coordinates as an
+        (n x 3) NumPy array of type float64, and can also be assigned
+        to. If the molecule has no coordinates, a conformer is added.
+        NumPy is required.
+        """
+        _checknumpy()
+        coords = numpy.asarray(coords, dtype=numpy.float64)
+        n = self.Mol.GetNumAtoms()
+        if coords.shape != (n, 3):
+            raise ValueError, ("Expected coordinates of shape (%d, 3) but got %s"
+                               % (n, coords.shape))
+        if self.Mol.GetNumConformers() == 0:
+            self.Mol.AddConformer(Chem.Conformer(n), assignId=True)
+        conformer = self.Mol.GetConformer()
+        if hasattr(conformer, "SetPositions"):
+            conformer.SetPositions(coords)
+        else:
+            for i, (x, y, z) in enumerate(coords.tolist()):
+                conformer.SetAtomPosition(i, rdkit.Geometry.Point3D(x, y, z))
+        self._invalidate()
+
+    def atomtable(self):
+        """Return the properties of the atoms as NumPy arrays.
+
+        Returns a dictionary with the keys atomicnum, formalcharge,
+        isotope, hyb, partialcharge and coords, each with one row per atom
+        in the same order as the atoms attribute (see
+        desctable.atomcolumns()). No Atom objects are created. NumPy is
+        required.
+
+        The hybridisation uses the same codes as Open Babel (1 for sp,
+        2 for sp2, 3 for sp3, 5 for sp3d, 6 for sp3d2 and 0 otherwise).
+        The partial charges are Gasteiger charges, calculated on a copy so
+        that the Mol is unchanged. If the molecule has no coordinates,
+        they are all zero.
+        """
+        mol = Chem.Mol(self.Mol)
+        AllChem.ComputeGasteigerCharges(mol)
+        conformer = None
+        if mol.GetNumConformers() > 0:
+            conformer = mol.GetConformer()
+        rows = []
+        for atom in mol.GetAtoms():
+            if conformer:
+                position = conformer.GetAtomPosition(atom.GetIdx())
+                coords = (position.x, position.y, position.z)
+            else:
+                coords = (0., 0., 0.)
+            rows.append((atom.GetAtomicNum(), atom.GetFormalCharge(),
+                         atom.GetIsotope(),
+                         _hybridisations.get(str(atom.GetHybridization()), 0),
+                         float(atom.GetProp("_GasteigerCharge"))) + coords)
+        return desctable.atomcolumns(rows)
+
+    def bondtable(self):
+        """Return the bonds as NumPy arrays.
+
+        Returns a dictionary with the keys begin and end (the indices of
+        the atoms, starting from 0, in the same order as the atoms
+        attribute) and order (1.5 for aromatic bonds), with one row per
+        bond. The adjacency of the atoms is included in compressed sparse
+        row format (see desctable.bondcolumns()). NumPy is required.
+        """
+        rows = [(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx(),
+                 bond.GetBondTypeAsDouble())
+                for bond in self.Mol.GetBonds()]
+        return desctable.bondcolumns(self.Mol.GetNumAtoms(), rows)
+
     def addh(self):
         """Add hydrogens."""
         self.Mol = Chem.AddHs(self.Mol)
+        self._invalidate()
         
     def removeh(self):
         """Remove hydrogens."""
         self.Mol = Chem.RemoveHs(self.Mol)
+        self._invalidate()
         
     def write(self, format="smi", filename=None, overwrite=False):
         """Write the molecule to a file or return a string.
@@ -291,14 +889,17 @@ class Molecule(object):
         """
         if not descnames:
             descnames = descs
-        ans = {}
         for descname in descnames:
-            try:
-                desc = descDict[descname]
-            except KeyError:
+            if descname not in descDict:
                 raise ValueError, "%s is not a recognised RDKit descriptor type" % descname
-            ans[descname] = desc(self.Mol)
-        return ans
+        if self._cache is None:
+            self._cache = {}
+        missing = [x for x in descnames if ("desc", x) not in self._cache]
+        if missing:
+            row = _calcplan(_plandescs(missing), self.Mol, len(missing))
+            for descname, value in zip(missing, row):
+                self._cache["desc", descname] = value
+        return dict([(x, self._cache["desc", x]) for x in descnames])
 
     def calcfp(self, fptype="rdkit"):
         """Calculate a molecular fingerprint.
@@ -309,10 +910,17 @@ class Molecule(object):
                      types.
         """
         fptype = fptype.lower()
+        if fptype not in fps:
+            raise ValueError, "%s is not a recognised RDKit Fingerprint type" % fptype
+        return self._cached(("fp", fptype), self._calcfp, fptype)
+
+    def _calcfp(self, fptype):
         if fptype=="rdkit":
             fp = Fingerprint(Chem.RDKFingerprint(self.Mol))
         elif fptype=="layered":
             fp = Fingerprint(Chem.LayeredFingerprint(self.Mol))            
+        elif fptype=="pattern":
+            fp = Fingerprint(Chem.PatternFingerprint(self.Mol))
         elif fptype=="maccs":
             fp = Fingerprint(Chem.MACCSkeys.GenMACCSKeys(self.Mol))
         elif fptype=="atompairs":
@@ -321,8 +929,6 @@ class Molecule(object):
         elif fptype=="torsions":
             # Going to leave as-is.
             fp = Chem.AtomPairs.Torsions.GetTopologicalTorsionFingerprintAsIntVect(self.Mol)
-        else:
-            raise ValueError, "%s is not a recognised RDKit Fingerprint type" % fptype
         return fp
 
     def draw(self, show=True, filename=None, update=False, usecoords=False):
@@ -345,6 +951,7 @@ class Molecule(object):
         else:
             if update:
                 AllChem.Compute2DCoords(self.Mol)
+                self._invalidate()
                 confId = 0
             else:
                 confId = self.Mol.GetNumConformers()
@@ -401,6 +1008,7 @@ class Molecule(object):
         if self.Mol.GetNumConformers() == 0:
             self.make3D(forcefield)
         _forcefields[forcefield](self.Mol, maxIters = steps)
+        self._invalidate()
 
     def make3D(self, forcefield = "uff", steps = 50):
         """Generate 3D coordinates.
@@ -422,6 +1030,7 @@ class Molecule(object):
                                             useRandomCoords = True)
             if success == -1:
                 raise Error, "Embedding failed!"
+        self._invalidate()
         self.localopt(forcefield, steps)
         
 class Atom(object):
@@ -436,7 +1045,8 @@ class Atom(object):
     The original RDKit Atom can be accessed using the attribute:
        Atom
     """
-    
+    __slots__ = ("Atom",)
+
     def __init__(self, Atom):
         self.Atom = Atom
     @property
@@ -466,13 +1076,15 @@ class Smarts(object):
        smartspattern
     
     Methods:
-       findall(molecule)
+       findall(molecule, maxmatches=None), match(molecule)
     
     Example:
     >>> mol = readstring("smi","CCN(CC)CC") # triethylamine
     >>> smarts = Smarts("[#6][#6]") # Matches an ethyl group
     >>> print smarts.findall(mol) 
     [(0, 1), (3, 4), (5, 6)]
+    >>> smarts.match(mol)
+    True
 
     The numbers returned are the indices (starting from 0) of the atoms
     that match the SMARTS pattern. In this case, there are three matches
@@ -484,13 +1096,105 @@ class Smarts(object):
         if not self.rdksmarts:
             raise IOError, "Invalid SMARTS pattern."
 
-    def findall(self,molecule):
+    def findall(self,molecule,maxmatches=None):
         """Find all matches of the SMARTS pattern to a particular molecule.
         
         Required parameters:
            molecule
+
+        Optional parameters:
+           maxmatches -- the maximum number of matches to return (default
+                         is None, which returns all of them, up to the
+                         RDKit's own limit of 1000)
+
+        The search stops once maxmatches matches have been found.
+        """
+        if maxmatches is None:
+            return molecule.Mol.GetSubstructMatches(self.rdksmarts)
+        return molecule.Mol.GetSubstructMatches(self.rdksmarts,
+                                                maxMatches=maxmatches)
+
+    def match(self,molecule):
+        """Does a SMARTS pattern match a particular molecule?
+
+        Required parameters:
+           molecule
+
+        The search stops at the first match.
+        """
+        return molecule.Mol.HasSubstructMatch(self.rdksmarts)
+
+class SmartsLibrary(object):
+    """A set of named SMARTS patterns that are matched together
+
+    Required parameters:
+       patterns -- a list of (name, SMARTS pattern) pairs, or a dictionary
+                   (in which case the patterns are sorted by name)
+
+    Attributes:
+       names -- the names of the patterns, in the order of the columns
+                returned by match()
+       smarts -- the compiled Smarts, in the same order
+
+    Methods:
+       match(molecules), select(molecules, mode="any")
+
+    Each pattern is compiled once. Before a pattern is matched against a
+    molecule, its element and ring requirements are checked against
+    counts made once for the molecule (see smartslib), and most patterns
+    are never run. NumPy is required.
+
+    Example:
+    >>> library = SmartsLibrary([("amine", "N"), ("benzene", "c1ccccc1")])
+    >>> mols = [readstring("smi", "Nc1ccccc1"), readstring("smi", "CCN")]
+    >>> library.match(mols).tolist()
+    [[True, True], [True, False]]
+    """
+    def __init__(self, patterns):
+        if hasattr(patterns, "items"):
+            patterns = sorted(patterns.items())
+        self.names = [name for name, pattern in patterns]
+        self.smarts = [Smarts(pattern) for name, pattern in patterns]
+        self._screen = smartslib.Screen([pattern for name, pattern in patterns])
+
+    def _counts(self, molecule):
+        rings = molecule.Mol.GetRingInfo().NumRings()
+        if rdMolDescriptors:
+            formula = rdMolDescriptors.CalcMolFormula(molecule.Mol)
+            return smartslib.formulacounts(formula), rings
+        counts = {}
+        for atom in molecule.Mol.GetAtoms():
+            atomicnum = atom.GetAtomicNum()
+            counts[atomicnum] = counts.get(atomicnum, 0) + 1
+        return counts, rings
+
+    def _matches(self, i, molecule):
+        return self.smarts[i].match(molecule)
+
+    def match(self, molecules):
+        """Find which patterns match each molecule.
+
+        Required parameters:
+           molecules -- an iterable of Molecules
+
+        Returns a boolean NumPy array with one row per molecule and one
+        column per pattern.
         """
-        return molecule.Mol.GetSubstructMatches(self.rdksmarts)
+        return self._screen.hitmatrix(molecules, self._counts, self._matches)
+
+    def select(self, molecules, mode="any"):
+        """Find which molecules pass a filter on the patterns.
+
+        Required parameters:
+           molecules -- an iterable of Molecules
+
+        Optional parameters:
+           mode -- "any", "all" or "none" (see smartslib.Screen.select())
+
+        Returns a list of booleans, one per molecule.
+        """
+        return self._screen.select(molecules, self._counts, self._matches,
+                                   mode)
 
 class MoleculeData(object):
     """Store molecule data in a dictionary-type object
@@ -519,6 +1223,8 @@ class MoleculeData(object):
     >>> print len(data), data.keys(), data.has_key("NSC")
     1 ['Comment'] False
     """
+    __slots__ = ("_mol",)
+
     def __init__(self, Mol):
         self._mol = Mol
     def _testforkey(self, key):
@@ -593,15 +1299,13 @@ def _compressbits(bitvector, wordsize=32):
     >>> _compressbits([0, 1, 0, 0, 0, 1], 2)
     [2, 0, 2]
     """
-    ans = []
-    for start in range(0, len(bitvector), wordsize):
-        compressed = 0
-        for i in range(wordsize):
-            if i + start < len(bitvector) and bitvector[i + start]:
-                compressed += 2**i
-        ans.append(compressed)
-
-    return ans
+    if isinstance(bitvector, (list, tuple)):
+        text = "".join([x and "1" or "0" for x in bitvector])
+    else:
+        text = rdkit.DataStructs.BitVectToText(bitvector)
+    # Each word is parsed from its bits, most significant first
+    return [int(text[start:start + wordsize][::-1], 2)
+            for start in range(0, len(text), wordsize)]
             
 
 if __name__=="__main__": #pragma: no cover
@@ -0,0 +1,684 @@
+"""
+recordio - Toolkit-independent access to the records in chemical files
+
+The functions in this module work directly on the text of SDF and SMILES
+files, splitting them on record boundaries without using a cheminformatics
+toolkit. They are used by the Cinfony modules to hand records to worker
+processes, and to read the title and SD tags of a record without parsing
+the molecule (see LazyMolecule, itertags() and tagcolumns()).
+
+Files compressed with gzip, bzip2 or Zstandard (recognised by their
+extension) are decompressed on the fly. The Zstandard format requires the
+zstandard module.
+
+Global variables:
+  recordformats - a dictionary of the formats that can be split into records
+  compressions - a dictionary of the supported compressed file extensions
+"""
+
+import os
+import re
+import bz2
+import gzip
+import mmap
+import array
+import Queue
+import threading
+import collections
+import multiprocessing
+
+try:
+    import zstandard
+except ImportError: #pragma: no cover
+    zstandard = None
+
+recordformats = {'sdf': "MDL SDF", 'smi': "SMILES"}
+"""A dictionary of the formats that can be split into records"""
+compressions = {'.gz': "gzip", '.bz2': "bzip2", '.zst': "Zstandard"}
+"""A dictionary of the supported compressed file extensions"""
+
+_blocksize = 1 << 20 # Size of the blocks passed between threads
+
+def getcompression(filename):
+    """Return the compressed file extension of a filename, or None.
+
+    >>> getcompression("library.sdf.gz")
+    '.gz'
+    >>> print getcompression("library.sdf")
+    None
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in compressions:
+        return extension
+    return None
+
+def _opencompressed(filename, mode):
+    extension = getcompression(filename)
+    if extension == ".gz":
+        return gzip.GzipFile(filename, mode)
+    elif extension == ".bz2":
+        return bz2.BZ2File(filename, mode)
+    if not zstandard:
+        errormessage = ("The zstandard module was not found, but is required "
+                        "to read and write Zstandard files.")
+        raise ImportError(errormessage)
+    if mode == "rb":
+        return zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"))
+    else:
+        return zstandard.ZstdCompressor().stream_writer(open(filename, "wb"))
+
+def _readblocks(inputfile, blocks, stop):
+    """Read blocks from a file into a queue until the end or until stopped"""
+    try:
+        try:
+            while not stop.is_set():
+                block = inputfile.read(_blocksize)
+                blocks.put(block)
+                if not block:
+                    break
+        except Exception as ex:
+            blocks.put(ex)
+    finally:
+        inputfile.close()
+
+def iterlines(filename):
+    """Iterate over the lines of a compressed file.
+
+    Required parameters:
+       filename -- see the compressions variable for the supported
+                   extensions
+
+    The file is decompressed in a background thread, so that
+    decompression overlaps with the processing of the lines.
+    """
+    inputfile = _opencompressed(filename, "rb")
+    blocks = Queue.Queue(8)
+    stop = threading.Event()
+    thread = threading.Thread(target=_readblocks,
+                              args=(inputfile, blocks, stop))
+    thread.daemon = True
+    thread.start()
+    remainder = ""
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                break
+            lines = (remainder + block).split("\n")
+            remainder = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if remainder:
+            yield remainder
+    finally:
+        stop.set()
+        try:
+            blocks.get_nowait() # Unblock the thread if the queue is full
+        except Queue.Empty:
+            pass
+        thread.join()
+
+class _BackgroundWriter(object):
+    """A file-like object that compresses its output in a separate thread"""
+    def __init__(self, filename):
+        self._file = _opencompressed(filename, "wb")
+        self._queue = Queue.Queue(64)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                text = self._queue.get()
+                if text is None:
+                    break
+                if not self._error:
+                    try:
+                        self._file.write(text)
+                    except Exception as ex:
+                        self._error = ex # Keep emptying the queue
+        finally:
+            self._file.close()
+
+    def write(self, text):
+        if self._error:
+            raise self._error
+        self._queue.put(text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error:
+            raise self._error
+
+def openoutput(filename):
+    """Open a compressed file for writing.
+
+    Required parameters:
+       filename -- see the compressions variable for the supported
+                   extensions
+
+    The returned object has write() and close() methods. The text written
+    is compressed in a background thread.
+    """
+    return _BackgroundWriter(filename)
+
+def writerecords(format, records, filename, overwrite=False):
+    """Write the text of records to a file.
+
+    Required parameters:
+       format - "sdf" or "smi" (see the recordformats variable)
+       records -- an iterable of the text of records, such as those
+                  returned by iterrecords()
+       filename -- the output file, which is compressed if it ends in one
+                   of the extensions in the compressions variable
+
+    Optional parameters:
+       overwrite -- if the output file already exists, should it
+                    be overwritten? (default is False)
+
+    Returns the number of records written. The records are written as
+    they are, without being parsed, apart from adding the end of the
+    record if it is missing.
+    """
+    if format not in recordformats:
+        raise ValueError("%s is not a recognised record format" % format)
+    if not overwrite and os.path.isfile(filename):
+        raise IOError("%s already exists. Use 'overwrite=True' to overwrite it." % filename)
+    if getcompression(filename):
+        output = openoutput(filename)
+    else:
+        output = open(filename, "wb")
+    total = 0
+    try:
+        for record in records:
+            if not record.endswith("\n"):
+                record += "\n"
+            if format == "sdf" and not record.rstrip().endswith("$$$$"):
+                record += "$$$$\n"
+            output.write(record)
+            total += 1
+    finally:
+        output.close()
+    return total
+
+def _streamrecords(format, lines):
+    """Split an iterator over lines into records"""
+    if format == "smi":
+        for line in lines:
+            if line.strip():
+                yield line
+    else:
+        record = []
+        for line in lines:
+            record.append(line)
+            if line.rstrip() == "$$$$":
+                yield "".join(record)
+                record = []
+        if "".join(record).strip(): # Last record is missing its '$$$$'
+            yield "".join(record)
+
+def _checkfile(format, filename):
+    if format not in recordformats:
+        raise ValueError("%s is not a recognised record format" % format)
+    if not os.path.isfile(filename):
+        raise IOError("No such file: '%s'" % filename)
+
+def memorymap(filename):
+    """Return a read-only memory map of a file, or None if it is empty.
+
+    Slicing the map returns a string holding just that part of the file;
+    the rest of the file is paged in by the operating system as needed
+    rather than being read into memory.
+    """
+    inputfile = open(filename, "rb")
+    try:
+        if os.fstat(inputfile.fileno()).st_size == 0:
+            return None # An empty file cannot be mapped
+        return mmap.mmap(inputfile.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        inputfile.close()
+
+_nonblank = re.compile(r"\S")
+
+def _scanoffsets(format, data):
+    """Yield the start and end positions of each record in a string or map"""
+    size = len(data)
+    if format == "smi":
+        position = 0
+        while position < size:
+            end = data.find("\n", position)
+            if end == -1:
+                end = size
+            else:
+                end += 1
+            if _nonblank.search(data, position, end):
+                yield position, end
+            position = end
+    else:
+        start = position = 0
+        while True:
+            found = data.find("$$$$", position)
+            if found == -1:
+                break
+            position = found + 4
+            end = data.find("\n", position)
+            if end == -1:
+                end = size
+            else:
+                end += 1
+            if found > 0 and data[found - 1] != "\n":
+                continue # Not at the start of a line
+            if _nonblank.search(data, position, end):
+                continue # Not alone on its line
+            yield start, end
+            start = position = end
+        if _nonblank.search(data, start): # Last record is missing its '$$$$'
+            yield start, size
+
+def iterrecords(format, filename):
+    """Iterate over the text of the records in a file.
+
+    Required parameters:
+       format - see the recordformats variable for a list of available
+                formats
+       filename
+
+    Each record is returned as a string, including its line endings (and
+    for SDF, its terminating '$$$$' line), suitable for passing to
+    readstring(). Blank lines between SMILES records are skipped.
+
+    The file is memory-mapped and scanned for record boundaries in place,
+    so only one record at a time is copied into a string. Compressed files
+    are instead decompressed in a background thread (see iterlines()).
+    """
+    _checkfile(format, filename)
+    if getcompression(filename):
+        for record in _streamrecords(format, iterlines(filename)):
+            yield record
+        return
+    data = memorymap(filename)
+    if data is None:
+        return
+    try:
+        for start, end in _scanoffsets(format, data):
+            yield data[start:end]
+    finally:
+        data.close()
+
+def readtitle(format, record):
+    """Return the title of a record.
+
+    For SDF, this is the first line of the record; for SMILES, it is the
+    text after the SMILES string.
+
+    >>> readtitle("smi", "CCO ethanol\\n")
+    'ethanol'
+    """
+    if format == "smi":
+        fields = record.strip().split(None, 1)
+        if len(fields) < 2:
+            return ""
+        return fields[1]
+    end = record.find("\n")
+    if end == -1:
+        end = len(record)
+    return record[:end].rstrip("\r")
+
+def readtags(record):
+    """Return the SD tags of an SDF record as a dictionary.
+
+    The value of a tag is the text of the lines following its header line
+    up to the next blank line, joined by newlines.
+
+    >>> readtags("NSC 1\\n\\n\\nM  END\\n>  <NSC>\\n1\\n\\n$$$$\\n")
+    {'NSC': '1'}
+    """
+    tags = {}
+    start = record.find("M  END")
+    if start == -1:
+        return tags
+    name = None
+    for line in record[start:].splitlines()[1:]:
+        if name is None:
+            if line.startswith(">"):
+                begin = line.find("<")
+                end = line.find(">", begin + 1)
+                if begin != -1 and end != -1:
+                    name, values = line[begin + 1:end], []
+            elif line == "$$$$":
+                break
+        elif line.strip() and line != "$$$$":
+            values.append(line)
+        else:
+            tags[name] = "\n".join(values)
+            name = None
+            if line == "$$$$":
+                break
+    if name is not None:
+        tags[name] = "\n".join(values)
+    return tags
+
+def itertags(filename, tagnames):
+    """Iterate over the title and selected SD tags of the records in a file.
+
+    Required parameters:
+       filename -- an SDF file
+       tagnames -- a list of the names of SD tags
+
+    Yields a tuple for each record holding the title followed by the value
+    of each tag, or None where a record does not have that tag. No
+    molecules are built: for each record only the title line and the
+    lines after 'M  END' are read from the memory-mapped file, so the
+    scan runs at close to the speed of the disk.
+
+    >>> for row in itertags("head.sdf", ["NSC", "ID"]):
+    ...     print row
+    ('NSC 1', '1', None)
+    ('NSC 2', '2', None)
+    """
+    _checkfile("sdf", filename)
+    if getcompression(filename):
+        for record in _streamrecords("sdf", iterlines(filename)):
+            tags = readtags(record)
+            yield (readtitle("sdf", record),) + tuple([tags.get(name)
+                                                       for name in tagnames])
+        return
+    data = memorymap(filename)
+    if data is None:
+        return
+    try:
+        for start, end in _scanoffsets("sdf", data):
+            titleend = data.find("\n", start, end)
+            if titleend == -1:
+                titleend = end
+            tagstart = data.find("M  END", start, end)
+            if tagstart == -1:
+                tags = {}
+            else:
+                tags = readtags(data[tagstart:end])
+            yield (data[start:titleend].rstrip("\r"),) + tuple(
+                [tags.get(name) for name in tagnames])
+    finally:
+        data.close()
+
+def tagcolumns(filename, tagnames):
+    """Read the title and selected SD tags of the records in a file.
+
+    Required parameters:
+       filename -- an SDF file
+       tagnames -- a list of the names of SD tags
+
+    Returns a dictionary of lists with the keys title and the names of
+    the tags, with one entry per record (see itertags()).
+
+    >>> tagcolumns("head.sdf", ["NSC"])["NSC"]
+    ['1', '2']
+    """
+    columns = [[] for i in range(len(tagnames) + 1)]
+    appends = [column.append for column in columns]
+    for row in itertags(filename, tagnames):
+        for append, value in zip(appends, row):
+            append(value)
+    return dict(zip(["title"] + list(tagnames), columns))
+
+class LazyMolecule(object):
+    """A record whose molecule is only read when it is needed.
+
+    Required parameters:
+       format - "sdf" or "smi" (see the recordformats variable)
+       text -- the text of the record
+       readrecord -- a function that takes the format and the text and
+                     returns a Molecule. It must be defined at the top
+                     level of a module if the LazyMolecule is pickled.
+
+    Attributes:
+       format, text, title, data, molecule
+
+    The title and data (a dictionary of the SD tags, empty for SMILES)
+    are read from the text without a toolkit. The molecule is only read
+    the first time that it, or any other attribute or method of a
+    Molecule, is used. Any changes to the dictionary of SD tags are then
+    copied to the molecule, and from then on title and data are those of
+    the molecule.
+
+    This is what readfile() returns when lazy is True:
+    >>> mol = LazyMolecule("sdf", "NSC 1\\n\\n\\nM  END\\n>  <NSC>\\n1\\n\\n$$$$\\n",
+    ...                    None)
+    >>> print mol.title, mol.data["NSC"]
+    NSC 1 1
+    """
+    __slots__ = ("format", "text", "_readrecord", "_molecule", "_tags")
+    _cinfony = True
+
+    def __init__(self, format, text, readrecord):
+        self.format = format
+        self.text = text
+        self._readrecord = readrecord
+        self._molecule = None
+        self._tags = None
+
+    @property
+    def molecule(self):
+        if self._molecule is None:
+            molecule = self._readrecord(self.format, self.text)
+            if self._tags is not None:
+                self._copytags(molecule.data)
+            self._molecule = molecule
+            self._tags = None
+        return self._molecule
+
+    def _copytags(self, data):
+        """Copy changes to the SD tags to the data of the molecule"""
+        original = self._readtags()
+        for name in original:
+            if name not in self._tags and name in data:
+                del data[name]
+        for name, value in self._tags.iteritems():
+            if original.get(name) != value:
+                data[name] = value
+
+    def _readtags(self):
+        if self.format == "sdf":
+            return readtags(self.text)
+        return {}
+
+    @property
+    def data(self):
+        if self._molecule is not None:
+            return self._molecule.data
+        if self._tags is None:
+            self._tags = self._readtags()
+        return self._tags
+
+    def _gettitle(self):
+        if self._molecule is not None:
+            return self._molecule.title
+        return readtitle(self.format, self.text)
+    def _settitle(self, val):
+        self.molecule.title = val
+    title = property(_gettitle, _settitle)
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name in LazyMolecule.__slots__:
+            raise AttributeError(name)
+        return getattr(self.molecule, name)
+
+    def __setattr__(self, name, value):
+        if hasattr(LazyMolecule, name):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.molecule, name, value)
+
+    def __getstate__(self):
+        return (self.format, self.text, self._readrecord, self._molecule,
+                self._tags)
+    def __setstate__(self, state):
+        (self.format, self.text, self._readrecord, self._molecule,
+         self._tags) = state
+
+    def __iter__(self):
+        return iter(self.molecule)
+
+    def __str__(self):
+        return str(self.molecule)
+
+class RecordIndex(object):
+    """Random access to the text of the records in a file.
+
+    Required parameters:
+       format - see the recordformats variable
+       filename
+
+    Optional parameters:
+       save -- store the index in a file alongside the original, with
+               ".idx" appended to its name (default is True)
+
+    The index holds the position of each record in the file, so that
+    record i can be read without reading the ones before it. A saved
+    index is reused until the size or modification time of the file
+    changes. If the index file cannot be written, the index is kept in
+    memory only. Compressed files cannot be indexed.
+
+    Records are accessed by indexing or slicing:
+    >>> index = RecordIndex("sdf", "head.sdf", save=False)
+    >>> len(index)
+    2
+    >>> print index[-1].splitlines()[0]
+    NSC 2
+    """
+    def __init__(self, format, filename, save=True):
+        _checkfile(format, filename)
+        if getcompression(filename):
+            raise ValueError("Cannot index the compressed file '%s'" % filename)
+        self.format = format
+        self.filename = filename
+        self.indexname = filename + ".idx"
+        stat = os.stat(filename)
+        self._header = "cinfony-index %s %d %r %d\n" % (
+            format, stat.st_size, stat.st_mtime, array.array("l").itemsize)
+        self._offsets = None
+        if save:
+            self._offsets = self._loadindex()
+        if self._offsets is None:
+            self._offsets = self._buildindex()
+            if save:
+                self._saveindex()
+        self._data = memorymap(filename)
+
+    def _buildindex(self):
+        offsets = array.array("l")
+        data = memorymap(self.filename)
+        if data is not None:
+            try:
+                for start, end in _scanoffsets(self.format, data):
+                    offsets.append(start)
+                    offsets.append(end)
+            finally:
+                data.close()
+        return offsets
+
+    def _loadindex(self):
+        if not os.path.isfile(self.indexname):
+            return None
+        indexfile = open(self.indexname, "rb")
+        try:
+            if indexfile.readline() != self._header:
+                return None # Out of date
+            offsets = array.array("l")
+            offsets.fromstring(indexfile.read())
+        finally:
+            indexfile.close()
+        return offsets
+
+    def _saveindex(self):
+        try:
+            indexfile = open(self.indexname, "wb")
+            try:
+                indexfile.write(self._header)
+                indexfile.write(self._offsets.tostring())
+            finally:
+                indexfile.close()
+        except (IOError, OSError):
+            pass
+
+    def __len__(self):
+        return len(self._offsets) // 2
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[x] for x in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("record index out of range")
+        return self._data[self._offsets[2*i]:self._offsets[2*i + 1]]
+
+    def close(self):
+        """Close the underlying file."""
+        if self._data is not None:
+            self._data.close()
+
+def iterchunks(format, filename, chunksize=1000):
+    """Iterate over lists of records from a file.
+
+    Required parameters:
+       format - see the recordformats variable
+       filename
+
+    Optional parameters:
+       chunksize -- the number of records in each list (default is 1000)
+    """
+    chunk = []
+    for record in iterrecords(format, filename):
+        chunk.append(record)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def imapchunks(function, chunks, nprocs=None, initializer=None,
+               initargs=()):
+    """Apply a function to each chunk using a pool of worker processes.
+
+    Required parameters:
+       function -- a function defined at the top level of a module (so
+                   that it can be pickled)
+       chunks -- an iterable of arguments for the function
+
+    Optional parameters:
+       nprocs -- the number of worker processes (default is the number
+                 of CPUs)
+       initializer -- a function defined at the top level of a module,
+                      called with initargs once in each worker process
+                      before any chunks (default is None)
+       initargs -- a tuple of arguments for the initializer (default is
+                   an empty tuple)
+
+    The results are yielded in the same order as the chunks. Only a
+    couple of chunks per worker are sent to the pool at any one time, so
+    memory use does not grow with the size of the input.
+    """
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(nprocs, initializer, initargs)
+    pending = collections.deque()
+    try:
+        for chunk in chunks:
+            pending.append(pool.apply_async(function, (chunk,)))
+            if len(pending) >= 2 * nprocs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,303 @@
+"""
+smartslib - Toolkit-independent screening of SMARTS patterns
+
+The SmartsLibrary class of a Cinfony module matches many SMARTS patterns
+against many molecules. Before a pattern is matched, a Screen checks cheap
+requirements that any matching molecule must meet: the number of atoms of
+each element that the pattern names, and the number of rings implied by
+its ring closures. The counts for a molecule are found once, from its
+molecular formula (see formulacounts()), and compared against every
+pattern at the same time.
+
+The requirements are read from the text of the pattern, without a toolkit.
+They are conservative: atoms given as a list of alternatives (such as
+[C,N]), negated atoms, hydrogens and the atoms in recursive SMARTS add no
+requirement.
+
+The filterfile() function of a Cinfony module writes the molecules of a
+file that pass a filter on a set of patterns, using filterrecords() to
+match the records in a pool of worker processes.
+
+NumPy is required.
+"""
+
+import re
+
+import recordio
+
+try:
+    import numpy
+except ImportError: #pragma: no cover
+    numpy = None
+
+def _checknumpy():
+    if not numpy:
+        errormessage = ("NumPy not found, but is required for matching "
+                        "a SmartsLibrary. See installation instructions for "
+                        "more information.")
+        raise ImportError(errormessage)
+
+_symbols = ("H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca Sc Ti V Cr "
+            "Mn Fe Co Ni Cu Zn Ga Ge As Se Br Kr Rb Sr Y Zr Nb Mo Tc Ru Rh "
+            "Pd Ag Cd In Sn Sb Te I Xe Cs Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy "
+            "Ho Er Tm Yb Lu Hf Ta W Re Os Ir Pt Au Hg Tl Pb Bi Po At Rn Fr "
+            "Ra Ac Th Pa U Np Pu Am Cm Bk Cf Es Fm Md No Lr").split()
+
+atomicnumbers = dict([(symbol, i + 1) for i, symbol in enumerate(_symbols)])
+"""A dictionary of the atomic numbers of the element symbols"""
+
+_organic = {"Cl": 17, "Br": 35, "B": 5, "C": 6, "N": 7, "O": 8, "P": 15,
+            "S": 16, "F": 9, "I": 53, "b": 5, "c": 6, "n": 7, "o": 8,
+            "p": 15, "s": 16}
+_aromatic = {"se": 34, "as": 33, "te": 52, "b": 5, "c": 6, "n": 7, "o": 8,
+             "p": 15, "s": 16}
+# Letters that start a primitive, so that "Cr" might be C with ring size r
+_primitivestarts = "abcnoprsvxhd"
+_atomicnumber = re.compile(r"(?<!!)#(\d+)")
+_formulaelement = re.compile(r"([A-Z][a-z]?)(\d*)")
+_modes = ["any", "all", "none"]
+
+def _checkmode(mode):
+    if mode not in _modes:
+        raise ValueError("The mode must be one of %s, not '%s'" %
+                         (", ".join(_modes), mode))
+
+def _striprecursive(text):
+    """Remove the contents of any recursive SMARTS from a bracket atom"""
+    parts = []
+    depth = 0
+    for char in text:
+        if depth:
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+        elif char == "(":
+            depth = 1
+        else:
+            parts.append(char)
+    return "".join(parts)
+
+def _bracketelement(text):
+    """Return the atomic number required by a bracket atom, or None"""
+    text = _striprecursive(text)
+    if "," in text: # A list of alternatives
+        return None
+    text = text.lstrip("0123456789") # Isotope
+    if text[:2] in _aromatic:
+        return _aromatic[text[:2]]
+    if len(text) > 1 and text[:2] in atomicnumbers:
+        if text[:2] in ("Cl", "Br") or text[1] not in _primitivestarts:
+            return atomicnumbers[text[:2]]
+        return None # Ambiguous
+    if text[:1] in atomicnumbers and text[:1] != "H":
+        return atomicnumbers[text[:1]]
+    if text[:1] in _aromatic:
+        return _aromatic[text[:1]]
+    match = _atomicnumber.search(text)
+    if match and match.group(1) != "1":
+        return int(match.group(1))
+    return None
+
+def _closebracket(smarts, start):
+    """Return the position of the ']' closing the '[' at start"""
+    depth = 0
+    for i in range(start, len(smarts)):
+        if smarts[i] in "[(":
+            depth += 1
+        elif smarts[i] in "])":
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError("Unbalanced brackets in SMARTS pattern '%s'" % smarts)
+
+def requirements(smarts):
+    """Return the requirements of a SMARTS pattern.
+
+    Required parameters:
+       smarts -- a SMARTS pattern
+
+    Returns a dictionary of the minimum number of atoms of each element
+    (by atomic number) and the minimum number of rings, that is, the
+    number of bonds that must be broken to leave no cycles.
+
+    >>> requirements("c1ccccc1C(=O)[N;H1]")
+    ({8: 1, 6: 7, 7: 1}, 1)
+    >>> requirements("[C,N]C.[!#8]")
+    ({6: 1}, 0)
+    """
+    elements = {}
+    closures = 0
+    i = 0
+    while i < len(smarts):
+        char = smarts[i]
+        element = None
+        if char == "[":
+            end = _closebracket(smarts, i)
+            element = _bracketelement(smarts[i + 1:end])
+            i = end + 1
+        elif char == "%":
+            closures += 1
+            i += 3
+        elif char.isdigit():
+            closures += 1
+            i += 1
+        elif smarts[i:i + 2] in ("Cl", "Br"):
+            element = _organic[smarts[i:i + 2]]
+            i += 2
+        else:
+            element = _organic.get(char)
+            i += 1
+        if element:
+            elements[element] = elements.get(element, 0) + 1
+    rings = 0
+    if "." not in smarts: # A ring closure might join two components
+        rings = closures // 2
+    return elements, rings
+
+def formulacounts(formula):
+    """Return the number of atoms of each element in a molecular formula.
+
+    Required parameters:
+       formula -- a molecular formula such as 'C2H6O'
+
+    Returns a dictionary keyed by atomic number. Symbols that are not
+    elements (such as D for deuterium) are ignored.
+
+    >>> formulacounts("C6H5Cl")
+    {1: 5, 6: 6, 17: 1}
+    """
+    counts = {}
+    for symbol, number in _formulaelement.findall(formula):
+        if symbol in atomicnumbers:
+            atomicnum = atomicnumbers[symbol]
+            counts[atomicnum] = counts.get(atomicnum, 0) + int(number or 1)
+    return counts
+
+class Screen(object):
+    """Check the requirements of many SMARTS patterns at once.
+
+    Required parameters:
+       patterns -- a list of SMARTS patterns
+
+    Attributes:
+       elements -- the atomic numbers required by any of the patterns
+
+    Methods:
+       candidates(), hitmatrix(), select()
+    """
+    def __init__(self, patterns):
+        _checknumpy()
+        reqs = [requirements(pattern) for pattern in patterns]
+        self.elements = sorted(set([element for counts, rings in reqs
+                                    for element in counts]))
+        self._counts = numpy.zeros((len(reqs), len(self.elements)), int)
+        for i, (counts, rings) in enumerate(reqs):
+            for j, element in enumerate(self.elements):
+                self._counts[i, j] = counts.get(element, 0)
+        self._rings = numpy.array([rings for counts, rings in reqs], int)
+
+    def candidates(self, counts, rings):
+        """Return a boolean array of the patterns that might match.
+
+        Required parameters:
+           counts -- a dictionary of the number of atoms of each element
+           rings -- the number of rings (see requirements())
+        """
+        available = numpy.array([counts.get(x, 0) for x in self.elements],
+                                int)
+        return ((self._counts <= available).all(axis=1) &
+                (self._rings <= rings))
+
+    def hitmatrix(self, molecules, counts, matches):
+        """Match each molecule against the patterns that pass the screen.
+
+        Required parameters:
+           molecules -- an iterable of molecules
+           counts -- a function that takes a molecule and returns the
+                     counts and rings for candidates()
+           matches -- a function that takes the index of a pattern and a
+                      molecule, and returns True if the pattern matches
+
+        Returns a boolean array with one row per molecule and one column
+        per pattern.
+        """
+        rows = []
+        for molecule in molecules:
+            candidates = self.candidates(*counts(molecule))
+            row = [False] * len(candidates)
+            for i in numpy.flatnonzero(candidates).tolist():
+                row[i] = bool(matches(i, molecule))
+            rows.append(row)
+        return numpy.array(rows, bool).reshape(len(rows), len(self._rings))
+
+    def select(self, molecules, counts, matches, mode="any"):
+        """Find which molecules pass a filter on the patterns.
+
+        Required parameters:
+           molecules, counts, matches -- as for hitmatrix()
+
+        Optional parameters:
+           mode -- "any" keeps the molecules that match at least one of the
+                   patterns, "all" those that match every pattern and
+                   "none" those that match none of them (default is "any")
+
+        Returns a list of booleans, one per molecule. The patterns are
+        matched one at a time, stopping as soon as the answer is known.
+        """
+        _checkmode(mode)
+        selected = []
+        for molecule in molecules:
+            candidates = self.candidates(*counts(molecule))
+            if mode == "all":
+                keep = bool(candidates.all()) and all(
+                    matches(i, molecule) for i in range(len(candidates)))
+            else:
+                found = any(matches(i, molecule) for i in
+                            numpy.flatnonzero(candidates).tolist())
+                keep = found == (mode == "any")
+            selected.append(keep)
+        return selected
+
+def filterrecords(function, initializer, format, filename, patterns,
+                  mode="any", nprocs=None, chunksize=1000):
+    """Find the records of a file that pass a filter on SMARTS patterns.
+
+    Required parameters:
+       function -- a function defined at the top level of a module, that
+                   takes a tuple of (format, records) and returns a list
+                   of the records to keep
+       initializer -- a function defined at the top level of a module,
+                      that takes the patterns and mode and prepares
+                      function to match them
+       format - "sdf" or "smi" (see recordio.recordformats)
+       filename
+       patterns -- a list of SMARTS patterns
+
+    Optional parameters:
+       mode -- "any", "all" or "none" (see Screen.select())
+       nprocs -- the number of worker processes. If 1, the records are
+                 matched in this process; if None, the number of CPUs is
+                 used (default is None)
+       chunksize -- the number of records sent to a worker at a time
+                    (default is 1000)
+
+    Returns an iterator over the records that are kept, in the same order
+    as in the file. The patterns are sent to each worker once, as text,
+    and compiled there by the initializer; after that, only the records
+    are sent. Only a couple of chunks per worker are in memory at any one
+    time (see recordio.imapchunks()).
+    """
+    _checkmode(mode)
+    if format not in recordio.recordformats:
+        raise ValueError("%s is not a recognised record format" % format)
+    initargs = (list(patterns), mode)
+    chunks = ((format, records) for records in
+              recordio.iterchunks(format, filename, chunksize))
+    if nprocs == 1:
+        initializer(*initargs)
+        results = (function(chunk) for chunk in chunks)
+    else:
+        results = recordio.imapchunks(function, chunks, nprocs, initializer,
+                                      initargs)
+    return (record for records in results for record in records)
@@ -14,6 +14,8 @@ import os
 import urllib2
 import StringIO
 
+import fpsearch
+
 try:
     import Tkinter as tk
     import Image as PIL
@@ -110,6 +112,29 @@ def readstring(format, string):
             mol.title = string
         return mol
 
+def calcfps(molecules, fptype="std"):
+    """Calculate the fingerprints of a set of molecules.
+
+    Required parameters:
+       molecules -- an iterable of Molecules, such as readfile()
+
+    Optional parameters:
+       fptype -- the fingerprint type (default is "std"). See the
+                 fps variable for a list of of available fingerprint
+                 types.
+
+    Returns an fpsearch.FingerprintMatrix, which holds the fingerprints
+    packed into a NumPy array of 64-bit words with one row per molecule.
+    NumPy is required.
+    """
+    fptype = fptype.lower()
+    if fptype not in fps:
+        raise ValueError("%s is not a recognised Webel Fingerprint type" % fptype)
+    strings = [molecule.calcfp(fptype).fp for molecule in molecules]
+    nbits = strings and len(strings[0]) or 0
+    return fpsearch.FingerprintMatrix(fpsearch.packbitstrings(strings),
+                                      nbits, fptype)
+
 class Outputfile(object):
     """Represent a file to which *output* is to be sent.
    
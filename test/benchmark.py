@@ -0,0 +1,413 @@
+"""Timings for the Cinfony modules
+
+Usage: python benchmark.py [name...]
+
+Run from the test directory. Without any arguments all of the benchmarks
+are run. The input files are made by repeating the molecules in head.sdf.
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+obabel = rdk = cdk = None
+try:
+    from cinfony import obabel
+except (ImportError, AttributeError):
+    pass
+try:
+    from cinfony import rdk
+except ImportError:
+    pass
+try:
+    from cinfony import cdk
+except (ImportError, KeyError):
+    pass
+from cinfony import fpsearch
+from cinfony import recordio
+
+def makesdf(copies):
+    """Return the name of a temporary SDF file holding copies of head.sdf"""
+    text = open("head.sdf", "rb").read()
+    filedes, filename = tempfile.mkstemp(suffix=".sdf")
+    output = os.fdopen(filedes, "wb")
+    for i in range(copies):
+        output.write(text)
+    output.close()
+    return filename
+
+def timeit(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+def numatoms(mol):
+    # Used by benchmapfile(), so must be at the top level
+    return len(mol.atoms)
+
+def benchmapfile(copies=20000):
+    """Parsing with mapfile() using 1 to 16 worker processes"""
+    filename = makesdf(copies)
+    try:
+        serial = timeit(lambda: [numatoms(mol) for mol in
+                                 obabel.readfile("sdf", filename)])
+        print "readfile: %.2f s" % serial
+        for nprocs in [1, 2, 4, 8, 16]:
+            t = timeit(lambda: list(obabel.mapfile(numatoms, "sdf", filename,
+                                                   nprocs=nprocs)))
+            print "mapfile, %2d workers: %.2f s (x%.1f)" % (nprocs, t,
+                                                           serial / t)
+    finally:
+        os.remove(filename)
+
+def randomfps(n, nbits=1024):
+    """Return a FingerprintMatrix of random fingerprints
+
+    The fraction of bits set varies between fingerprints, from 0 to 0.5.
+    """
+    import numpy
+    density = numpy.random.random((n, 1)) * 0.5
+    bits = (numpy.random.random((n, nbits)) < density).astype(numpy.uint8)
+    return fpsearch.FingerprintMatrix(fpsearch._packbits(bits), nbits)
+
+def benchsearch(n=1000000, queries=10):
+    """Tanimoto searching of 1M 1024-bit fingerprints"""
+    fps = randomfps(n)
+    print "popcounts: %.2f s" % timeit(fps.popcounts)
+    for threshold, k in [(0.0, 10), (0.8, None)]:
+        t = timeit(lambda: [fpsearch.search(fps[i], fps, threshold, k)
+                            for i in range(queries)])
+        print "threshold %.1f, k %s: %.3f s per query" % (threshold, k,
+                                                          t / queries)
+    index = fpsearch.PopcountIndex(fps)
+    t = timeit(lambda: [index.search(fps[i], 0.8) for i in range(queries)])
+    print "PopcountIndex, threshold 0.8: %.3f s per query" % (t / queries)
+
+def oldfindbits(fp, bitsperint):
+    # The bit extraction previously used by pybel.Fingerprint.bits
+    ans = []
+    start = 1
+    for x in fp:
+        i = start
+        while x > 0:
+            if x % 2:
+                ans.append(i)
+            x >>= 1
+            i += 1
+        start += bitsperint
+    return ans
+
+def oldcompressbits(bitvector, wordsize=32):
+    # The compression previously used by rdk.Fingerprint.__str__
+    ans = []
+    for start in range(0, len(bitvector), wordsize):
+        compressed = 0
+        for i in range(wordsize):
+            if i + start < len(bitvector) and bitvector[i + start]:
+                compressed += 2**i
+        ans.append(compressed)
+    return ans
+
+def benchbits(repeats=2000):
+    """Extracting the bits of 1024-bit and 2048-bit fingerprints"""
+    import random
+    for nbits in [1024, 2048]:
+        words = [random.getrandbits(32) for i in range(nbits // 32)]
+        old = timeit(lambda: [oldfindbits(words, 32) for i in range(repeats)])
+        new = timeit(lambda: [fpsearch.findbits(words, 32, 1)
+                              for i in range(repeats)])
+        print "%d bits, findbits: %.1f us (was %.1f us)" % (
+            nbits, new * 1e6 / repeats, old * 1e6 / repeats)
+        bitvector = fpsearch.findbits(words, 32)
+        bitvector = [int(i in bitvector) for i in range(nbits)]
+        text = "".join(map(str, bitvector)) # As given by BitVectToText
+        old = timeit(lambda: [oldcompressbits(bitvector)
+                              for i in range(repeats)])
+        new = timeit(lambda: [[int(text[start:start + 32][::-1], 2)
+                               for start in range(0, nbits, 32)]
+                              for i in range(repeats)])
+        print "%d bits, compressbits: %.1f us (was %.1f us)" % (
+            nbits, new * 1e6 / repeats, old * 1e6 / repeats)
+
+def benchdescs(copies=50):
+    """All descriptors, calculated independently and with calcdescs()"""
+    filename = makesdf(copies)
+    try:
+        if rdk:
+            mols = list(rdk.readfile("sdf", filename))
+            names = rdk.descs
+            before = timeit(lambda: [[rdk.descDict[name](mol.Mol)
+                                      for name in names] for mol in mols])
+            after = timeit(lambda: rdk.calcdescs(mols, names))
+            print "rdk: %.1f mols/s (was %.1f mols/s)" % (len(mols) / after,
+                                                         len(mols) / before)
+        if cdk:
+            mols = list(cdk.readfile("sdf", filename))
+            before = timeit(lambda: [mol.calcdesc() for mol in mols])
+            after = timeit(lambda: cdk.calcdescs(mols))
+            print "cdk: %.1f mols/s (was %.1f mols/s)" % (len(mols) / after,
+                                                         len(mols) / before)
+    finally:
+        os.remove(filename)
+
+def oldmasses(mol):
+    # The masses previously calculated by cdk.Molecule, with explicit H
+    clone = cdk.Molecule(mol.Molecule.clone())
+    clone.addh()
+    manip = cdk.cdk.tools.manipulator.MolecularFormulaManipulator
+    atommanip = cdk.cdk.tools.manipulator.AtomContainerManipulator
+    mf = manip.getMolecularFormula(clone.Molecule)
+    return (atommanip.getNaturalExactMass(clone.Molecule),
+            manip.getMajorIsotopeMass(mf))
+
+def benchcdkmasses(copies=500):
+    """The molwt and exactmass of CDK Molecules"""
+    filename = makesdf(copies)
+    try:
+        mols = list(cdk.readfile("sdf", filename))
+        before = timeit(lambda: [oldmasses(mol) for mol in mols])
+        # A new Molecule for each, so that the values are not cached
+        after = timeit(lambda: [(x.molwt, x.exactmass) for x in
+                                [cdk.Molecule(mol.Molecule) for mol in mols]])
+        print "%.1f us per molecule (was %.1f us)" % (
+            after * 1e6 / len(mols), before * 1e6 / len(mols))
+    finally:
+        os.remove(filename)
+
+def rss():
+    """Return the resident memory of this process in MB (Linux only)"""
+    pages = int(open("/proc/self/statm").read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+_underlying = {"obabel": "OBMol", "rdk": "Mol", "cdk": "Molecule"}
+
+def getdata(mols):
+    return [mol.data for mol in mols]
+
+def benchmemory(n=1000000):
+    """The memory used by 1M Molecules and Atoms, with and without __slots__"""
+    for name in ["obabel", "rdk", "cdk"]:
+        toolkit = globals()[name]
+        if toolkit is None:
+            continue
+        mol = toolkit.readfile("sdf", "head.sdf").next()
+        attr = _underlying[name]
+        underlying = getattr(mol, attr)
+        atom = mol.atoms[0]
+        underlyingatom = getattr(atom, type(atom).__slots__[0])
+
+        class OldMolecule(toolkit.Molecule):
+            """A Molecule with a __dict__ and a cache, as before"""
+            def __init__(self, mol):
+                toolkit.Molecule.__init__(self, mol)
+                self._cache = {}
+            @property
+            def data(self):
+                return toolkit.MoleculeData(getattr(self, attr))
+        class OldAtom(toolkit.Atom):
+            """An Atom with a __dict__, as before"""
+
+        for label, molclass, atomclass in [("dict", OldMolecule, OldAtom),
+                                           ("slots", toolkit.Molecule,
+                                            toolkit.Atom)]:
+            start = rss()
+            mols = [molclass(underlying) for i in xrange(n)]
+            molsize = (rss() - start) * 1e6 / n
+            start = rss()
+            atoms = [atomclass(underlyingatom) for i in xrange(n)]
+            atomsize = (rss() - start) * 1e6 / n
+            t = timeit(getdata, mols)
+            print "%s, %s: %.0f bytes per Molecule, %.0f bytes per Atom, data %.2f s" % (
+                name, label, molsize, atomsize, t)
+            del mols, atoms
+
+def benchlazy(copies=20000):
+    """Selecting molecules by an SD tag, with and without lazy reading"""
+    filename = makesdf(copies)
+    try:
+        for name in ["obabel", "rdk", "cdk"]:
+            toolkit = globals()[name]
+            if toolkit is None:
+                continue
+            for lazy in [False, True]:
+                t = timeit(lambda: [mol for mol in
+                                    toolkit.readfile("sdf", filename, lazy)
+                                    if mol.data["NSC"] == "1"])
+                print "%s, lazy=%s: %.2f s" % (name, lazy, t)
+    finally:
+        os.remove(filename)
+
+def benchtags(copies=100000):
+    """Reading the titles and an SD tag from 200K records"""
+    filename = makesdf(copies)
+    try:
+        size = os.path.getsize(filename) / 1e6
+        t = timeit(recordio.tagcolumns, filename, ["NSC"])
+        print "tagcolumns: %.2f s (%.0f MB/s)" % (t, size / t)
+        t = timeit(lambda: [x for x in recordio.iterrecords("sdf", filename)])
+        print "iterrecords alone: %.2f s (%.0f MB/s)" % (t, size / t)
+    finally:
+        os.remove(filename)
+
+_functionalgroups = [
+    "[CX3](=O)[OX2H1]", "[CX3](=O)[OX2][#6]", "[CX3](=O)[NX3]", "[NX3;H2][#6]",
+    "[NX3;H1]([#6])[#6]", "[OX2H][CX4]", "[OX2H]c", "[SX2H]", "[CX3H1](=O)",
+    "[#6][CX3](=O)[#6]", "C#N", "[N+](=O)[O-]", "S(=O)(=O)N", "S(=O)(=O)[OH]",
+    "P(=O)(O)O", "[Cl,Br,I][CX4]", "c[F,Cl,Br,I]", "C=C", "C#C", "c1ccccc1",
+    "c1ccncc1", "c1ccc2ccccc2c1", "c1ccsc1", "c1ccoc1", "c1cc[nH]c1",
+    "C1CCCCC1", "C1CCNCC1", "C1COCCN1", "O=C1CCCN1", "[N;R][C;R](=O)",
+    "N=N", "[N-]=[N+]=N", "OO", "C(=O)Cl", "C=CC(=O)", "[SiX4]", "[B]",
+    "[Se]", "[Sn]", "[Hg]"]
+
+def benchsmartslibrary(copies=1000):
+    """40 SMARTS patterns matched one at a time and with a SmartsLibrary"""
+    filename = makesdf(copies)
+    try:
+        for name in ["obabel", "rdk", "cdk"]:
+            toolkit = globals()[name]
+            if toolkit is None:
+                continue
+            mols = list(toolkit.readfile("sdf", filename))
+            library = toolkit.SmartsLibrary(
+                [(str(i), x) for i, x in enumerate(_functionalgroups)])
+            before = timeit(lambda: [[len(smarts.findall(mol)) > 0
+                                      for smarts in library.smarts]
+                                     for mol in mols])
+            after = timeit(library.match, mols)
+            print "%s: %.2f s (was %.2f s)" % (name, after, before)
+    finally:
+        os.remove(filename)
+
+def benchfilter(copies=20000):
+    """Filter a file on 40 SMARTS patterns with 1 to 8 worker processes"""
+    filename = makesdf(copies)
+    filedes, outfile = tempfile.mkstemp(suffix=".sdf")
+    os.close(filedes)
+    try:
+        for name in ["obabel", "rdk", "cdk"]:
+            toolkit = globals()[name]
+            if toolkit is None:
+                continue
+            for mode in ["any", "none"]:
+                if name == "cdk": # Always matches in this process
+                    t = timeit(toolkit.filterfile, "sdf", filename, outfile,
+                               _functionalgroups, mode, True)
+                    print "%s, %s: %.2f s" % (name, mode, t)
+                    continue
+                for nprocs in [1, 2, 4, 8]:
+                    t = timeit(toolkit.filterfile, "sdf", filename, outfile,
+                               _functionalgroups, mode, nprocs, 1000, True)
+                    print "%s, %s, %d workers: %.2f s" % (name, mode,
+                                                          nprocs, t)
+    finally:
+        os.remove(filename)
+        os.remove(outfile)
+
+def benchsubstruct(copies=1000):
+    """Substructure search with and without a fingerprint screen"""
+    filename = makesdf(copies)
+    try:
+        for name in ["obabel", "rdk", "cdk"]:
+            toolkit = globals()[name]
+            if toolkit is None:
+                continue
+            mols = list(toolkit.readfile("sdf", filename))
+            fps = toolkit.calcfps(mols, toolkit.screenfps[0])
+            for query in ["SS", "C=O", "c1ccccc1", "[N+](=O)[O-]"]:
+                smarts = toolkit.Smarts(query)
+                before = timeit(lambda: [i for i, mol in enumerate(mols)
+                                         if smarts.findall(mol)])
+                after = timeit(toolkit.substructsearch, query, fps, mols)
+                touched = len(fpsearch.screen(
+                    toolkit.calcfps([toolkit.readstring("smi", query)],
+                                    fps.fptype), fps))
+                print "%s, %s: %.2f s (was %.2f s), %.0f%% matched" % (
+                    name, query, after, before, 100. * touched / len(mols))
+    finally:
+        os.remove(filename)
+
+_symmetric = [
+    ("C60", "c12c3c4c5c1c1c6c7c2c2c8c3c3c9c4c4c%10c5c5c1c1c6c6c%11c7c2c2c7"
+     "c8c3c3c8c9c4c4c9c%10c5c5c1c1c6c6c%11c2c2c7c3c3c8c4c4c9c5c1c1c6c2c3c41",
+     "[#6]~[#6]~[#6]~[#6]~[#6]~[#6]~[#6]~[#6]"),
+    ("tetra-tert-butylmethane", "CC(C)(C)C(C(C)(C)C)(C(C)(C)C)C(C)(C)C",
+     "CC(C)(C)CC(C)(C)C"),
+    ("cyclotriacontane", "C1" + "C" * 29 + "1", "C" * 12)]
+
+def benchmatch(repeats=100):
+    """SMARTS matching of symmetric molecules: all, one and any matches"""
+    for name in ["obabel", "rdk", "cdk"]:
+        toolkit = globals()[name]
+        if toolkit is None:
+            continue
+        for title, smiles, pattern in _symmetric:
+            mol = toolkit.readstring("smi", smiles)
+            smarts = toolkit.Smarts(pattern)
+            n = len(smarts.findall(mol))
+            findall = timeit(lambda: [smarts.findall(mol)
+                                      for i in range(repeats)])
+            first = timeit(lambda: [smarts.findall(mol, maxmatches=1)
+                                    for i in range(repeats)])
+            match = timeit(lambda: [smarts.match(mol) for i in range(repeats)])
+            print ("%s, %s (%d matches): findall %.4f s, maxmatches=1 %.4f s, "
+                   "match %.4f s" % (name, title, n, findall, first, match))
+
+def benchconvert(copies=1000):
+    """Copy molecules between toolkits through a MolGraph or as text"""
+    filename = makesdf(copies // 2)
+    try:
+        names = [x for x in ["obabel", "rdk", "cdk"] if globals()[x]]
+        for source in names:
+            mols = list(globals()[source].readfile("sdf", filename))
+            smiles = [globals()[source].readstring("smi", mol.write("smi"))
+                      for mol in mols]
+            for target in names:
+                if target == source:
+                    continue
+                toolkit = globals()[target]
+                for dim, data in [("3D", mols), ("0D", smiles)]:
+                    graph = timeit(lambda: [toolkit.fromgraph(mol)
+                                            for mol in data])
+                    text = timeit(lambda: [toolkit.Molecule(mol)
+                                           for mol in data])
+                    print "%s to %s, %s: %.2f s (was %.2f s as text)" % (
+                        source, target, dim, graph, text)
+    finally:
+        os.remove(filename)
+
+def benchneighbours(n=100000, threshold=0.8):
+    """All pairs of 100K 1024-bit fingerprints with 1 to 16 worker processes"""
+    fps = randomfps(n)
+    filedes, filename = tempfile.mkstemp(suffix=".pairs")
+    os.close(filedes)
+    try:
+        for nprocs in [1, 2, 4, 8, 16]:
+            t = timeit(lambda: fpsearch.neighbours(fps, threshold, filename,
+                                                   nprocs, overwrite=True))
+            print "neighbours, %2d workers: %.2f s" % (nprocs, t)
+        pairs = fpsearch.loadneighbours(filename)
+        print "%d pairs" % len(pairs)
+        t = timeit(lambda: fpsearch.butina(pairs, n))
+        print "butina: %.2f s" % t
+        t = timeit(lambda: fpsearch.butina(pairs, n, reordering=True))
+        print "butina, reordering: %.2f s" % t
+    finally:
+        os.remove(filename)
+
+if __name__=="__main__":
+    lookup = {'mapfile': benchmapfile, 'search': benchsearch, 'bits': benchbits,
+              'neighbours': benchneighbours, 'descs': benchdescs,
+              'cdkmasses': benchcdkmasses, 'memory': benchmemory,
+              'lazy': benchlazy, 'tags': benchtags,
+              'smartslibrary': benchsmartslibrary,
+              'substruct': benchsubstruct, 'match': benchmatch,
+              'filter': benchfilter, 'convert': benchconvert}
+
+    names = sorted(lookup.keys())
+    if len(sys.argv) > 1:
+        names = sys.argv[1:]
+
+    for name in names:
+        print "\n%s\n%s" % (lookup[name].__doc__, "== "*10)
+        lookup[name]()
@@ -1,5 +1,7 @@
 import pdb
 import os
+import pickle
+import tempfile
 import sys
 import unittest
 
@@ -17,6 +19,43 @@ try:
 except ImportError:
     pass
 from cinfony import webel
+from cinfony import recordio
+from cinfony import fpsearch
+from cinfony import desctable
+from cinfony import smartslib
+from cinfony import molgraph
+
+def numatoms(mol):
+    # Used by the tests of mapfile(), so must be at the top level
+    return len(mol.atoms)
+
+def descrows(descnames, molecules):
+    # Used by the tests of desctable.maprows(), so must be at the top level
+    return [[len(mol) * (i + 1) for i in range(len(descnames))]
+            for mol in molecules]
+
+class TagMolecule(object):
+    """A stand-in for a Molecule, for testing recordio.LazyMolecule"""
+    def __init__(self, record):
+        self.title = "parsed"
+        self.data = dict(recordio.readtags(record), Comment="comment")
+
+def readtagmolecule(format, record):
+    # Used by the tests of recordio.LazyMolecule, so must be at the top level
+    return TagMolecule(record)
+
+_keptitles = None
+
+def inittitles(titles, mode):
+    # Used by the tests of smartslib.filterrecords(), so must be at the top level
+    global _keptitles
+    _keptitles = titles
+
+def keeptitles(args):
+    # Used by the tests of smartslib.filterrecords(), so must be at the top level
+    format, records = args
+    return [record for record in records
+            if recordio.readtitle(format, record) in _keptitles]
 
 class myTestCase(unittest.TestCase):
     """Additional methods not present in Jython 2.2"""
@@ -73,6 +112,39 @@ class TestToolkit(myTestCase):
         t = r.split(", ")
         self.assertEqual(len(t), self.Nfpbits)
         
+    def testcalcfps(self):
+        """Pack the fingerprints of several molecules"""
+        fps = self.toolkit.calcfps(self.mols)
+        self.assertEqual(len(fps), 2)
+        bits = [set(fps.bits(i)) for i in range(len(fps))]
+        self.assertEqual(len(bits[0]), self.Nbits)
+        tanimoto = len(bits[0] & bits[1]) / float(len(bits[0] | bits[1]))
+        self.assertAlmostEqual(tanimoto, self.tanimotoresult, 3)
+        scores = fpsearch.tanimoto(fps[0], fps)
+        self.assertAlmostEqual(scores[1], self.tanimotoresult, 3)
+        self.assertRaises(ValueError, self.toolkit.calcfps, self.mols,
+                          "Nosuchname")
+
+    def testpackfingerprints(self):
+        """Pack the Fingerprints from calcfp()"""
+        fps = fpsearch.packfingerprints([mol.calcfp() for mol in self.mols])
+        self.assertEqual(len(fps), 2)
+        scores = fpsearch.tanimoto(fps[0], fps)
+        self.assertAlmostEqual(scores[1], self.tanimotoresult, 3)
+
+    def testfpdb(self):
+        """Store fingerprints in a file and search them"""
+        db = fpsearch.makedb("testoutput.fpdb", self.toolkit, self.mols)
+        self.assertEqual(len(db), 2)
+        self.assertEqual(db.fptype, self.toolkit.calcfps(self.mols).fptype)
+        query = self.toolkit.calcfps(self.mols[1:])
+        indices, scores = db.search(query, k=1)
+        self.assertEqual(indices.tolist(), [1])
+        self.assertRaises(IOError, fpsearch.makedb, "testoutput.fpdb",
+                          self.toolkit, self.mols)
+        del db, indices, scores # Release the memory map
+        os.remove("testoutput.fpdb")
+
     def testFPbits(self):
         """Test whether the bits are set correctly."""
         bits = [x.calcfp().bits for x in self.mols]
@@ -228,6 +300,17 @@ M  END
         os.remove("testoutput.txt")
         self.assertEqual(numdollar, 2)
 
+    def testcompressed(self):
+        """Write and read a gzipped SDF file"""
+        outputfile = self.toolkit.Outputfile("sdf", "testoutput.sdf.gz")
+        for mol in self.head:
+            outputfile.write(mol)
+        outputfile.close()
+        mols = list(self.toolkit.readfile("sdf", "testoutput.sdf.gz"))
+        os.remove("testoutput.sdf.gz")
+        self.assertEqual([len(x.atoms) for x in mols],
+                         [len(x.atoms) for x in self.head])
+
     def RFdesctest(self):
         # Should raise ValueError
         self.mols[0].calcdesc("BadDescName")
@@ -239,6 +322,22 @@ M  END
         self.assertAlmostEqual(desc[self.tpsaname], 26.02, 2)
         self.assertRaises(ValueError, self.RFdesctest)
 
+    def testcalcdescs(self):
+        """Calculate a table of descriptors"""
+        table = self.toolkit.calcdescs(self.mols, [self.tpsaname])
+        self.assertEqual(len(table[self.tpsaname]), 2)
+        self.assertAlmostEqual(table[self.tpsaname][1], 26.02, 2)
+        self.assertRaises(ValueError, self.toolkit.calcdescs, self.mols,
+                          ["BadDescName"])
+
+    def testcalcdescsnprocs(self):
+        """Calculate a table of descriptors using several processes"""
+        table = self.toolkit.calcdescs(self.head, nprocs=2, chunksize=1)
+        serial = self.toolkit.calcdescs(self.head)
+        self.assertEqual(sorted(table.keys()), sorted(serial.keys()))
+        for name in [self.tpsaname]:
+            self.assertEqual(list(table[name]), list(serial[name]))
+
     def MDaccesstest(self):
         # Should raise KeyError
         return self.head[0].data['noel']
@@ -299,6 +398,92 @@ M  END
         ans = smarts.findall(mol)
         self.assertEqual(len(ans), 3)
 
+    def testSMARTSmatch(self):
+        """Stop searching for ethyl groups once the answer is known"""
+        mol = self.toolkit.readstring("smi", "CCN(CC)CC")
+        smarts = self.toolkit.Smarts("[#6][#6]")
+        self.assertTrue(smarts.match(mol))
+        self.assertFalse(self.toolkit.Smarts("[#7][#7]").match(mol))
+        self.assertEqual(len(smarts.findall(mol, maxmatches=1)), 1)
+        self.assertEqual(len(smarts.findall(mol, maxmatches=5)), 3)
+        self.assertEqual(list(smarts.findall(mol, maxmatches=2)),
+                         list(smarts.findall(mol))[:2])
+
+    def testsubstructsearch(self):
+        """Substructure search with a fingerprint screen"""
+        fps = self.toolkit.calcfps(self.head, self.toolkit.screenfps[0])
+        search = self.toolkit.substructsearch
+        self.assertEqual(search("SS", fps, self.head), [1])
+        self.assertEqual(search("C=O", fps, self.head), [0])
+        self.assertEqual(search("CC", fps, self.head), [0])
+        self.assertEqual(search("Br", fps, self.head), [])
+        unknown = fpsearch.FingerprintMatrix(fps.words, fps.nbits)
+        self.assertRaises(ValueError, search, "C", unknown, self.head)
+
+    def testfilterfile(self):
+        """Write the molecules of a file that pass a SMARTS filter"""
+        filterfile = self.toolkit.filterfile
+        def titles():
+            return [mol.title for mol in
+                    self.toolkit.readfile("sdf", "testoutput.sdf")]
+        self.assertEqual(filterfile("sdf", "head.sdf", "testoutput.sdf",
+                                    ["SS", "Br"]), 1)
+        self.assertEqual(titles(), ["NSC 2"])
+        self.assertRaises(IOError, filterfile, "sdf", "head.sdf",
+                          "testoutput.sdf", ["SS"])
+        filterfile("sdf", "head.sdf", "testoutput.sdf", ["SS", "Br"],
+                   mode="none", overwrite=True)
+        self.assertEqual(titles(), ["NSC 1"])
+        filterfile("sdf", "head.sdf", "testoutput.sdf", ["C", "S"],
+                   mode="all", overwrite=True)
+        self.assertEqual(titles(), ["NSC 2"])
+        filterfile("sdf", "head.sdf", "testoutput.sdf", ["C"],
+                   mode="all", overwrite=True)
+        self.assertEqual(titles(), ["NSC 1", "NSC 2"])
+        self.assertRaises(ValueError, filterfile, "sdf", "head.sdf",
+                          "testoutput.sdf", ["C"], mode="some",
+                          overwrite=True)
+        badfile = open("testbad.sdf", "wb")
+        badfile.write(open("head.sdf", "rb").read())
+        badfile.write("NSC 3\nnot a molecule\n$$$$\n")
+        badfile.close()
+        for mode in ["any", "none"]:
+            try:
+                filterfile("sdf", "testbad.sdf", "testoutput.sdf", ["C"],
+                           mode=mode, overwrite=True)
+            except ValueError, e:
+                self.assertTrue("NSC 3" in str(e))
+            else:
+                self.fail("No ValueError for an unreadable record")
+        os.remove("testbad.sdf")
+        os.remove("testoutput.sdf")
+
+    def testSmartsLibrary(self):
+        """Match several SMARTS patterns against several molecules"""
+        library = self.toolkit.SmartsLibrary([("amine", "N"),
+                                              ("benzene", "c1ccccc1"),
+                                              ("halide", "[Cl,Br]")])
+        mols = [self.toolkit.readstring("smi", smiles)
+                for smiles in ["Nc1ccccc1", "CCN", "CCCl", "C1CCCCC1"]]
+        self.assertEqual(library.match(mols).tolist(),
+                         [[True, True, False], [True, False, False],
+                          [False, False, True], [False, False, False]])
+        self.assertEqual(library.match([]).shape, (0, 3))
+        library = self.toolkit.SmartsLibrary({"b": "C", "a": "N"})
+        self.assertEqual(library.names, ["a", "b"])
+
+    def testMoleculeFile(self):
+        """Random access to the molecules in a file"""
+        molfile = self.toolkit.MoleculeFile("sdf", "head.sdf", save=False)
+        self.assertEqual(len(molfile), 2)
+        self.assertEqual(len(molfile[1].atoms), len(self.head[1].atoms))
+        self.assertEqual([len(x.atoms) for x in molfile[::-1]],
+                         [len(x.atoms) for x in self.head[::-1]])
+        self.assertRaises(IndexError, molfile.__getitem__, 2)
+        molfile.close()
+        self.assertRaises(ValueError, self.toolkit.MoleculeFile,
+                          "noel", "head.sdf")
+
     def testAddh(self):
         """Adding and removing hydrogens"""
         self.assertEqual(len(self.mols[0].atoms),4)
@@ -306,6 +491,147 @@ M  END
         self.assertEqual(len(self.mols[0].atoms),14)
         self.mols[0].removeh()
         self.assertEqual(len(self.mols[0].atoms),4)
+
+    def testatomtable(self):
+        """The atom table matches the Atoms"""
+        mol = self.head[0]
+        table = mol.atomtable()
+        atoms = mol.atoms
+        self.assertEqual(table["atomicnum"].tolist(),
+                         [atom.atomicnum for atom in atoms])
+        self.assertEqual(table["formalcharge"].tolist(),
+                         [atom.formalcharge for atom in atoms])
+        self.assertEqual(len(table["partialcharge"]), len(atoms))
+        self.assertEqual(table["coords"].shape, (len(atoms), 3))
+        for coords, atom in zip(table["coords"], atoms):
+            for x, y in zip(coords, atom.coords):
+                self.assertAlmostEqual(x, y, 4)
+
+    def testatomtableisotopes(self):
+        """Only isotopes that have been set are given"""
+        mol = self.toolkit.readstring("smi", "CCO")
+        self.assertEqual(mol.atomtable()["isotope"].tolist(), [0, 0, 0])
+        self.assertEqual(mol.atomtable()["isotope"].tolist(), [0, 0, 0])
+        mol = self.toolkit.readstring("smi", "[13CH4]")
+        self.assertEqual(mol.atomtable()["isotope"].tolist(), [13])
+
+    def testbondtable(self):
+        """The bond table matches the adjacency"""
+        mol = self.head[0]
+        table = mol.bondtable()
+        natoms, nbonds = len(mol.atoms), len(table["begin"])
+        self.assertTrue(nbonds >= natoms - 1)
+        self.assertEqual(len(table["order"]), nbonds)
+        self.assertEqual(len(table["indptr"]), natoms + 1)
+        self.assertEqual(table["indptr"][-1], 2 * nbonds)
+        self.assertTrue(table["indices"].min() >= 0)
+        self.assertTrue(table["indices"].max() < natoms)
+        for i in range(natoms):
+            start, end = table["indptr"][i], table["indptr"][i + 1]
+            for j, bond in zip(table["indices"][start:end],
+                               table["bondindex"][start:end]):
+                self.assertEqual(sorted([table["begin"][bond],
+                                         table["end"][bond]]),
+                                 sorted([i, j]))
+        batch = desctable.graphbatch(self.head)
+        self.assertEqual(batch["atomoffsets"][1], natoms)
+        self.assertEqual(batch["bondoffsets"][1], nbonds)
+
+    def testcoords(self):
+        """Get and set all of the coordinates at once"""
+        mol = self.head[0]
+        coords = mol.coords
+        self.assertEqual(coords.shape, (len(mol.atoms), 3))
+        for row, atom in zip(coords, mol.atoms):
+            for x, y in zip(row, atom.coords):
+                self.assertAlmostEqual(x, y, 4)
+        mol.coords = coords + 1.0
+        self.assertAlmostEqual(mol.atoms[1].coords[2], coords[1][2] + 1.0, 4)
+        mol.setcoords(coords.tolist())
+        self.assertAlmostEqual(mol.atoms[1].coords[2], coords[1][2], 4)
+        self.assertRaises(ValueError, mol.setcoords, coords[1:])
+
+    def testcache(self):
+        """Cached values are recalculated after the molecule changes"""
+        mol = self.mols[0]
+        mol.atoms.pop() # A copy of the cached list
+        self.assertEqual(len(mol.atoms), 4)
+        self.assertAlmostEqual(mol.molwt, mol.molwt)
+        fp = mol.calcfp()
+        self.assertTrue(mol.calcfp() is fp)
+        desc = mol.calcdesc([self.tpsaname])
+        self.assertEqual(mol.calcdesc([self.tpsaname]), desc)
+        mol.addh()
+        self.assertEqual(len(mol.atoms), 14)
+        self.assertFalse(mol.calcfp() is fp)
+        fp = mol.calcfp()
+        mol.title = "butane"
+        self.assertFalse(mol.calcfp() is fp)
+        mol.removeh()
+        self.assertEqual(len(mol.atoms), 4)
+
+    def testslots(self):
+        """Molecules and Atoms have no __dict__"""
+        mol = self.head[0]
+        self.assertFalse(hasattr(mol, "__dict__"))
+        self.assertFalse(hasattr(mol.atoms[0], "__dict__"))
+        self.assertRaises(AttributeError, setattr, mol, "foo", 1)
+        self.assertTrue(mol.data is mol.data)
+        self.assertEqual(mol.data["NSC"], "1")
+
+    def testlazy(self):
+        """Read the title and SD tags without parsing the molecule"""
+        mols = list(self.toolkit.readfile("sdf", "head.sdf", lazy=True))
+        self.assertEqual(len(mols), 2)
+        mol = mols[0]
+        self.assertEqual(mol.title, "NSC 1")
+        self.assertEqual(mol.data["NSC"], "1")
+        mol.data["NSC"] = "one"
+        self.assertEqual(len(mol.atoms), len(self.head[0].atoms))
+        self.assertEqual(mol.data["NSC"], "one")
+        self.assertAlmostEqual(mol.molwt, self.head[0].molwt, 3)
+        self.assertRaises(ValueError, lambda: list(
+            self.toolkit.readfile("mol2", "head.sdf", lazy=True)))
+
+    def testgraph(self):
+        """Copy molecules between toolkits through a MolGraph"""
+        graph = self.toolkit.readstring("smi", "[13CH3][NH3+]")._graph
+        self.assertEqual([atom[:4] for atom in graph.atoms],
+                         [(6, 0, 13, 3), (7, 1, 0, 3)])
+        self.assertEqual(graph.bonds, [(0, 1, 1, False)])
+        self.assertEqual(graph.dim, 0)
+        mol = self.head[0]
+        atomicnums = [atom.atomicnum for atom in mol.atoms]
+        for toolkit in [obabel, rdk, cdk]:
+            if toolkit is None:
+                continue
+            copy = toolkit.fromgraph(mol)
+            self.assertEqual([atom.atomicnum for atom in copy.atoms],
+                             atomicnums)
+            self.assertEqual(copy.title, "NSC 1")
+            for atom, oldatom in zip(copy.atoms, mol.atoms):
+                for x, y in zip(atom.coords, oldatom.coords):
+                    self.assertAlmostEqual(x, y, 4)
+
+    def testgraphstereo(self):
+        """Stereochemistry survives copying and adding and removing H"""
+        for smiles in ["F[C@H](Cl)Br", "C/C=C/C", "C/C=C/[C@H](N)C(=O)O"]:
+            mol = self.toolkit.readstring("smi", smiles)
+            # A canonical SMILES string with stereochemistry
+            expected = mol._exchange
+            copies = [self.toolkit.Molecule(mol)]
+            for toolkit in [obabel, rdk]:
+                if toolkit is not None:
+                    copies.append(self.toolkit.fromgraph(
+                        toolkit.fromgraph(mol)))
+            for copy in copies:
+                self.assertEqual(copy._exchange, expected)
+                copy.addh()
+                copy.removeh()
+                self.assertEqual(copy._exchange, expected)
+        graph = self.toolkit.readstring("smi", "F[C@@H](Cl)Br")._graph
+        self.assertEqual(len(graph.tetrahedral), 1)
+        self.assertEqual(graph.cistrans, [])
         
 class TestOBabel(TestToolkit):
     toolkit = obabel
@@ -321,6 +647,46 @@ class TestOBabel(TestToolkit):
         fps = [x.calcfp("FP3") for x in self.mols]
         self.assertEqual(fps[0] | fps[1], 0.)
 
+    def testmapfile(self):
+        """Apply a function to a file using several processes"""
+        ans = list(self.toolkit.mapfile(numatoms, "sdf", "head.sdf",
+                                        nprocs=2, chunksize=1))
+        self.assertEqual(ans, [len(mol.atoms) for mol in self.head])
+        self.assertRaises(ValueError, list,
+                          self.toolkit.mapfile(numatoms, "noel", "head.sdf"))
+
+    def testpickle(self):
+        """Pickle a molecule"""
+        mol = pickle.loads(pickle.dumps(self.head[0]))
+        self.assertEqual(len(mol.atoms), self.Natoms)
+        self.assertEqual(mol.title, self.head[0].title)
+
+    def testcoordsnewatom(self):
+        """Set the coordinates after adding an atom"""
+        mol = self.head[0]
+        coords = mol.coords
+        mol.OBMol.NewAtom().SetAtomicNum(6)
+        mol = self.toolkit.Molecule(mol.OBMol)
+        newcoords = [list(row) for row in coords] + [[1.0, 2.0, 3.0]]
+        mol.setcoords(newcoords)
+        self.assertEqual(mol.coords.shape, (len(coords) + 1, 3))
+        for row, atom in zip(newcoords, mol.atoms):
+            for x, y in zip(row, atom.coords):
+                self.assertAlmostEqual(x, y, 4)
+        self.assertRaises(ValueError, mol.setcoords, coords)
+
+    def testcompressedformats(self):
+        """Only SDF and SMILES files can be compressed"""
+        self.assertRaises(ValueError, self.toolkit.Outputfile, "cml",
+                          "testoutput.cml.gz")
+        self.assertFalse(os.path.isfile("testoutput.cml.gz"))
+        outputfile = self.toolkit.Outputfile("sdf", "testoutput.sdf.gz")
+        outputfile.write(self.head[0])
+        outputfile.close()
+        self.assertRaises(ValueError, list,
+                          self.toolkit.readfile("cml", "testoutput.sdf.gz"))
+        os.remove("testoutput.sdf.gz")
+
     def testunitcell(self):
         """Testing unit cell access"""
         mol = self.toolkit.readfile("cif", "hashizume.cif").next()
@@ -361,6 +727,102 @@ class TestOBabel(TestToolkit):
         self.assertRaises(AttributeError, self.RSaccesstest)
 
 class TestJybel(TestOBabel):
+    def testcalcfps(self):
+        """No packed fingerprints"""
+        pass
+
+    def testpackfingerprints(self):
+        """No packed fingerprints"""
+        pass
+
+    def testfpdb(self):
+        """No fingerprint databases"""
+        pass
+
+    def testcompressed(self):
+        """No compressed files"""
+        pass
+
+    def testcompressedformats(self):
+        """No compressed files"""
+        pass
+
+    def testcoordsnewatom(self):
+        """No coordinate arrays"""
+        pass
+
+    def testMoleculeFile(self):
+        """No MoleculeFile"""
+        pass
+
+    def testmapfile(self):
+        """No mapfile()"""
+        pass
+
+    def testcalcdescs(self):
+        """No descriptor tables"""
+        pass
+
+    def testcache(self):
+        """No cache"""
+        pass
+
+    def testatomtable(self):
+        """No atom tables"""
+        pass
+
+    def testatomtableisotopes(self):
+        """No atom tables"""
+        pass
+
+    def testbondtable(self):
+        """No bond tables"""
+        pass
+
+    def testslots(self):
+        """No slots"""
+        pass
+
+    def testlazy(self):
+        """No lazy reading"""
+        pass
+
+    def testSmartsLibrary(self):
+        """No SMARTS libraries"""
+        pass
+
+    def testsubstructsearch(self):
+        """No substructure search"""
+        pass
+
+    def testSMARTSmatch(self):
+        """No early-exit SMARTS matching"""
+        pass
+
+    def testfilterfile(self):
+        """No filterfile()"""
+        pass
+
+    def testgraph(self):
+        """No MolGraph"""
+        pass
+
+    def testgraphstereo(self):
+        """No MolGraph"""
+        pass
+
+    def testcoords(self):
+        """No coordinate arrays"""
+        pass
+
+    def testcalcdescsnprocs(self):
+        """No descriptor tables"""
+        pass
+
+    def testpickle(self):
+        """No pickling"""
+        pass
+
     def testDrawdependencies(self):
         "No testing the draw dependencies"
         pass
@@ -385,6 +847,33 @@ class TestRDKit(TestToolkit):
         """No conversion to MOL2 done"""
         pass
 
+    def testplandescs(self):
+        """Shared calculations give the same descriptor values"""
+        table = rdk.calcdescs(self.mols)
+        for name in rdk.descs:
+            value = rdk.descDict[name](self.mols[1].Mol)
+            self.assertAlmostEqual(table[name][1], value, 6)
+
+    def testatomtablecopy(self):
+        """The Gasteiger charges are not stored on the Mol"""
+        mol = self.head[0]
+        charges = mol.atomtable()["partialcharge"]
+        self.assertEqual(len(charges), len(mol.atoms))
+        self.assertFalse([atom for atom in mol.Mol.GetAtoms()
+                          if atom.HasProp("_GasteigerCharge")])
+
+    def testcompressedclose(self):
+        """Closing a compressed Outputfile writes every molecule"""
+        outputfile = rdk.Outputfile("sdf", "testoutput.sdf.gz")
+        for i in range(25):
+            for mol in self.head:
+                outputfile.write(mol)
+        outputfile.close()
+        mols = list(rdk.readfile("sdf", "testoutput.sdf.gz"))
+        os.remove("testoutput.sdf.gz")
+        self.assertEqual(len(mols), 50)
+        self.assertEqual(mols[-1].title, "NSC 2")
+
 class TestWebel(TestToolkit):
     toolkit = webel
     tanimotoresult = 0.375
@@ -412,8 +901,42 @@ class TestWebel(TestToolkit):
         """Not testing atom repr"""
     def testAiteration(self):
         """Not testing the ability to iterate over the atoms"""
+    def testMoleculeFile(self):
+        """Not testing random access to files"""
+    def testcompressed(self):
+        """Not testing compressed files"""
+    def testcalcdescs(self):
+        """Not testing descriptor tables"""
+    def testcalcdescsnprocs(self):
+        """Not testing descriptor tables"""
     def testAddh(self):
         """Not testing adding/removing hydrogens"""
+    def testcache(self):
+        """Not testing the cache"""
+    def testatomtable(self):
+        """Not testing atom tables"""
+    def testatomtableisotopes(self):
+        """Not testing atom tables"""
+    def testbondtable(self):
+        """Not testing bond tables"""
+    def testslots(self):
+        """Not testing slots"""
+    def testlazy(self):
+        """Not testing lazy reading"""
+    def testSmartsLibrary(self):
+        """Not testing SMARTS libraries"""
+    def testsubstructsearch(self):
+        """Not testing substructure search"""
+    def testSMARTSmatch(self):
+        """Not testing findall with maxmatches"""
+    def testfilterfile(self):
+        """Not testing filterfile()"""
+    def testgraph(self):
+        """Not testing MolGraph"""
+    def testgraphstereo(self):
+        """Not testing MolGraph"""
+    def testcoords(self):
+        """Not testing coordinate arrays"""
     def testLocalOpt(self):
         """Not testing local opt"""
     def testMake3D(self):
@@ -525,6 +1048,33 @@ class TestCDK(TestToolkit):
     def testMake3D(self):
         """No 3D coordinate generation done"""
         pass
+    def testcalcdescsnprocs(self):
+        """No worker processes, as the JVM cannot be shared"""
+        pass
+    def testgraphstereo(self):
+        """No stereo elements in the CDK"""
+        pass
+
+    def testplandescs(self):
+        """Shared atom typing gives the same descriptor values"""
+        desc = self.mols[1].calcdesc()
+        table = cdk.calcdescs(self.mols)
+        for name, value in desc.iteritems():
+            self.assertAlmostEqual(table[name][1], value, 6)
+
+    def testcalcdescscopy(self):
+        """Perceiving the atom types leaves the molecules unchanged"""
+        mol = cdk.readstring("smi", "c1ccccc1O")
+        types = [atom.Atom.getAtomTypeName() for atom in mol.atoms]
+        flags = [atom.Atom.getFlag(cdk.cdk.CDKConstants.ISAROMATIC)
+                 for atom in mol.atoms]
+        formula = mol.formula
+        cdk.calcdescs([mol], [self.tpsaname])
+        self.assertEqual([atom.Atom.getAtomTypeName() for atom in mol.atoms],
+                         types)
+        self.assertEqual([atom.Atom.getFlag(cdk.cdk.CDKConstants.ISAROMATIC)
+                          for atom in mol.atoms], flags)
+        self.assertEqual(mol.formula, formula)
 
     def testRSgetprops(self):
         """Get the values of the properties."""
@@ -534,15 +1084,439 @@ class TestCDK(TestToolkit):
         self.assertEqual(len(self.mols[0].atoms), 4)
         self.assertRaises(AttributeError, self.RSaccesstest)
 
+    def testmasses(self):
+        """The masses match those of a copy with explicit hydrogens"""
+        atommanip = cdk.cdk.tools.manipulator.AtomContainerManipulator
+        manip = cdk.cdk.tools.manipulator.MolecularFormulaManipulator
+        for mol in self.head:
+            clone = cdk.Molecule(mol.Molecule.clone())
+            clone.addh()
+            self.assertAlmostEqual(mol.molwt,
+                        atommanip.getNaturalExactMass(clone.Molecule), 6)
+            mf = manip.getMolecularFormula(clone.Molecule)
+            self.assertAlmostEqual(mol.exactmass,
+                                   manip.getMajorIsotopeMass(mf), 6)
+
 ##    def testRFoutputfile(self):
 ##        pass
 
+class TestFPSearch(myTestCase):
+    """Packed fingerprints"""
+
+    def testpackwords(self):
+        """Pack lists of 32-bit and 64-bit words"""
+        words = fpsearch.packwords([[1, 2, 4], [0, 0, 1]])
+        self.assertEqual(words.shape, (2, 2))
+        self.assertEqual(list(words[0]), [1 + (2 << 32), 4])
+        words = fpsearch.packwords([[5, 6]], 64)
+        self.assertEqual(list(words[0]), [5, 6])
+        self.assertRaises(ValueError, fpsearch.packwords, [[1]], 16)
+
+    def testmatrix(self):
+        """Access the bits of a FingerprintMatrix"""
+        strings = ["1" + "0"*98 + "1", "01" * 50]
+        fps = fpsearch.FingerprintMatrix(fpsearch.packbitstrings(strings), 100)
+        self.assertEqual(fps.words.shape, (2, 2))
+        self.assertEqual(fps.bits(0), [0, 99])
+        self.assertEqual(fps.bits(1), range(1, 100, 2))
+        self.assertEqual(len(fps[[1]]), 1)
+        self.assertEqual(fps[[1]].bits(0), fps.bits(1))
+
+    def testsubstructscreen(self):
+        """Find the fingerprints with all of the bits of a query"""
+        strings = ["1100" * 30, "1110" * 30, "0011" * 30, "1" * 120]
+        fps = fpsearch.FingerprintMatrix(fpsearch.packbitstrings(strings), 120)
+        self.assertEqual(fpsearch.screen(fps[0], fps).tolist(), [0, 1, 3])
+        self.assertEqual(fpsearch.screen(fps[3], fps).tolist(), [3])
+        empty = fpsearch.packbitstrings(["0" * 120])[0]
+        self.assertEqual(fpsearch.screen(empty, fps).tolist(), [0, 1, 2, 3])
+        self.assertEqual(fpsearch.screen(fps[0], fps[:0]).tolist(), [])
+
+    def testsearch(self):
+        """Similarity searching"""
+        strings = ["1100", "1110", "0011", "0000"]
+        fps = fpsearch.FingerprintMatrix(fpsearch.packbitstrings(strings), 4)
+        scores = fpsearch.tanimoto(fps[1], fps)
+        for score, result in zip(scores, [2/3., 1., 0.25, 0.]):
+            self.assertAlmostEqual(score, result)
+        indices, scores = fpsearch.search(fps[1], fps, threshold=0.5)
+        self.assertEqual(indices.tolist(), [1, 0])
+        indices, scores = fpsearch.search(fps[[2]], fps, k=2)
+        self.assertEqual(indices.tolist(), [2, 1])
+        self.assertAlmostEqual(scores[1], 0.25)
+        self.assertRaises(ValueError, fpsearch.search, fps[0][:0], fps)
+
+    def testpopcountindex(self):
+        """Searching with the popcount bounds gives the same answer"""
+        strings = ["1100", "1110", "0011", "0000", "1111", "1000"]
+        fps = fpsearch.FingerprintMatrix(fpsearch.packbitstrings(strings), 4)
+        index = fpsearch.PopcountIndex(fps)
+        self.assertEqual(len(index), len(fps))
+        for threshold in [0.0, 0.5, 0.75, 1.0]:
+            for i in range(len(fps)):
+                for k in [None, 2]:
+                    ans = fpsearch.search(fps[i], fps, threshold, k)
+                    result = index.search(fps[i], threshold, k)
+                    self.assertEqual(result[0].tolist(), ans[0].tolist())
+                    self.assertEqual(result[1].tolist(), ans[1].tolist())
+
+    def testneighbours(self):
+        """Find all similar pairs using several processes"""
+        strings = ["1100", "1110", "0011", "0000", "1111", "1000"]
+        fps = fpsearch.FingerprintMatrix(fpsearch.packbitstrings(strings), 4)
+        pairs = fpsearch.neighbours(fps, 0.5, "testoutput.pairs", nprocs=2,
+                                    blocksize=2)
+        found = sorted((i, j) for i, j, score in pairs.tolist())
+        expected = [(i, j) for i in range(len(fps)) for j in range(i + 1, len(fps))
+                    if fpsearch.tanimoto(fps[i], fps)[j] >= 0.5]
+        self.assertEqual(found, expected)
+        self.assertEqual(len(fpsearch.loadneighbours("testoutput.pairs")),
+                         len(expected))
+        self.assertRaises(IOError, fpsearch.neighbours, fps, 0.5,
+                          "testoutput.pairs")
+        del pairs
+        os.remove("testoutput.pairs")
+
+    def testbutina(self):
+        """Cluster the neighbours"""
+        strings = ["1100", "1110", "0011", "0000", "1111", "1000"]
+        fps = fpsearch.FingerprintMatrix(fpsearch.packbitstrings(strings), 4)
+        pairs = fpsearch.neighbours(fps, 0.6, "testoutput.pairs")
+        clusters = fpsearch.butina(pairs, len(fps))
+        self.assertEqual(clusters, [[1, 0, 4], [2], [3], [5]])
+        clusters = fpsearch.butina(pairs, len(fps), reordering=True)
+        self.assertEqual(sorted(sum(clusters, [])), range(len(fps)))
+        del pairs
+        os.remove("testoutput.pairs")
+
+class ChainMolecule(object):
+    """A stand-in for a Molecule, for testing desctable.graphbatch()"""
+    def __init__(self, natoms):
+        self.natoms = natoms
+
+    def atomtable(self):
+        return desctable.atomcolumns([(6, 0, 0, 3, 0., i, 0., 0.)
+                                      for i in range(self.natoms)])
+
+    def bondtable(self):
+        return desctable.bondcolumns(self.natoms, [(i, i + 1, 1.)
+                                     for i in range(self.natoms - 1)])
+
+class TestDescTable(myTestCase):
+    """Tables of descriptor values"""
+
+    def testfromrows(self):
+        """Convert rows into columns"""
+        table = desctable.fromrows(["a", "b"], [(1, 2), (3, "x")])
+        self.assertEqual(list(table["a"]), [1.0, 3.0])
+        self.assertEqual(table["b"][0], 2.0)
+        self.assertTrue(table["b"][1] != table["b"][1]) # NaN
+        table = desctable.fromrows(["a"], [])
+        self.assertEqual(len(table["a"]), 0)
+
+    def testfromdicts(self):
+        """Convert dictionaries into columns"""
+        table = desctable.fromdicts([{"a": 1}, {}, {"a": 2, "b": 3}])
+        self.assertEqual(sorted(table.keys()), ["a", "b"])
+        self.assertEqual(table["a"][2], 2.0)
+        self.assertTrue(table["a"][1] != table["a"][1]) # NaN
+
+    def testmaprows(self):
+        """Calculate rows in order using several processes"""
+        molecules = ["C" * i for i in range(10)]
+        for nprocs in [1, 2]:
+            rows = list(desctable.maprows(descrows, ["x", "y"], molecules,
+                                          nprocs, chunksize=3))
+            self.assertEqual(rows, [[i, 2 * i] for i in range(10)])
+
+    def testbondcolumns(self):
+        """Convert bonds into columns and an adjacency"""
+        table = desctable.bondcolumns(4, [(2, 0, 1.), (0, 1, 2.)])
+        self.assertEqual(table["indptr"].tolist(), [0, 2, 3, 4, 4])
+        self.assertEqual(table["indices"].tolist(), [1, 2, 0, 0])
+        self.assertEqual(table["bondindex"].tolist(), [1, 0, 1, 0])
+        self.assertEqual(table["order"].tolist(), [1., 2.])
+
+    def testgraphbatch(self):
+        """Combine the tables of several molecules"""
+        batch = desctable.graphbatch([ChainMolecule(n) for n in [3, 0, 2]])
+        self.assertEqual(batch["atomoffsets"].tolist(), [0, 3, 3, 5])
+        self.assertEqual(batch["bondoffsets"].tolist(), [0, 2, 2, 3])
+        self.assertEqual(batch["molecule"].tolist(), [0, 0, 0, 2, 2])
+        self.assertEqual(batch["begin"].tolist(), [0, 1, 3])
+        self.assertEqual(batch["end"].tolist(), [1, 2, 4])
+        self.assertEqual(batch["indptr"].tolist(), [0, 1, 3, 4, 5, 6])
+        self.assertEqual(batch["coords"][4].tolist(), [1., 0., 0.])
+        batch = desctable.graphbatch([])
+        self.assertEqual(batch["atomoffsets"].tolist(), [0])
+        self.assertEqual(len(batch["indptr"]), 1)
+
+class BitStringToolkit(object):
+    """A stand-in for a Cinfony module, for testing fpsearch"""
+    class Molecule(object):
+        def __init__(self, bitstring, title):
+            self.bitstring, self.title = bitstring, title
+
+    def calcfps(self, molecules, fptype="bitstring"):
+        strings = [mol.bitstring for mol in molecules]
+        return fpsearch.FingerprintMatrix(fpsearch.packbitstrings(strings),
+                                          len(strings[0]), fptype)
+
+class TestFPDB(myTestCase):
+    """Fingerprint database files"""
+
+    def setUp(self):
+        self.toolkit = BitStringToolkit()
+        strings = ["1100", "1110", "0011", "0000"]
+        self.mols = [self.toolkit.Molecule(x, "mol%d" % i)
+                     for i, x in enumerate(strings)]
+
+    def tearDown(self):
+        if os.path.isfile("testoutput.fpdb"):
+            os.remove("testoutput.fpdb")
+
+    def testmakedb(self):
+        """Make a database and read it back"""
+        db = fpsearch.makedb("testoutput.fpdb", self.toolkit, self.mols,
+                             titlesize=3)
+        self.assertEqual(len(db), 4)
+        self.assertEqual(db.fptype, "bitstring")
+        self.assertEqual(db.title(1), "mol")
+        self.assertEqual(db.fps.bits(1), [0, 1, 2])
+        self.assertEqual(db.fps.popcounts().tolist(), [2, 3, 2, 0])
+        indices, scores = db.search(db.fps[0], threshold=0.5)
+        self.assertEqual(indices.tolist(), [0, 1])
+
+    def testemptydb(self):
+        """Make a database with no molecules"""
+        db = fpsearch.makedb("testoutput.fpdb", self.toolkit, [])
+        self.assertEqual(len(db), 0)
+
+    def testnotadb(self):
+        """Test that opening the wrong type of file raises an error"""
+        self.assertRaises(IOError, fpsearch.FingerprintDB, "head.sdf")
+
+class TestSmartsLib(myTestCase):
+    """Screening SMARTS patterns without a toolkit"""
+
+    def testrequirements(self):
+        """Read the element and ring requirements of a pattern"""
+        self.assertEqual(smartslib.requirements("c1ccccc1C(=O)[N;H1]"),
+                         ({6: 7, 7: 1, 8: 1}, 1))
+        self.assertEqual(smartslib.requirements("[C,N]C.[!#8]"), ({6: 1}, 0))
+        self.assertEqual(smartslib.requirements("[c;!$(c=O)]Cl"),
+                         ({6: 1, 17: 1}, 0))
+        self.assertEqual(smartslib.requirements("[#7][2H][Na+]"), ({7: 1}, 0))
+        self.assertEqual(smartslib.requirements("C%10CC%10"), ({6: 3}, 1))
+        self.assertRaises(ValueError, smartslib.requirements, "[C")
+
+    def testscreen(self):
+        """Only match the patterns that pass the screen"""
+        screen = smartslib.Screen(["CCO", "c1ccccc1", "[#7]", "*"])
+        self.assertEqual(screen.candidates({6: 6}, 1).tolist(),
+                         [False, True, False, True])
+        self.assertEqual(screen.candidates({6: 2, 8: 1, 7: 1}, 0).tolist(),
+                         [True, False, True, True])
+        matched = []
+        def matches(i, molecule):
+            matched.append((i, molecule))
+            return i != 3
+        counts = {"ethanol": ({6: 2, 8: 1}, 0), "benzene": ({6: 6}, 1)}
+        hits = screen.hitmatrix(["ethanol", "benzene"], counts.get, matches)
+        self.assertEqual(hits.tolist(), [[True, False, False, False],
+                                         [False, True, False, False]])
+        self.assertEqual(len(matched), 4)
+
+    def testselect(self):
+        """Keep the molecules that match any, all or none of the patterns"""
+        screen = smartslib.Screen(["CCO", "c1ccccc1", "*"])
+        counts = {"ethanol": ({6: 2, 8: 1}, 0), "benzene": ({6: 6}, 1),
+                  "water": ({8: 1}, 0)}
+        matched = []
+        def matches(i, molecule):
+            matched.append((i, molecule))
+            return i != 2 or molecule != "water"
+        mols = ["ethanol", "benzene", "water"]
+        self.assertEqual(screen.select(mols, counts.get, matches),
+                         [True, True, False])
+        self.assertEqual(len(matched), 3) # Stops at the first match
+        self.assertEqual(screen.select(mols, counts.get, matches, "none"),
+                         [False, False, True])
+        del matched[:]
+        self.assertEqual(screen.select(mols, counts.get, matches, "all"),
+                         [False, False, False])
+        self.assertEqual(matched, []) # No molecule passes every screen
+        self.assertRaises(ValueError, screen.select, mols, counts.get,
+                          matches, "some")
+
+    def testfilterrecords(self):
+        """Keep the records of a file in their original order"""
+        for nprocs in [1, 2]:
+            records = smartslib.filterrecords(keeptitles, inittitles, "sdf",
+                                              "head.sdf", ["NSC 2", "NSC 1"],
+                                              nprocs=nprocs, chunksize=1)
+            self.assertEqual([recordio.readtitle("sdf", x) for x in records],
+                             ["NSC 1", "NSC 2"])
+        self.assertRaises(ValueError, smartslib.filterrecords, keeptitles,
+                          inittitles, "mol2", "head.sdf", [])
+
+class TestMolGraph(myTestCase):
+    """The graph of a molecule without a toolkit"""
+
+    def testdefaults(self):
+        """A MolGraph has no coordinates or stereo unless given"""
+        graph = molgraph.MolGraph([(8, 0, 0, 2, False)], [], title="water")
+        self.assertEqual(graph.coords, None)
+        self.assertEqual(graph.dim, 0)
+        self.assertEqual(graph.tetrahedral, [])
+        self.assertEqual(graph.cistrans, [])
+        self.assertEqual(repr(graph), "<MolGraph of 1 atoms and 0 bonds>")
+        self.assertRaises(AttributeError, setattr, graph, "foo", 1)
+
+    def testreorder(self):
+        """Reordering the neighbours of a stereocentre"""
+        refs = (0, 1, 2, None)
+        self.assertTrue(molgraph.reorder(refs, True, refs))
+        self.assertFalse(molgraph.reorder(refs, False, refs))
+        # An even permutation keeps the winding, an odd one reverses it
+        self.assertTrue(molgraph.reorder(refs, True, (1, 2, 0, None)))
+        self.assertFalse(molgraph.reorder(refs, True, (None, 1, 2, 0)))
+        self.assertTrue(molgraph.reorder(refs, False, (1, 0, 2, None)))
+
+class TestRecordIO(myTestCase):
+    """Splitting files into records without a toolkit"""
+
+    def testsdfrecords(self):
+        """Split an SDF file into records"""
+        records = list(recordio.iterrecords("sdf", "head.sdf"))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].split("\n")[0].rstrip(), "NSC 1")
+        self.assertEqual(records[1].rstrip()[-4:], "$$$$")
+        self.assertEqual("".join(records), open("head.sdf", "rb").read())
+
+    def testtags(self):
+        """Read the title and SD tags of a record"""
+        record = recordio.iterrecords("sdf", "head.sdf").next()
+        self.assertEqual(recordio.readtitle("sdf", record), "NSC 1")
+        self.assertEqual(recordio.readtags(record), {"NSC": "1"})
+        record = "x\r\n\r\n\r\nM  END\r\n> <A> (1)\r\na\r\nb\r\n\r\n$$$$\r\n"
+        self.assertEqual(recordio.readtitle("sdf", record), "x")
+        self.assertEqual(recordio.readtags(record), {"A": "a\nb"})
+        self.assertEqual(recordio.readtitle("smi", "CCO\n"), "")
+        self.assertEqual(recordio.readtitle("smi", "CCO\tethanol\n"),
+                         "ethanol")
+
+    def testtagcolumns(self):
+        """Scan the titles and SD tags of a file into columns"""
+        columns = recordio.tagcolumns("head.sdf", ["NSC", "missing"])
+        self.assertEqual(columns["title"], ["NSC 1", "NSC 2"])
+        self.assertEqual(columns["NSC"], ["1", "2"])
+        self.assertEqual(columns["missing"], [None, None])
+        filedes, filename = tempfile.mkstemp(suffix=".sdf.gz")
+        os.close(filedes)
+        try:
+            output = recordio.openoutput(filename)
+            output.write(open("head.sdf", "rb").read())
+            output.close()
+            rows = list(recordio.itertags(filename, ["NSC"]))
+            self.assertEqual(rows, [("NSC 1", "1"), ("NSC 2", "2")])
+        finally:
+            os.remove(filename)
+
+    def testlazymolecule(self):
+        """Only read the molecule when it is needed"""
+        record = recordio.iterrecords("sdf", "head.sdf").next()
+        mol = recordio.LazyMolecule("sdf", record, readtagmolecule)
+        self.assertEqual(mol.title, "NSC 1")
+        mol.data["NSC"] = "one"
+        mol.data["new"] = "value"
+        mol = pickle.loads(pickle.dumps(mol))
+        self.assertEqual(mol.data["new"], "value")
+        self.assertTrue(mol.molecule is mol.molecule)
+        self.assertEqual(mol.title, "parsed")
+        self.assertEqual(mol.data, {"NSC": "one", "new": "value",
+                                    "Comment": "comment"})
+        mol.extra = 1 # Set on the molecule
+        self.assertEqual(mol.molecule.extra, 1)
+        self.assertRaises(AttributeError, getattr, mol, "missing")
+
+    def testchunks(self):
+        """Group records into chunks"""
+        chunks = list(recordio.iterchunks("sdf", "head.sdf", chunksize=1))
+        self.assertEqual([len(x) for x in chunks], [1, 1])
+
+    def testindex(self):
+        """Save and reuse an index of the records"""
+        filedes, filename = tempfile.mkstemp(suffix=".sdf")
+        os.write(filedes, open("head.sdf", "rb").read())
+        os.close(filedes)
+        try:
+            index = recordio.RecordIndex("sdf", filename)
+            self.assertTrue(os.path.isfile(index.indexname))
+            index.close()
+            index = recordio.RecordIndex("sdf", filename)
+            self.assertEqual(len(index), 2)
+            self.assertEqual(index[1].splitlines()[0], "NSC 2")
+            self.assertEqual(len(index[:]), 2)
+            index.close()
+            # Appending a record changes the size, so the index is rebuilt
+            output = open(filename, "ab")
+            output.write("CCO ethanol\n\nM  END\n$$$$\n")
+            output.close()
+            index = recordio.RecordIndex("sdf", filename)
+            self.assertEqual(len(index), 3)
+            index.close()
+        finally:
+            os.remove(filename)
+            os.remove(filename + ".idx")
+
+    def testcompressed(self):
+        """Write and read compressed files"""
+        text = open("head.sdf", "rb").read()
+        for filename in ["testoutput.sdf.gz", "testoutput.sdf.bz2"]:
+            outputfile = recordio.openoutput(filename)
+            outputfile.write(text)
+            outputfile.close()
+            records = list(recordio.iterrecords("sdf", filename))
+            self.assertEqual("".join(records), text)
+            self.assertRaises(ValueError, recordio.RecordIndex, "sdf", filename)
+            os.remove(filename)
+
+    def testwriterecords(self):
+        """Write the text of records without parsing them"""
+        records = list(recordio.iterrecords("sdf", "head.sdf"))
+        for filename in ["testoutput.sdf", "testoutput.sdf.gz"]:
+            self.assertEqual(recordio.writerecords("sdf", iter(records),
+                                                   filename), 2)
+            self.assertEqual(list(recordio.iterrecords("sdf", filename)),
+                             records)
+            self.assertRaises(IOError, recordio.writerecords, "sdf",
+                              records, filename)
+            os.remove(filename)
+        recordio.writerecords("smi", ["CCO ethanol", "C methane\n"],
+                              "testoutput.smi")
+        self.assertEqual(open("testoutput.smi", "rb").read(),
+                         "CCO ethanol\nC methane\n")
+        os.remove("testoutput.smi")
+        self.assertRaises(ValueError, recordio.writerecords, "noel",
+                          records, "testoutput.sdf")
+
+    def testerrors(self):
+        """Test that invalid formats and missing files raise errors"""
+        self.assertRaises(ValueError, list,
+                          recordio.iterrecords("noel", "head.sdf"))
+        self.assertRaises(IOError, list,
+                          recordio.iterrecords("sdf", "nosuchfile.sdf"))
+
 if __name__=="__main__":
     if os.path.isfile("testoutput.txt"):
         os.remove("testoutput.txt")
 
     lookup = {'cdk': TestCDK, 'obabel':TestOBabel, 'rdk':TestRDKit,
-              'webel': TestWebel}
+              'webel': TestWebel, 'recordio': TestRecordIO,
+              'fpsearch': TestFPSearch, 'fpdb': TestFPDB,
+              'desctable': TestDescTable, 'smartslib': TestSmartsLib,
+              'molgraph': TestMolGraph}
     if sys.platform[:4] == "java":
         lookup['obabel'] = TestJybel
         del lookup['rdk']